@@ -5,18 +5,33 @@ import logging as log
 import argparse
 from crontab import CronTab
 from datetime import datetime,timedelta
-from smtp_client import SMTPClient
-import time
+from smtp_client import MailQueue
 import subprocess
 import os.path
 import re
 import gc
-import yaml
+import json
+import backupconfig
 import shutil
+import threading
+import time
 import elasticdump
 import mysqldump
 import pgdump
 import mongodump
+import workerpool
+import dumppipe
+import dumpstate
+import functools
+import contextlib
+import tempfile
+import scheduler
+import throttle
+import bandwidth
+import metrics
+import control
+import resticjson
+import repository
 
 def fail(msg,args):
 	log.error(msg,args)
@@ -60,27 +75,35 @@ class ParseCronExpressions(argparse.Action):
 
 		setattr(namespace, self.dest, items)
 
-def get_next_schedule(crontab):
-	now=datetime.now()
-	delay=-1
-	for cron in crontab:
-		cron_delay=cron.next(now,default_utc=False)
-		if delay<0 or cron_delay<delay:
-			delay=cron_delay
-	return now+timedelta(seconds=delay)
+# lanes of the scheduler, each with its own cron expressions and overlap policy (rotate only runs via the control API)
+SCHEDULE_LANES=['backup','prune','rotate','check']
+
+class ParseOverlapPolicies(argparse.Action):
+	'''
+	Parses "<policy>" (all lanes) or "<lane>=<policy>" into a dict of lane names to overlap policies.
+	'''
+	def __call__(self, parser, namespace, values, option_string=None):
+		policies=dict(getattr(namespace,self.dest) or {})
+		if type(values) is str:
+			values=[values]
+		for value in values:
+			lane,_,policy=value.rpartition('=')
+			if policy not in scheduler.OVERLAP_POLICIES:
+				raise argparse.ArgumentError(self,'%s: policy must be one of %s'%(value,', '.join(scheduler.OVERLAP_POLICIES)))
+			if lane and lane not in SCHEDULE_LANES:
+				raise argparse.ArgumentError(self,'%s: lane must be one of %s'%(value,', '.join(SCHEDULE_LANES)))
+			for name in [lane] if lane else SCHEDULE_LANES:
+				policies[name]=policy
+		setattr(namespace, self.dest, policies)
 
 def load_config():
-	config_file=get_env('BACKUP_CONFIG',None)
-	if config_file is None:
-		return {}
-	if not os.path.exists(config_file):
-		log.error('Config does not exist: %s'%config_file)
+	'''
+	Returns the validated config (cached until the file changes) or None if it is invalid.
+	'''
 	try:
-		log.info('Using extra config from %s'%config_file)
-		with open(config_file,'r') as config:
-			return yaml.safe_load(config)
-	except:
-		log.exception('Unable to read config file %s'%config_file)
+		return backupconfig.load_config(get_env('BACKUP_CONFIG',None),[(name,settings) for name,title,settings,dump_with_config in DUMP_ENGINES])
+	except backupconfig.ConfigError as e:
+		log.error('Invalid config: %s'%e)
 		return None
 
 def run_pre_backup_script(scriptinfo):
@@ -107,13 +130,15 @@ def run_pre_backup_script(scriptinfo):
 
 	return True
 
-def init_restic_repo():
+def init_restic_repo(env=None, copy_from=None):
 	log.info('Initializing repository')
+	cmd=['restic','init']
+	if copy_from is not None:
+		# same chunker parameters as the repository snapshots are copied from, so copied data deduplicates
+		cmd.append('--copy-chunker-params')
+		env=dict(env if env is not None else environ,**copy_source_env(copy_from))
 	try:
-		subprocess.check_output([
-			'restic',
-			'init'
-		],stderr=subprocess.STDOUT)
+		subprocess.check_output(cmd,stderr=subprocess.STDOUT,env=env)
 		log.info('Repository initialized.')
 	except subprocess.CalledProcessError as e:
 		output=e.output.decode()
@@ -124,221 +149,492 @@ def init_restic_repo():
 			return False
 	return True
 
-def run_backup(prune=False, dump_only=False):
+def keep_from_env():
+	keep={}
+	for keep_type in backupconfig.KEEP_TYPES:
+		keep_env='KEEP_%s' % (keep_type.upper())
+		if keep_env in environ:
+			keep[keep_type]=str(environ[keep_env])
+	return keep or None
+
+def target_env(target):
+	'''
+	Environment of restic commands for a target of the config.
+	'''
+	env=dict(environ,**target['env'])
+	env['RESTIC_REPOSITORY']=target['repository']
+	if target['password'] is not None:
+		env['RESTIC_PASSWORD']=target['password']
+		env.pop('RESTIC_PASSWORD_FILE',None)
+	elif target['password_file'] is not None:
+		env['RESTIC_PASSWORD_FILE']=target['password_file']
+		env.pop('RESTIC_PASSWORD',None)
+	return env
+
+def copy_source_env(repo):
+	'''
+	Environment variables that make repo the source of "restic copy" (and of chunker parameters for "restic init").
+	'''
+	env=repo.env if repo.env is not None else environ
+	result={'RESTIC_FROM_REPOSITORY': repo.url}
+	for name in ['PASSWORD','PASSWORD_FILE']:
+		if 'RESTIC_%s'%name in env:
+			result['RESTIC_FROM_%s'%name]=env['RESTIC_%s'%name]
+	return result
+
+def get_repositories(config):
+	'''
+	Returns the repositories to back up to: the targets of the config or the one of RESTIC_REPOSITORY.
+	'''
+	if config.targets is None:
+		return [repository.get(get_env('RESTIC_REPOSITORY'),keep=config.keep or keep_from_env())]
+	return [repository.get(target['repository'],target['name'],target_env(target),target['keep'] or keep_from_env(),
+		{'target': target['name']}) for target in config.targets]
+
+def open_repository(repo, copy_from=None):
+	'''
+	Starts a job on the repository. Initializes it, unless this process already did. Returns False if that failed.
+	'''
+	repo.begin_job()
+	return repo.ensure_initialized(functools.partial(metrics.timed,'init',init_restic_repo,repo.env,copy_from,labels=repo.labels))
+
+def report_repositories():
+	for repo in repository.all_repositories():
+		repo.report()
+
+def run_on_targets(name, repos, job, cancel=None):
+	'''
+	Runs job(repo,cancel) for each repository concurrently. Targets fail independently, so a failure does not stop the
+	others. Returns the repositories for which the job succeeded.
+	'''
+	succeeded=[]
+	def run(repo,cancel):
+		result=job(repo,cancel)
+		if result:
+			succeeded.append(repo)
+		return result
+	workerpool.run_parallel(name,[(repo.name,functools.partial(run,repo)) for repo in repos],len(repos),cancel,
+		log_prefix=any([repo.labels for repo in repos]),fail_fast=False)
+	return [repo for repo in repos if repo in succeeded]
+
+def target_job(phase, function):
+	'''
+	Wraps function(repo,cancel) into a job for run_on_targets that opens the repository first and records the phase.
+	'''
+	def run(repo,cancel):
+		if not open_repository(repo):
+			return False
+		return metrics.timed(phase,function,repo,cancel,labels=repo.labels)
+	return run
+
+# config key, log name, settings parser and dump function of all supported dump engines (in order of execution)
+DUMP_ENGINES=[
+	('elasticdump','Elasticdump',elasticdump.es_dump_settings,elasticdump.es_dump_with_config),
+	('mysqldump','Mysqldump',mysqldump.mysql_dump_settings,mysqldump.mysql_dump_with_config),
+	('pgdump','Pgdump',pgdump.pg_dump_settings,pgdump.pg_dump_with_config),
+	('mongodump','Mongodump',mongodump.mongodump_settings,mongodump.mongodump_with_config),
+]
+
+# latency probe of the throttle for each engine in throttle.PROBE_ENGINES
+DUMP_PROBES={
+	'mysqldump': mysqldump.mysql_probe,
+	'pgdump': pgdump.pg_probe,
+}
+
+def throttle_probe(config):
+	if config.throttle is None or config.throttle['probe'] is None:
+		return None
+	engine=config.throttle['probe']['engine']
+	return functools.partial(DUMP_PROBES[engine],dict(config.engines)[engine])
+
+def prepare_dump_dir(backup_root,name,keep_files=False):
+	dump_dir=os.path.join(backup_root,name)
+	if keep_files:
+		# engines that skip unchanged databases keep their previous dumps and clean up stale files themselves
+		if not os.path.isdir(dump_dir):
+			os.mkdir(dump_dir)
+		return dump_dir
+	try:
+		shutil.rmtree(dump_dir)
+	except:
+		pass
+	if os.path.exists(dump_dir):
+		log.error('Unable to delete old %s dir at %s'%(name,dump_dir))
+	os.mkdir(dump_dir)
+	return dump_dir
+
+def run_dump(title,dump_with_config,dump_dir,write_dir,dump_settings,stream,checkpoint,cancel):
+	if stream is None:
+		log.info('Running %s to %s'%(title.lower(),write_dir))
+	else:
+		log.info('Running %s and streaming to restic'%title.lower())
+	dump_ok=dump_with_config(write_dir,dump_settings,cancel,stream,checkpoint)
+	if not dump_ok:
+		log.error('%s failed. Backup canceled.'%title)
+		return False
+	if write_dir!=dump_dir:
+		dumpstate.merge_dump_dir(write_dir,dump_dir,title)
+	return True
+
+def run_dumps(backup_root,config,stream=None,cancel=None,resume=False):
+	'''
+	Runs the configured dump engines. With resume, databases/indices that the last (failed) run dumped completely are kept
+	and the completed ones of this run are recorded in a checkpoint.
+	'''
+	jobs=[]
+	engines=dict(config.engines)
+	for name,title,settings,dump_with_config in DUMP_ENGINES:
+		if name not in engines:
+			continue
+		skip_unchanged=engines[name].get('skip_unchanged') is not None
+		dump_dir=os.path.join(backup_root,name)
+		# dumps are written to a new dir and merged into dump_dir, so unchanged files keep their mtime (engines that skip
+		# unchanged databases keep those files themselves)
+		new_dir=os.path.join(backup_root,'.%s.new'%name)
+		write_name=os.path.basename(new_dir) if stream is None and not skip_unchanged else name
+		write_dir=os.path.join(backup_root,write_name)
+		if write_dir!=new_dir and os.path.isdir(new_dir):
+			# left over from a failed run, it must not end up in the backup
+			shutil.rmtree(new_dir)
+		checkpoint=None
+		if stream is None and resume and os.path.isdir(write_dir):
+			checkpoint=dumpstate.load_checkpoint(title,write_dir,config.resume_max_age,config.dump_retries,config.dump_retry_delay)
+		prepare_dump_dir(backup_root,write_name,checkpoint is not None or skip_unchanged)
+		if write_dir!=dump_dir and not os.path.isdir(dump_dir):
+			os.mkdir(dump_dir)
+		if checkpoint is None:
+			dumpstate.remove_checkpoint(write_dir)
+			# recording reads each dump file again for its sha256, so only runs that can be resumed do it. Streamed dumps
+			# leave no files to check, they are only retried
+			checkpoint=dumpstate.Checkpoint(title,write_dir if stream is None and resume else None,config.dump_retries,config.dump_retry_delay)
+		jobs.append((name,metrics.timed_job('dump',{'engine': name},
+			functools.partial(run_dump,title,dump_with_config,dump_dir,write_dir,engines[name],stream,checkpoint),
+			[dump_dir] if stream is None else None)))
+
+	# number of dump engines to run concurrently (default: one after another)
+	parallelism=config.dump_parallelism
+	if parallelism>1 and len(jobs)>1:
+		log.info('Running %s dump engines with up to %s in parallel'%(len(jobs),parallelism))
+	with throttle.throttled(config.throttle,throttle_probe(config)):
+		return workerpool.run_parallel('Dump',jobs,parallelism,cancel,log_prefix=parallelism>1)
+
+def remove_checkpoints(backup_root,config):
+	'''
+	Removes the checkpoints once the dumps are backed up, so the next run cannot resume them. Only engines that skip
+	unchanged databases have them in their dump dir, the others remove them with the merged write dir.
+	'''
+	for name,settings in config.engines:
+		dumpstate.remove_checkpoint(os.path.join(backup_root,name))
+
+@contextlib.contextmanager
+def stream_settings(config, repo):
+	'''
+	Settings to stream dumps into repo. The password of a configured target is passed to restic in a private temporary file.
+	'''
+	if repo.env is None:
+		yield dumppipe.restic_stream_settings(get_env('BACKUP_HOSTNAME'),config.tags,config.cache_dir,bandwidth=config.bandwidth)
+		return
+	password_file=repo.env.get('RESTIC_PASSWORD_FILE')
+	tmp_file=None
+	if 'RESTIC_PASSWORD' in repo.env:
+		fd,tmp_file=tempfile.mkstemp(prefix='restic-password')
+		with os.fdopen(fd,'w') as f:
+			f.write(repo.env['RESTIC_PASSWORD'])
+		password_file=tmp_file
+	try:
+		yield dumppipe.restic_stream_settings(get_env('BACKUP_HOSTNAME'),config.tags,config.cache_dir,repo.url,password_file,config.bandwidth)
+	finally:
+		if tmp_file is not None:
+			os.unlink(tmp_file)
+
+def restic_limits(command):
+	'''
+	Returns the bandwidth limit arguments of a restic command starting now.
+	'''
+	config=load_config()
+	return bandwidth.restic_args(config.bandwidth if config is not None else None,command)
+
+def target_subject(subject, repo):
+	return '%s (%s)'%(subject,repo.name) if repo.labels else subject
+
+@metrics.phase_timer('run')
+def run_backup(prune=False, dump_only=False, cancel=None, resume=False):
 	backup_root=get_env('BACKUP_ROOT')
 
 	config=load_config()
 	if config is None:
 		return False
 
+	targets=[]
 	if not dump_only:
-		if not init_restic_repo():
+		targets=get_repositories(config)
+		copy=config.replication=='copy' and len(targets)>1
+		def prepare(repo,cancel):
+			# targets the backup is copied to get the chunker parameters of the first one
+			if not open_repository(repo,targets[0] if copy and repo is not targets[0] else None):
+				return False
+			try:
+				repo.ensure_unlocked()
+			except subprocess.CalledProcessError:
+				return False
+			return True
+		# targets that cannot be initialized or unlocked fail, the others are backed up anyway
+		if copy:
+			# the other targets are initialized with the chunker parameters of the first one, which must exist by then
+			ready=run_on_targets('Prepare',targets[:1],prepare,cancel)
+			if ready:
+				ready+=run_on_targets('Prepare',targets[1:],prepare,cancel)
+		else:
+			ready=run_on_targets('Prepare',targets,prepare,cancel)
+		if not ready or (copy and ready[0] is not targets[0]):
 			return False
-		log.info("Unlocking repository")
-		subprocess.check_call(["restic", "unlock"], stderr=subprocess.STDOUT)
 
 	if not (os.path.exists(backup_root)):
 		log.info('Backup mount point not found %s. Creating internal mount point for dump jobs. This might be ok if you only backup database dumps.'%backup_root)
 		os.mkdir(backup_root)
 
-	smtp_client = None
-
-	if "smtp" in config:
-		smtp_client = SMTPClient(config["smtp"])
-
-	if 'pre-backup-scripts' in config:
-		for script in config['pre-backup-scripts']:
-			if not run_pre_backup_script(script):
+	if config.pre_backup_scripts:
+		for index,script in enumerate(config.pre_backup_scripts):
+			label=script['description'] if 'description' in script else str(index)
+			if not metrics.timed('pre_backup_script',run_pre_backup_script,script,labels={'script': label}):
 				log.error('Stopped due to pre-backup script failures')
 				return False
 
-	if 'elasticdump' in config:
-		elasticdump_dir=os.path.join(backup_root,'elasticdump')
-		try:
-			shutil.rmtree(elasticdump_dir)
-		except:
-			pass
-		if os.path.exists(elasticdump_dir):
-			log.error('Unable to delete old elasticdump dir at %s'%elasticdump_dir)
-		os.mkdir(elasticdump_dir)
-
-		log.info('Running elasticdump to %s'%elasticdump_dir)
-		elasticdump_ok=elasticdump.es_dump_with_config(elasticdump_dir,config['elasticdump'])
-		if not elasticdump_ok:
-			log.error('Elasticdump failed. Backup canceled.')
-			return False
+	# pipe dumps directly into restic instead of writing them to BACKUP_ROOT first (into the first target, see replication)
+	if config.stream_to_restic and dump_only:
+		log.warning('stream-to-restic is ignored for dump-only runs. Writing dumps to %s'%backup_root)
+	dumps_started=time.time()
+	if config.stream_to_restic and not dump_only:
+		with stream_settings(config,ready[0]) as stream:
+			dump_ok=run_dumps(backup_root,config,stream,cancel,resume)
+	else:
+		dump_ok=run_dumps(backup_root,config,None,cancel,resume)
+	if not dump_ok:
+		return False
 
-	if 'mysqldump' in config:
-		mysqldump_dir=os.path.join(backup_root,'mysqldump')
-		try:
-			shutil.rmtree(mysqldump_dir)
-		except:
-			pass
-		if os.path.exists(mysqldump_dir):
-			log.error('Unable to delete old mysqldump dir at %s'%mysqldump_dir)
-		os.mkdir(mysqldump_dir)
-
-		log.info('Running mysqldump to %s'%mysqldump_dir)
-		mysqldump_ok=mysqldump.mysql_dump_with_config(mysqldump_dir,config['mysqldump'])
-		if not mysqldump_ok:
-			log.error('Mysqldump failed. Backup canceled.')
-			return False
+	if dump_only:
+		remove_checkpoints(backup_root,config)
+		return True
 
-	if 'pgdump' in config:
-		pgdump_dir=os.path.join(backup_root,'pgdump')
-		try:
-			shutil.rmtree(pgdump_dir)
-		except:
-			pass
-		if os.path.exists(pgdump_dir):
-			log.error('Unable to delete old pgdump dir at %s'%pgdump_dir)
-		os.mkdir(pgdump_dir)
-
-		log.info('Running pgdump to %s'%pgdump_dir)
-		pgdump_ok=pgdump.pg_dump_with_config(pgdump_dir,config['pgdump'])
-		if not pgdump_ok:
-			log.error('Pgdump failed. Backup canceled.')
+	if copy:
+		# back up once, then copy the snapshots of this run to the other targets
+		snapshots=[]
+		if not backup_target(ready[0],cancel,config,backup_root,snapshots):
 			return False
+		if config.stream_to_restic:
+			streamed=streamed_snapshots(ready[0],config,dumps_started)
+			snapshots=None if streamed is None else snapshots+streamed
+		backed_up=ready[:1]+run_on_targets('Copy',ready[1:],target_phase('copy',functools.partial(copy_to_target,source=ready[0],
+			config=config,snapshots=snapshots)),cancel)
+	else:
+		backed_up=run_on_targets('Backup',ready,functools.partial(backup_target,config=config,backup_root=backup_root),cancel)
 
-	if 'mongodump' in config:
-		mongodump_dir=os.path.join(backup_root,'mongodump')
-		try:
-			shutil.rmtree(mongodump_dir)
-		except:
-			pass
-		if os.path.exists(mongodump_dir):
-			log.error('Unable to delete old mongodump dir at %s'%mongodump_dir)
-		os.mkdir(mongodump_dir)
-
-		log.info('Running mongodump to %s'%mongodump_dir)
-		mongodump_ok=mongodump.mongodump_with_config(mongodump_dir,config['mongodump'])
-		if not mongodump_ok:
-			log.error('Mongodump failed. Backup canceled.')
-			return False
+	finished=run_on_targets('Rotate',backed_up,functools.partial(finish_target,prune=prune),cancel)
+	if len(targets)>1:
+		log.info('Targets: %s'%', '.join(['%s %s'%(repo.name,'ok' if repo in finished else 'failed') for repo in targets]))
+	if len(finished)!=len(targets):
+		return False
+	remove_checkpoints(backup_root,config)
+	return True
 
-	if dump_only:
-		return True
+def target_phase(phase, function):
+	'''
+	Wraps function(repo,cancel) into a job for run_on_targets that records the phase.
+	'''
+	def run(repo,cancel):
+		return metrics.timed(phase,function,repo,cancel,labels=repo.labels)
+	return run
+
+def finish_target(repo, cancel, prune=False):
+	if not metrics.timed('forget',forget_target,repo,cancel,labels=repo.labels):
+		return False
+	if prune:
+		return metrics.timed('prune',prune_target,repo,cancel,labels=repo.labels)
+	return True
 
+def backup_target(repo, cancel, config, backup_root, snapshots=None):
+	'''
+	Runs restic backup of backup_root (or the included files) into repo. Records the result per target, the phase
+	"backup" includes exit code 3 (some files could not be read) as success. The ID of the new snapshot is appended to snapshots.
+	'''
 	cmd=[
 		'nice','-n19',
 		'ionice','-c3',
 		'restic',
 		'backup',
+		'--json',
 		'--host',get_env('BACKUP_HOSTNAME'),
 	]
 
+	for tag in config.tags:
+		cmd+=['--tag',tag]
+
 	# exclude caches (http://bford.info/cachedir/spec.html)
-	if not ('exclude-caches' in config and bool(config['exclude-caches'])):
+	if not config.exclude_caches:
 		cmd.append('--exclude-caches')
 
 	# ignore inode for changed-file checks (default is true)
-	if not ('ignore-inode' in config and bool(config['ignore-inode'])):
+	if not config.ignore_inode:
 		cmd.append('--ignore-inode')
 
 	# set cacheDir if not default one should be used
-	if ('cache-dir' in config ):
-		log.info("cache-dir is: "+config['cache-dir'])
+	if config.cache_dir is not None:
+		log.info("cache-dir is: "+config.cache_dir)
 		cmd.append('--cache-dir')
-		cmd.append(config['cache-dir'])
+		cmd.append(config.cache_dir)
 
 	# include files to backupset from given files
-	if 'include-from' in config:
-		includes=config['include-from']
-		if type(includes) is not list:
-				includes=[includes]
-		for include in includes:
-			log.info("Use include from: %s"%include)
-			cmd.append('--files-from')
-			cmd.append(include)
+	for include in config.include_from:
+		log.info("Use include from: %s"%include)
+		cmd.append('--files-from')
+		cmd.append(include)
 
 	# exclude other files
-	if 'exclude' in config:
-		excludes=config['exclude']
-		if type(excludes) is not list:
-			excludes=[excludes]
-		for exclude in excludes:
-			log.info("Excluding: %s"%exclude)
-			cmd.append('--exclude')
-			cmd.append(exclude)
+	for exclude in config.exclude:
+		log.info("Excluding: %s"%exclude)
+		cmd.append('--exclude')
+		cmd.append(exclude)
+
+	# restic reports the data added by each file only with -vv
+	if config.report_data_added:
+		cmd.append('-vv')
 
 	# if include is set no backuproot should given as argument
-	if 'include-from' not in config:
+	if not config.include_from:
 		cmd.append(backup_root)
 
 	log.info('Starting backup')
-	try:
-		subprocess.run(cmd,stderr=subprocess.STDOUT,check=True)
+	started=time.time()
+	summary=run_limited_backup(cmd,config,cancel,repo,backup_root)
+	returncode=summary['exit_code']
+	metrics.record_phase('backup',started,returncode,repo.labels,success=returncode in (0,3))
+	metrics.record_backup_summary(summary,repo.labels)
+	if snapshots is not None and 'snapshot_id' in summary:
+		snapshots.append(summary['snapshot_id'])
+	if returncode == 0:
 		log.info('Backup finished.')
-	except subprocess.CalledProcessError as proc:
-		# some files could not be found
-		if proc.returncode == 3:
-			log.info("Backup finished with warnings.")
-			if smtp_client is not None:
-				smtp_client.send_mail("Restic Backup warning", f"Backup Host: {get_env('BACKUP_HOSTNAME')}")
-		# failed
-		else:
-			log.info('Backup failed.')
-			if smtp_client is not None:
-				smtp_client.send_mail("Restic Backup failed", f"Backup Host: {get_env('BACKUP_HOSTNAME')}")
-			return False
-
-	if not clean_old_backups(config):
+	# some files could not be found
+	elif returncode == 3:
+		log.info("Backup finished with warnings.")
+		if config.smtp is not None:
+			notify(target_subject("Restic Backup warning",repo), f"Backup Host: {get_env('BACKUP_HOSTNAME')}\n\n{resticjson.format_summary(summary)}")
+	# failed
+	else:
+		log.info('Backup failed.')
+		repo.command_failed()
+		if config.smtp is not None:
+			notify(target_subject("Restic Backup failed",repo), f"Backup Host: {get_env('BACKUP_HOSTNAME')}\n\n{resticjson.format_summary(summary)}")
 		return False
 
-	if prune:
-		return prune_repository()
-
 	return True
 
-def clean_old_backups(config=None):
+def run_limited_backup(cmd, config, cancel, repo, backup_root):
+	'''
+	Runs restic backup with the bandwidth limits of the time it starts. If the limits change while it runs (and restart-backup
+	is set), restic is stopped and started again with the new limits.
+	'''
+	restart=None
+	while True:
+		# the timer may fire a little before the change of the limits
+		now=datetime.now() if restart is None else max(datetime.now(),restart)
+		restart=None
+		if config.bandwidth is not None and config.bandwidth['restart-backup']:
+			restart=bandwidth.next_change(config.bandwidth,now)
+		# stops this run of restic at the next change of the limits
+		backup_cancel=workerpool.CancelToken(cancel)
+		timer=None
+		if restart is not None:
+			timer=threading.Timer((restart-now).total_seconds(),backup_cancel.set)
+			timer.daemon=True
+			timer.start()
+		command=cmd.index('backup')+1
+		limited_cmd=cmd[:command]+bandwidth.restic_args(config.bandwidth,'backup',now)+cmd[command:]
+		try:
+			return resticjson.run_backup(limited_cmd,config.progress_interval,backup_cancel,repo.env,repo.name,
+				backup_root if config.report_data_added else None)
+		except workerpool.Cancelled:
+			if cancel is not None and cancel.is_set():
+				raise
+			log.info('Bandwidth: limits changed at %s, restarting backup'%restart.strftime('%H:%M:%S'))
+		finally:
+			if timer is not None:
+				timer.cancel()
+
+def streamed_snapshots(repo, config, since):
+	'''
+	Returns the IDs of the snapshots of dumps streamed into repo since the timestamp since, or None if listing them failed.
+	'''
+	names=[name for name,settings in config.engines]
+	args=['snapshots','--json','--host',get_env('BACKUP_HOSTNAME')]
+	if config.cache_dir is not None:
+		args+=['--cache-dir',config.cache_dir]
+	try:
+		return [snapshot['id'] for snapshot in json.loads(repo.restic('snapshots',args))
+			if resticjson.parse_time(snapshot['time'])>=since and
+				all([path.strip('/').split('/')[0] in names for path in snapshot['paths']])]
+	except (subprocess.CalledProcessError,ValueError,KeyError,TypeError):
+		log.error('Listing the streamed snapshots of %s failed.'%repo.name)
+		repo.command_failed()
+		return None
 
-	if config is None:
-		# direct call, init first
-		config=load_config()
-		if not init_restic_repo():
-			return False
+def copy_to_target(repo, cancel, source, config, snapshots):
+	'''
+	Copies the snapshots (IDs) of this run from the repository source to repo. Older snapshots are not copied again, so
+	each target keeps them according to its own retention.
+	'''
+	if not snapshots:
+		log.warning('Copy failed! No snapshots of this run found in %s'%source.name)
+		return False
+	cmd=['nice','-n19','ionice','-c3','restic','copy']
+	if config.cache_dir is not None:
+		cmd+=['--cache-dir',config.cache_dir]
+	cmd+=bandwidth.restic_args(config.bandwidth,'copy')
+	cmd+=snapshots
+	log.info('Copying %s snapshots from %s'%(len(snapshots),source.name))
+	try:
+		workerpool.run_command(cmd,cancel,env=dict(repo.env if repo.env is not None else environ,**copy_source_env(source)))
+		log.info('Copy finished.')
+	except subprocess.CalledProcessError:
+		log.warning('Copy failed!')
+		repo.command_failed()
+		return False
+	return True
 
-	if config is None:
+def forget_target(repo, cancel):
+	if repo.keep is None:
+		log.warning('Rotation not configured. Keeping backups forever.')
 		return False
 
 	cleanup_command=[
 		'restic',
 		'forget',
 	]
+	for keep_type,keep in repo.keep.items():
+		cleanup_command+=['--keep-%s'%keep_type,keep]
+	cleanup_command+=restic_limits('forget')
 
-	if 'keep' in config:
-		keep=config['keep']
-		keep_is_valid=False
-		for keep_type in ['last','hourly','daily','weekly','monthly','yearly']:
-			if keep_type in keep:
-				keep_is_valid=True
-				cleanup_command+=['--keep-%s'%keep_type,str(keep[keep_type])]
-		if not keep_is_valid:
-			log.warning('Keep configuration is invalid - not deleting old backups.')
-			return False
-	else:
-		keep_is_valid=False
-		for keep_type in ['last','hourly','daily','weekly','monthly','yearly']:
-			keep_env='KEEP_%s' % (keep_type.upper())
-			if keep_env in environ:
-				keep_is_valid=True
-				cleanup_command+=['--keep-%s'%keep_type,str(environ[keep_env])]
-		if not keep_is_valid:
-			log.warning('Rotation not configured. Keeping backups forever.')
-			return False
-
-	log.info('Unlocking repository')
-	subprocess.run(['restic','unlock'],stderr=subprocess.STDOUT,check=True)
 	log.info('Deleting old backups')
 	try:
-		subprocess.run(cleanup_command,stderr=subprocess.STDOUT,check=True)
+		repo.ensure_unlocked()
+		workerpool.run_command(cleanup_command,cancel,env=repo.env)
 		log.info('Cleanup finished.')
 	except subprocess.CalledProcessError:
 		log.warning('Cleanup failed!')
+		repo.command_failed()
 		return False
 
 	return True
 
+def clean_old_backups(cancel=None):
+	'''
+	Rotates the backups of all targets now.
+	'''
+	config=load_config()
+	if config is None:
+		return False
+	repos=get_repositories(config)
+	return len(run_on_targets('Rotate',repos,target_job('forget',forget_target),cancel))==len(repos)
+
 def get_prune_timeout():
 	prune_timeout=get_env('RESTIC_PRUNE_TIMEOUT',UNDEFINED)
 	if (prune_timeout is None):
@@ -360,26 +656,14 @@ def get_prune_timeout():
 		return None
 	return prune_timeout
 
-def prune_repository(config=None):
-	if config is None:
-		# direct call, init first
-		config=load_config()
-		if not init_restic_repo():
-			return False
-
-	if config is None:
-		return False
-
+def prune_target(repo, cancel):
 	prune_timeout=get_prune_timeout()
 
 	prune_command=[
 		'restic',
 		'prune',
 		'-o','s3.list-objects-v1=true'  # See https://github.com/restic/restic/issues/3761
-	]
-
-	log.info('Unlocking repository')
-	subprocess.run(['restic','unlock'],stderr=subprocess.STDOUT,check=True)
+	]+restic_limits('prune')
 
 	if prune_timeout is None:
 		log.info('Pruning repository')
@@ -387,68 +671,139 @@ def prune_repository(config=None):
 		log.info('Pruning repository (timeout %s)'%get_env('RESTIC_PRUNE_TIMEOUT'))
 		prune_command=['timeout',str(prune_timeout.total_seconds())] + prune_command
 	try:
-		subprocess.run(prune_command,stderr=subprocess.STDOUT,check=True)
+		repo.ensure_unlocked()
+		workerpool.run_command(prune_command,cancel,env=repo.env)
 		log.info('Prune finished.')
 	except subprocess.CalledProcessError:
 		log.warning('Prune failed!')
+		repo.command_failed()
 		return False
 
 	return True
 
+def prune_repository(cancel=None):
+	'''
+	Prunes all targets now.
+	'''
+	config=load_config()
+	if config is None:
+		return False
+	repos=get_repositories(config)
+	return len(run_on_targets('Prune',repos,target_job('prune',prune_target),cancel))==len(repos)
 
-def notify(subject, body):
 
+# background mail delivery, created with the first notification and replaced if the smtp config changes
+_mail_queue=None
+
+def notify(subject, body):
+	'''
+	Queues a notification. Notifications are collected until flush_notifications() and sent as one mail in the background.
+	'''
+	global _mail_queue
 	config=load_config()
 	if config is None:
 		log.error('Could not load config.')
 		return False
-	if "smtp" not in config:
+	if config.smtp is None:
 		log.error("'smtp' is missing from config - not sending mail.")
 		return False
-	smpt_client = SMTPClient(config["smtp"])
-	smpt_client.send_mail(subject, body)
-	log.info("Sent Notifaction.")
+	if _mail_queue is None or _mail_queue.client.settings!=config.smtp:
+		if _mail_queue is not None:
+			_mail_queue.flush()
+		_mail_queue=MailQueue(config.smtp)
+	_mail_queue.add(subject, body)
+	log.info("Queued notification: %s"%subject)
+	return True
+
+def flush_notifications(wait=False):
+	'''
+	Sends the queued notifications of this run as one mail. With wait, blocks until it was delivered (or given up), at most
+	for the exit-timeout of the smtp config, and returns False if delivery failed or did not finish in time.
+	'''
+	if _mail_queue is None:
+		return True
+	_mail_queue.flush()
+	if wait:
+		return _mail_queue.wait(_mail_queue.exit_timeout)
 	return True
 
 
-def schedule_backup(crontab, prunecron=None, dump_only=False):
-	next_is_prune=False
-	while True:
-		next_schedule=get_next_schedule(crontab)
-		next_is_prune=False
+def check_target(repo, cancel):
+	log.info('Checking repository')
+	try:
+		workerpool.run_command(['restic','check']+restic_limits('check'),cancel,env=repo.env)
+		log.info('Check finished.')
+	except subprocess.CalledProcessError:
+		log.warning('Check failed!')
+		repo.command_failed()
+		return False
 
-		if prunecron is not None:
-			next_prune=get_next_schedule(prunecron)
-			if next_prune < next_schedule:
-				next_schedule = next_prune
-				next_is_prune = True
+	return True
 
-		if next_is_prune:
-			log.info('Scheduling next prune at %s'%next_schedule)
-		else:
-			log.info('Scheduling next backup at %s'%next_schedule)
-		while True:
-			now=datetime.now()
-			if now>=next_schedule:
-				break
-			time.sleep(10)
-		try:
-			if next_is_prune:
-				res=prune_repository()
-			else:
-				res=run_backup(prunecron is None, dump_only)
-		except:
-			res=False
-			log.exception("Something went unexpectedly wrong!")
-		finally:
-			gc.collect()
-        
-		if not res:
-			notify("Restic Backup Failed", f"Backup Host: {get_env('BACKUP_HOSTNAME')}")
+def check_repository(cancel=None):
+	'''
+	Checks all targets now.
+	'''
+	config=load_config()
+	if config is None:
+		return False
+	repos=get_repositories(config)
+	return len(run_on_targets('Check',repos,target_job('check',check_target),cancel))==len(repos)
 
+def setup_metrics(serve=False):
+	'''
+	Configures the metrics output from the "metrics" section of the config. The HTTP endpoint is only served in schedule mode.
+	'''
+	config=load_config()
+	if config is None:
+		return
+	settings=config.metrics
+	metrics.configure(get_env('BACKUP_HOSTNAME'),settings['textfile'])
+	if serve and settings['listen'] is not None:
+		metrics.serve(settings['listen'])
+
+def run_scheduled(job,failure_subject,cancel=None):
+	try:
+		res=job(cancel=cancel)
+	except workerpool.Cancelled:
+		res=False
+	except:
+		res=False
+		log.exception("Something went unexpectedly wrong!")
+	finally:
+		gc.collect()
+		report_repositories()
+		metrics.write_textfile()
+
+	if cancel is not None and cancel.is_set():
+		# stopped on request, not a failure worth a mail
+		log.warning("Job cancelled.")
+	elif not res:
+		notify(failure_subject, f"Backup Host: {get_env('BACKUP_HOSTNAME')}")
+	flush_notifications()
+	return res
+
+def schedule_backup(crontab, prunecron=None, dump_only=False, checkcron=None, overlap=None, resume=False):
+	'''
+	Runs backup, prune and check jobs at the given times. By default, a job is skipped if another one is still running.
+	All jobs (and rotate) can also be started via the control API if it is configured.
+	'''
+	overlap=overlap or {}
+	jobs=scheduler.Scheduler()
+	jobs.add_lane('backup',crontab,functools.partial(run_scheduled,functools.partial(run_backup,prunecron is None,dump_only,resume=resume),
+		"Restic Backup Failed"),overlap.get('backup','skip'))
+	jobs.add_lane('prune',prunecron,functools.partial(run_scheduled,prune_repository,"Restic Prune Failed"),overlap.get('prune','skip'))
+	jobs.add_lane('rotate',None,functools.partial(run_scheduled,clean_old_backups,"Restic Clean Failed"),overlap.get('rotate','skip'))
+	jobs.add_lane('check',checkcron,functools.partial(run_scheduled,check_repository,"Restic Check Failed"),overlap.get('check','skip'))
+	setup_metrics(serve=True)
+	config=load_config()
+	if config is not None and config.control['listen'] is not None:
+		control.serve(config.control['listen'],jobs)
+	jobs.run()
 
 def main():
 	log.basicConfig(level=log.INFO,format='%(asctime)s %(levelname)7s: %(message)s')
+	workerpool.install_log_prefix()
 	parser = argparse.ArgumentParser(description='Perform backups with restic')
 	subparsers = parser.add_subparsers(help='sub-command help',dest='cmd')
 	subparsers.required = True
@@ -456,47 +811,81 @@ def main():
 	parser_run.add_argument(
 		"--dump-only", action="store_true", help="Dump target in config without restic."
 	)
+	parser_run.add_argument(
+		"--resume", action="store_true", help="Keep the databases/indices that the last failed run with --resume dumped completely."
+	)
 	parser_run = subparsers.add_parser('rotate', help='Rotate backups now.')
 	parser_run = subparsers.add_parser('prune', help='Prune the repository now')
+	parser_run = subparsers.add_parser('check', help='Check the repository now')
 	parser_run = subparsers.add_parser('notify', help='Send test mail')
 	parser_schedule = subparsers.add_parser('schedule', help='Schedule backups.')
 	parser_schedule.add_argument('--prune',dest='prunecron',action=ParseCronExpressions,
 		help='Time to prune the backup (cron expression, see https://pypi.org/project/crontab/)')
+	parser_schedule.add_argument('--check',dest='checkcron',action=ParseCronExpressions,
+		help='Time to check the repository (cron expression, see https://pypi.org/project/crontab/)')
+	parser_schedule.add_argument('--overlap',action=ParseOverlapPolicies,
+		help='What to do if a job is due while another one is running: skip (default), queue or coalesce. '
+			'"<policy>" applies to all lanes, "<lane>=<policy>" to %s only'%(
+			'%s or %s'%(', '.join(SCHEDULE_LANES[:-1]),SCHEDULE_LANES[-1])))
 	parser_schedule.add_argument(
 		"--dump-only", action="store_true", help="Dump target in config without restic."
 	)
+	parser_schedule.add_argument(
+		"--resume", action="store_true", help="Keep the databases/indices that the last failed run with --resume dumped completely."
+	)
 	parser_schedule.add_argument('cronexpression',nargs='+',action=ParseCronExpressions,
 		help='Time to schedule the backup (cron expression, see https://pypi.org/project/crontab/)')
 
 	args=parser.parse_args()
 
-	get_env('RESTIC_REPOSITORY')
-	get_env('RESTIC_PASSWORD')
 	get_env('BACKUP_HOSTNAME')
 	get_env('BACKUP_ROOT')
 	get_prune_timeout()
 
-	if args.cmd=='run':
-		result=run_backup(True, args.dump_only)
-		if not result:
-			notify("Restic Backup Failed", f"Backup Host: {get_env('BACKUP_HOSTNAME')}")
+	# report config errors at startup rather than at the first scheduled run
+	config=load_config()
+	if config is None:
+		quit(1)
+
+	# targets of the config replace the repository of the environment
+	if config.targets is None:
+		get_env('RESTIC_REPOSITORY')
+		get_env('RESTIC_PASSWORD')
+
+	if args.cmd!='schedule':
+		setup_metrics()
+
+	if args.cmd=='schedule':
+		schedule_backup(args.cronexpression, args.prunecron, args.dump_only, args.checkcron, args.overlap, args.resume)
+		return
+
+	if args.cmd=='notify':
+		result=notify("Restic Notification Test", f"This is a test mail sent by backup host: {get_env('BACKUP_HOSTNAME')}")
+		# wait for the delivery to report whether the mail could be sent
+		if not (result and flush_notifications(wait=True)):
 			quit(1)
+		return
+
+	if args.cmd=='run':
+		result=run_backup(True, args.dump_only, resume=args.resume)
+		failure_subject="Restic Backup Failed"
 	elif args.cmd=='rotate':
-		result=clean_old_backups(None)
-		if not result:
-			notify("Restic Clean Failed", f"Backup Host: {get_env('BACKUP_HOSTNAME')}")
-			quit(1)
+		result=clean_old_backups()
+		failure_subject="Restic Clean Failed"
 	elif args.cmd=='prune':
-		result=prune_repository(None)
-		if not result:
-			notify("Restic Prune Failed", f"Backup Host: {get_env('BACKUP_HOSTNAME')}")
-			quit(1)
-	elif args.cmd=='notify':
-		result=notify("Restic Notification Test", f"This is a test mail sent by backup host: {get_env('BACKUP_HOSTNAME')}")
-		if not result:
-			quit(1)
+		result=prune_repository()
+		failure_subject="Restic Prune Failed"
 	else:
-		schedule_backup(args.cronexpression, args.prunecron, args.dump_only)
+		result=check_repository()
+		failure_subject="Restic Check Failed"
+	report_repositories()
+	metrics.write_textfile()
+	if not result:
+		notify(failure_subject, f"Backup Host: {get_env('BACKUP_HOSTNAME')}")
+	# the process exits afterwards, so queued mails are delivered first
+	flush_notifications(wait=True)
+	if not result:
+		quit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+import logging as log
+import os
+import os.path
+import re
+import threading
+import yaml
+import bandwidth
+import control
+import dumpstate
+import metrics
+import resticjson
+import smtp_client
+import throttle
+
+# rotation rules of "restic forget" (config keys below "keep" and KEEP_<TYPE> environment variables)
+KEEP_TYPES=['last','hourly','daily','weekly','monthly','yearly']
+
+# how several targets get the backup: each one runs "restic backup" or the first one does and the others "restic copy"
+REPLICATION_MODES=['parallel','copy']
+
+class ConfigError(Exception):
+	pass
+
+class NameFilter:
+	'''
+	Selects databases/indices by include or exclude regular expressions, which are compiled once.
+	'''
+	def __init__(self,include_patterns=None,exclude_patterns=None):
+		if include_patterns and exclude_patterns:
+			raise ConfigError('Either inclusion or exclusion of databases is allowed, not both!')
+		self.include=self.compile(include_patterns)
+		self.exclude=self.compile(exclude_patterns)
+
+	@staticmethod
+	def compile(patterns):
+		if not patterns:
+			return None
+		if type(patterns) is not list:
+			patterns=[patterns]
+		try:
+			return [re.compile(str(p)) for p in patterns]
+		except re.error as e:
+			raise ConfigError('Invalid regular expression %s: %s'%(e.pattern,e))
+
+	def matches(self,name):
+		if self.include is not None and not any([p.match(name) for p in self.include]):
+			return False
+		if self.exclude is not None and any([p.match(name) for p in self.exclude]):
+			return False
+		return True
+
+	def select(self,names,log_name,kind='database'):
+		'''
+		Returns the names that pass the filter and logs the decision for each of them.
+		'''
+		selected=[]
+		for name in names:
+			if self.include is not None:
+				if any([p.match(name) for p in self.include]):
+					log.info('%s: %s %s is included for this dump.'%(log_name,kind,name))
+				else:
+					log.info('%s: %s %s is not included for this dump.'%(log_name,kind,name))
+					continue
+			if self.exclude is not None:
+				if any([p.match(name) for p in self.exclude]):
+					log.info('%s: %s %s is excluded for this dump.'%(log_name,kind,name))
+					continue
+				else:
+					log.info('%s: %s %s is not excluded for this dump.'%(log_name,kind,name))
+			selected.append(name)
+		return selected
+
+def name_filter(config):
+	'''
+	Returns the NameFilter of the include/exclude options of a dump config.
+	'''
+	return NameFilter(config['include'] if 'include' in config else None,config['exclude'] if 'exclude' in config else None)
+
+def keep_settings(keep):
+	if type(keep) is not dict or not any([keep_type in keep for keep_type in KEEP_TYPES]):
+		raise ConfigError('Keep configuration is invalid. At least one of %s needs to be set.'%', '.join(KEEP_TYPES))
+	return {keep_type: str(keep[keep_type]) for keep_type in KEEP_TYPES if keep_type in keep}
+
+def target_settings(config,keep):
+	'''
+	Parses an entry of "targets". keep is the default retention of targets without their own.
+	'''
+	if type(config) is not dict or 'name' not in config or 'repository' not in config:
+		raise ConfigError('Each target needs a name and a repository: %s'%config)
+	env=config['env'] if 'env' in config else {}
+	if type(env) is not dict:
+		raise ConfigError('env of target %s must be a mapping'%config['name'])
+	return {
+		'name': str(config['name']),
+		'repository': str(config['repository']),
+		'password': str(config['password']) if 'password' in config else None,
+		'password_file': str(config['password-file']) if 'password-file' in config else None,
+		'env': {str(key): str(value) for key,value in env.items()},
+		'keep': keep_settings(config['keep']) if 'keep' in config else keep,
+	}
+
+def as_list(value):
+	if value is None:
+		return []
+	if type(value) is not list:
+		return [value]
+	return value
+
+class BackupConfig:
+	'''
+	The parsed and validated config file. Dump engine sections are parsed by the settings function of each engine
+	into the keyword arguments of its dump function.
+	'''
+	def __init__(self,config,engines):
+		if config is None:
+			config={}
+		if type(config) is not dict:
+			raise ConfigError('Expected a yaml mapping, got: %s'%type(config).__name__)
+		self.raw=config
+
+		self.keep=keep_settings(config['keep']) if 'keep' in config else None
+
+		# repositories to back up to, None for the one of RESTIC_REPOSITORY
+		self.targets=None
+		if 'targets' in config:
+			if type(config['targets']) is not list or not config['targets']:
+				raise ConfigError('targets must be a list of repositories')
+			self.targets=[target_settings(target,self.keep) for target in config['targets']]
+			names=[target['name'] for target in self.targets]
+			if len(set(names))!=len(names):
+				raise ConfigError('Target names must be unique: %s'%', '.join(names))
+		self.replication=config['replication'] if 'replication' in config else 'parallel'
+		if self.replication not in REPLICATION_MODES:
+			raise ConfigError('Invalid replication: %s (allowed: %s)'%(self.replication,', '.join(REPLICATION_MODES)))
+
+		self.tags=[str(tag) for tag in as_list(config['tags'] if 'tags' in config else None)]
+		self.stream_to_restic='stream-to-restic' in config and bool(config['stream-to-restic'])
+		if self.stream_to_restic and self.targets is not None and len(self.targets)>1 and self.replication!='copy':
+			raise ConfigError('stream-to-restic with several targets requires replication: copy')
+		self.cache_dir=config['cache-dir'] if 'cache-dir' in config else None
+		self.exclude_caches='exclude-caches' in config and bool(config['exclude-caches'])
+		self.ignore_inode='ignore-inode' in config and bool(config['ignore-inode'])
+		# report the data each folder of BACKUP_ROOT added to the repository (makes restic report every file)
+		self.report_data_added='report-data-added' in config and bool(config['report-data-added'])
+		self.include_from=as_list(config['include-from'] if 'include-from' in config else None)
+		self.exclude=as_list(config['exclude'] if 'exclude' in config else None)
+		self.smtp=None
+		if 'smtp' in config:
+			self.smtp=smtp_client.smtp_settings(config['smtp'])
+			if self.smtp is None:
+				raise ConfigError('Invalid smtp config')
+
+		self.pre_backup_scripts=as_list(config['pre-backup-scripts'] if 'pre-backup-scripts' in config else None)
+		for script in self.pre_backup_scripts:
+			if type(script) is not dict:
+				raise ConfigError('Expected pre-backup-script to be a dict, got: %s'%type(script).__name__)
+			if 'script' not in script:
+				raise ConfigError("Pre-backup-script does not contain a 'script' property.")
+
+		try:
+			self.dump_parallelism=int(config['dump-parallelism']) if 'dump-parallelism' in config else 1
+			self.progress_interval=int(config['progress-interval']) if 'progress-interval' in config else resticjson.DEFAULT_PROGRESS_INTERVAL
+			# failed databases/indices are dumped again dump_retries times, after dump_retry_delay seconds (doubled for each retry)
+			self.dump_retries=int(config['dump-retries']) if 'dump-retries' in config else 0
+			self.dump_retry_delay=float(config['dump-retry-delay']) if 'dump-retry-delay' in config else 60
+			self.resume_max_age=float(config['resume-max-age']) if 'resume-max-age' in config else dumpstate.DEFAULT_RESUME_MAX_AGE
+		except ValueError:
+			raise ConfigError('dump-parallelism, progress-interval, dump-retries, dump-retry-delay and resume-max-age must be numbers')
+
+		self.metrics=metrics.metrics_settings(config['metrics'] if 'metrics' in config else None)
+		if self.metrics is None:
+			raise ConfigError('Invalid metrics config')
+		self.control=control.control_settings(config['control'] if 'control' in config else None)
+		if self.control is None:
+			raise ConfigError('Invalid control config')
+		# limits of restic by time of day
+		self.bandwidth=None
+		if 'bandwidth' in config:
+			self.bandwidth=bandwidth.bandwidth_settings(config['bandwidth'])
+			if self.bandwidth is None:
+				raise ConfigError('Invalid bandwidth config')
+		self.throttle=None
+		if 'throttle' in config:
+			self.throttle=throttle.throttle_settings(config['throttle'])
+			if self.throttle is None:
+				raise ConfigError('Invalid throttle config')
+			if self.throttle['probe'] is not None and self.throttle['probe']['engine'] not in config:
+				raise ConfigError('The throttle probe needs a %s config'%self.throttle['probe']['engine'])
+
+		# (name,settings) of the configured dump engines in order of execution
+		self.engines=[]
+		for name,settings_function in engines:
+			if name not in config:
+				continue
+			if type(config[name]) is not dict:
+				raise ConfigError('Invalid %s config: %s'%(name,config[name]))
+			settings=settings_function(config[name])
+			if settings is None:
+				raise ConfigError('Invalid %s config'%name)
+			self.engines.append((name,settings))
+
+_cache={}
+_cache_lock=threading.Lock()
+
+def load_config(config_file,engines):
+	'''
+	Loads and validates the config file. The result is cached until the modification time or size of the file changes.
+	Raises ConfigError if the file cannot be read or is invalid.
+	'''
+	if config_file is None:
+		return BackupConfig({},engines)
+	try:
+		stat=os.stat(config_file)
+	except OSError:
+		raise ConfigError('Config does not exist: %s'%config_file)
+	key=(stat.st_mtime_ns,stat.st_size)
+	with _cache_lock:
+		if config_file in _cache and _cache[config_file][0]==key:
+			return _cache[config_file][1]
+	log.info('Using extra config from %s'%config_file)
+	try:
+		with open(config_file,'r') as f:
+			raw=yaml.safe_load(f)
+	except (OSError,yaml.YAMLError) as e:
+		raise ConfigError('Unable to read config file %s: %s'%(config_file,e))
+	config=BackupConfig(raw,engines)
+	with _cache_lock:
+		_cache[config_file]=(key,config)
+	return config
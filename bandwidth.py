@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import logging as log
+import re
+from datetime import datetime,timedelta
+import throttle
+
+DAYS=['mon','tue','wed','thu','fri','sat','sun']
+
+def parse_time(value):
+	'''
+	Parses a time of day (HH:MM or HH:MM:SS) into seconds since midnight. Raises ValueError if it is invalid.
+	'''
+	if type(value) is not str:
+		# yaml reads unquoted times like 8:00 as numbers
+		raise ValueError('Invalid time %s, times must be quoted (e.g. "08:00")'%value)
+	match=re.match(r'^\s*(\d{1,2}):(\d{2})(?::(\d{2}))?\s*$',value)
+	if match is None or int(match.group(2))>59 or int(match.group(3) or 0)>59:
+		raise ValueError('Invalid time: %s'%value)
+	seconds=int(match.group(1))*3600+int(match.group(2))*60+int(match.group(3) or 0)
+	if seconds>24*3600:
+		raise ValueError('Invalid time: %s'%value)
+	return seconds
+
+def parse_days(value):
+	'''
+	Parses a list of weekdays (mon ... sun, ranges like mon-fri) into weekday numbers. Raises ValueError if it is invalid.
+	'''
+	if type(value) is not list:
+		value=str(value).split(',')
+	days=set()
+	for item in value:
+		first,_,last=str(item).strip().lower().partition('-')
+		if first not in DAYS or (last and last not in DAYS):
+			raise ValueError('Invalid day: %s (allowed: %s)'%(item,', '.join(DAYS)))
+		first=DAYS.index(first)
+		last=DAYS.index(last) if last else first
+		# ranges may wrap around the end of the week (e.g. sat-mon)
+		days.update([day%7 for day in range(first,(last if last>=first else last+7)+1)])
+	return days
+
+def parse_limit(value):
+	'''
+	Parses a bandwidth (bytes per second with optional K, M or G suffix) into the KiB/s restic expects. 0 is unlimited (None).
+	'''
+	if value is None:
+		return None
+	limit=throttle.parse_bytes(value)
+	if limit==0:
+		return None
+	return max(1,limit//1024)
+
+def bandwidth_settings(config):
+	'''
+	Parses the "bandwidth" section of the config. Returns None if the config is invalid.
+	upload and download are the limits outside the windows of schedule, each window may override them.
+	'''
+	if type(config) is not dict:
+		log.error('Invalid bandwidth config: %s'%config)
+		return None
+	schedule=config['schedule'] if 'schedule' in config else []
+	if type(schedule) is not list:
+		log.error('Invalid bandwidth config: schedule must be a list of windows')
+		return None
+	try:
+		settings={
+			'upload': parse_limit(config['upload'] if 'upload' in config else None),
+			'download': parse_limit(config['download'] if 'download' in config else None),
+			'restart-backup': bool(config['restart-backup']) if 'restart-backup' in config else True,
+			'schedule': [],
+		}
+		for index,window in enumerate(schedule):
+			if type(window) is not dict or 'from' not in window or 'to' not in window:
+				raise ValueError('each window needs from and to: %s'%window)
+			settings['schedule'].append({
+				'name': str(window['name']) if 'name' in window else 'window %s'%(index+1),
+				'days': parse_days(window['days']) if 'days' in window else set(range(7)),
+				'from': parse_time(window['from']),
+				'to': parse_time(window['to']),
+				'upload': parse_limit(window['upload']) if 'upload' in window else settings['upload'],
+				'download': parse_limit(window['download']) if 'download' in window else settings['download'],
+			})
+	except ValueError as e:
+		log.error('Invalid bandwidth config: %s'%e)
+		return None
+	return settings
+
+def in_window(window,now):
+	'''
+	Returns True if the window covers the time now. Windows whose end is not after their start end on the next day.
+	'''
+	seconds=now.hour*3600+now.minute*60+now.second
+	if window['from']<window['to']:
+		return now.weekday() in window['days'] and window['from']<=seconds<window['to']
+	return (now.weekday() in window['days'] and seconds>=window['from']) or \
+		((now.weekday()-1)%7 in window['days'] and seconds<window['to'])
+
+def limits_at(settings,now=None):
+	'''
+	Returns (upload,download,window name) in KiB/s (None if unlimited) at the time now. The first matching window applies,
+	outside of all windows the window name is None.
+	'''
+	now=now or datetime.now()
+	for window in settings['schedule']:
+		if in_window(window,now):
+			return (window['upload'],window['download'],window['name'])
+	return (settings['upload'],settings['download'],None)
+
+def next_change(settings,now=None):
+	'''
+	Returns the time at which the limits next change after now, or None if they never change.
+	'''
+	now=now or datetime.now()
+	current=limits_at(settings,now)[:2]
+	midnight=now.replace(hour=0,minute=0,second=0,microsecond=0)
+	boundaries=set()
+	for day in range(9):
+		for window in settings['schedule']:
+			for seconds in (window['from'],window['to']):
+				boundary=midnight+timedelta(days=day,seconds=seconds)
+				if boundary>now:
+					boundaries.add(boundary)
+	for boundary in sorted(boundaries):
+		if limits_at(settings,boundary)[:2]!=current:
+			return boundary
+	return None
+
+def format_limits(limits):
+	upload,download=limits[:2]
+	return 'upload %s, download %s'%(
+		'unlimited' if upload is None else '%s/s'%throttle.format_rate(upload*1024),
+		'unlimited' if download is None else '%s/s'%throttle.format_rate(download*1024))
+
+def restic_args(settings,command,now=None):
+	'''
+	Returns the --limit-upload/--limit-download arguments of a restic command starting now (empty if settings is None
+	or nothing is limited) and logs them.
+	'''
+	if settings is None:
+		return []
+	limits=limits_at(settings,now)
+	upload,download,name=limits
+	args=[]
+	if upload is not None:
+		args+=['--limit-upload',str(upload)]
+	if download is not None:
+		args+=['--limit-download',str(download)]
+	if args:
+		log.info('Bandwidth: restic %s limited to %s (%s)'%(command,format_limits(limits),name or 'default'))
+	return args
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import json
+import logging as log
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import metrics
+import resticjson
+
+# commands of the control API and the scheduler lanes they trigger
+COMMANDS={
+	'run': 'backup',
+	'rotate': 'rotate',
+	'prune': 'prune',
+	'check': 'check',
+}
+
+def control_settings(config):
+	'''
+	Parses the "control" section of the config. Returns None if the config is invalid.
+	listen is either a unix socket path or [<address>:]<port> (address defaults to 127.0.0.1).
+	'''
+	if config is None:
+		config={}
+	if type(config) is not dict:
+		log.error('Invalid control config: %s'%config)
+		return None
+	listen=None
+	if 'listen' in config:
+		listen=str(config['listen'])
+		if '/' not in listen:
+			host,_,port=listen.rpartition(':')
+			try:
+				listen=(host or '127.0.0.1',int(port))
+			except ValueError:
+				log.error('Invalid control config: listen must be a socket path or [<address>:]<port>')
+				return None
+	return {
+		'listen': listen,
+	}
+
+class ControlHandler(BaseHTTPRequestHandler):
+	'''
+	GET /status returns the state of the scheduler, the running phases and the progress of a running restic backup.
+	POST /run, /rotate, /prune and /check start a job (202, or 409 if the overlap policy skips it),
+	POST /cancel stops the running job (409 if no job is running).
+	'''
+	def log_message(self,format,*args):
+		pass
+
+	def address_string(self):
+		# unix sockets have no client address
+		return str(self.client_address[0]) if self.client_address else 'local'
+
+	def reply(self,code,data):
+		body=(json.dumps(data,indent=1)+'\n').encode()
+		self.send_response(code)
+		self.send_header('Content-Type','application/json')
+		self.send_header('Content-Length',str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def action(self):
+		return self.path.split('?')[0].strip('/')
+
+	def do_GET(self):
+		if self.action()!='status':
+			self.reply(404,{'error': 'Not found'})
+			return
+		status=self.server.scheduler.status()
+		status['time']=time.time()
+		status['phases']=metrics.active_phases()
+		status['backup_progress']=resticjson.current_progress() or None
+		self.reply(200,status)
+
+	def do_POST(self):
+		action=self.action()
+		if action=='cancel':
+			lane=self.server.scheduler.cancel()
+			if lane is None:
+				self.reply(409,{'error': 'No job is running'})
+			else:
+				self.reply(200,{'cancelled': lane})
+			return
+		if action not in COMMANDS:
+			self.reply(404,{'error': 'Not found'})
+			return
+		log.info('Control API: %s requested'%action)
+		if self.server.scheduler.trigger(COMMANDS[action]):
+			self.reply(202,{'started': COMMANDS[action]})
+		else:
+			self.reply(409,{'error': 'Skipped, another job is running'})
+
+class ControlServer(ThreadingHTTPServer):
+	def __init__(self,listen,scheduler):
+		self.scheduler=scheduler
+		super().__init__(listen,ControlHandler)
+
+class UnixControlServer(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+	daemon_threads=True
+
+	def __init__(self,path,scheduler):
+		self.scheduler=scheduler
+		if os.path.exists(path):
+			# left over from a previous run
+			os.unlink(path)
+		super().__init__(path,ControlHandler)
+		os.chmod(path,0o600)
+
+def serve(listen,scheduler):
+	'''
+	Serves the control API of scheduler from a background thread, on a unix socket (listen is a path) or via HTTP.
+	'''
+	if type(listen) is str:
+		server=UnixControlServer(listen,scheduler)
+		log.info('Serving control API on %s'%listen)
+	else:
+		server=ControlServer(listen,scheduler)
+		log.info('Serving control API on http://%s:%s/'%listen)
+	threading.Thread(target=server.serve_forever,name='control',daemon=True).start()
+	return server
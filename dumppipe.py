@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import logging as log
+import os.path
+import shlex
+import subprocess
+import threading
+import bandwidth
+import throttle
+import workerpool
+
+# file extension of each supported compression codec
+COMPRESSION_CODECS={
+	'gzip': '.gz',
+	'pigz': '.gz',
+	'zstd': '.zst',
+	'none': '',
+}
+
+# levels each codec accepts (zstd above 19 runs with --ultra)
+COMPRESSION_LEVELS={
+	'gzip': (1,9),
+	'pigz': (1,9),
+	'zstd': (1,22),
+}
+
+DEFAULT_COMPRESSION={
+	'codec': 'gzip',
+	'level': 9,
+	'threads': None,
+}
+
+NO_COMPRESSION={
+	'codec': 'none',
+	'level': 0,
+	'threads': None,
+}
+
+def compression_settings(config):
+	'''
+	Parses the "compression" section of a dump config. Returns None if the config is invalid.
+	'''
+	if config is None:
+		return DEFAULT_COMPRESSION
+	if type(config) is str:
+		config={'codec': config}
+	if type(config) is not dict:
+		log.error('Invalid compression config: %s'%config)
+		return None
+	codec=config['codec'] if 'codec' in config else DEFAULT_COMPRESSION['codec']
+	if codec not in COMPRESSION_CODECS:
+		log.error('Invalid compression codec: %s (allowed: %s)'%(codec,', '.join(COMPRESSION_CODECS)))
+		return None
+	try:
+		if 'level' in config:
+			level=int(config['level'])
+		else:
+			level=3 if codec=='zstd' else DEFAULT_COMPRESSION['level']
+		threads=int(config['threads']) if 'threads' in config else None
+	except ValueError:
+		log.error('Invalid compression config: level and threads must be numbers')
+		return None
+	if codec in COMPRESSION_LEVELS and not COMPRESSION_LEVELS[codec][0]<=level<=COMPRESSION_LEVELS[codec][1]:
+		log.error('Invalid compression level for %s: %s (allowed: %s-%s)'%(codec,level,*COMPRESSION_LEVELS[codec]))
+		return None
+	if threads is not None and threads<1:
+		log.error('Invalid compression config: threads must be at least 1')
+		return None
+	return {
+		'codec': codec,
+		'level': level,
+		'threads': threads,
+	}
+
+def compress_command(compression):
+	'''
+	Returns the shell command that compresses stdin to stdout, or None if no compression should be done.
+	'''
+	codec=compression['codec']
+	level=compression['level']
+	threads=compression['threads']
+	if codec=='gzip':
+		return 'nice -n 19 gzip -%s --rsyncable'%level
+	if codec=='pigz':
+		return 'nice -n 19 pigz -%s --rsyncable%s'%(level,'' if threads is None else ' -p %s'%threads)
+	if codec=='zstd':
+		return 'nice -n 19 zstd -q -%s%s --rsyncable -T%s'%(level,' --ultra' if level>19 else '',0 if threads is None else threads)
+	return None
+
+def restic_stream_settings(host,tags,cache_dir=None,repository=None,password_file=None,bandwidth=None):
+	'''
+	Settings to stream dumps into restic instead of writing them to BACKUP_ROOT.
+	Each dump stream becomes a separate snapshot with the same host and tags as the file backup.
+	Without repository, restic uses RESTIC_REPOSITORY and RESTIC_PASSWORD of the environment.
+	bandwidth is the schedule of the limits of restic (see bandwidth.bandwidth_settings).
+	'''
+	return {
+		'host': host,
+		'tags': tags,
+		'cache-dir': cache_dir,
+		'repository': repository,
+		'password-file': password_file,
+		'bandwidth': bandwidth,
+	}
+
+def restic_stdin_command(stream_path,stream):
+	cmd=[
+		'restic',
+		'backup',
+		'--stdin',
+		'--stdin-filename',stream_path,
+		'--host',stream['host'],
+	]
+	for tag in stream['tags']:
+		cmd+=['--tag',tag]
+	if stream['cache-dir'] is not None:
+		cmd+=['--cache-dir',stream['cache-dir']]
+	if stream['repository'] is not None:
+		cmd+=['--repo',stream['repository']]
+	if stream['password-file'] is not None:
+		cmd+=['--password-file',stream['password-file']]
+	# the limits at the start of each dump
+	cmd+=bandwidth.restic_args(stream['bandwidth'],'backup of %s'%stream_path)
+	return cmd
+
+def output_filename(filename,compression=DEFAULT_COMPRESSION):
+	return filename+COMPRESSION_CODECS[compression['codec']]
+
+def output_pipe(target_dir,filename,stream=None,compression=DEFAULT_COMPRESSION):
+	'''
+	Returns the shell fragment that consumes a dump written to stdout.
+	Without stream settings the dump is compressed to <target_dir>/<filename><codec extension>, otherwise it is piped
+	uncompressed into "restic backup --stdin" as <dump dir name>/<filename> and restic takes care of compression.
+	While dumps are throttled, the dump passes the throttling stage first.
+	'''
+	limit=throttle.pipe_command()
+	limit='' if limit is None else ' | %s'%limit
+	if stream is None:
+		target=shlex.quote(os.path.join(target_dir,output_filename(filename,compression)))
+		compress=compress_command(compression)
+		if compress is None:
+			return '%s > %s '%(limit,target)
+		return '%s | %s > %s '%(limit,compress,target)
+	stream_path='%s/%s'%(os.path.basename(os.path.normpath(target_dir)),filename)
+	return '%s | nice -n 19 ionice -c3 %s '%(limit,' '.join([shlex.quote(arg) for arg in restic_stdin_command(stream_path,stream)]))
+
+class OutputWriter:
+	'''
+	Binary file-like object to write a dump from python to the same destination that output_pipe connects shell pipelines to.
+	close() raises subprocess.CalledProcessError if the consumer (compressor or restic) failed.
+	'''
+	def __init__(self,target_dir,filename,stream=None,compression=DEFAULT_COMPRESSION):
+		self.proc=None
+		self.file=None
+		if stream is None and compression['codec']=='none' and throttle.pipe_command() is None:
+			self.file=open(os.path.join(target_dir,output_filename(filename,compression)),'wb')
+			return
+		self.cmd='cat%s'%output_pipe(target_dir,filename,stream,compression)
+		self.proc=subprocess.Popen('set -o pipefail; %s'%self.cmd,shell=True,executable='/bin/bash',
+			stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,start_new_session=True)
+		self.file=self.proc.stdin
+		self.reader=threading.Thread(target=workerpool.log_output,args=(self.proc.stdout,workerpool.get_log_prefix()),daemon=True)
+		self.reader.start()
+
+	def write(self,data):
+		self.file.write(data)
+
+	def close(self):
+		self.file.close()
+		if self.proc is None:
+			return
+		self.proc.wait()
+		self.reader.join(timeout=5)
+		if self.proc.returncode!=0:
+			raise subprocess.CalledProcessError(self.proc.returncode,self.cmd)
+
+	def abort(self):
+		if self.proc is not None:
+			workerpool.kill_process_group(self.proc)
+		try:
+			self.file.close()
+		except OSError:
+			pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,exc_type,exc_value,traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()
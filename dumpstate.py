@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+import logging as log
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime,timedelta
+import workerpool
+
+# name of the state file kept in dump directories of engines that skip unchanged databases/indices
+STATE_FILE='.dumpstate.json'
+# name of the manifest of the databases/indices an unfinished run has dumped completely
+CHECKPOINT_FILE='.checkpoint.json'
+# hours after which the checkpoint of an unfinished run is not resumed anymore
+DEFAULT_RESUME_MAX_AGE=24
+
+def load_state(target_dir,filename=STATE_FILE):
+	state_file=os.path.join(target_dir,filename)
+	if not os.path.exists(state_file):
+		return {}
+	try:
+		with open(state_file,'r') as f:
+			state=json.load(f)
+		if type(state) is not dict:
+			raise ValueError('Expected a json object')
+		return state
+	except (OSError,ValueError) as e:
+		log.warning('Ignoring invalid dump state %s: %s'%(state_file,e))
+		return {}
+
+def save_state(target_dir,state,filename=STATE_FILE):
+	'''
+	Writes the state atomically, so an interrupted run never leaves a truncated state file.
+	'''
+	fd,tmp_file=tempfile.mkstemp(dir=target_dir,prefix=filename)
+	try:
+		with os.fdopen(fd,'w') as f:
+			json.dump(state,f,indent=1,sort_keys=True)
+		os.replace(tmp_file,os.path.join(target_dir,filename))
+	except BaseException:
+		os.unlink(tmp_file)
+		raise
+
+def skip_unchanged_settings(config,methods):
+	'''
+	Parses the "skip-unchanged" option of a dump config. The first of methods is the default.
+	Returns None if unchanged databases should be dumped anyway and False if the config is invalid.
+	'''
+	if config is None or config is False:
+		return None
+	if config is True:
+		config={}
+	if type(config) is not dict:
+		log.error('Invalid skip-unchanged config: %s'%config)
+		return False
+	method=config['method'] if 'method' in config else methods[0]
+	if method not in methods:
+		log.error('Invalid skip-unchanged method: %s (allowed: %s)'%(method,', '.join(methods)))
+		return False
+	try:
+		force_full_days=int(config['force-full-days']) if 'force-full-days' in config else 7
+	except ValueError:
+		log.error('Invalid skip-unchanged config: force-full-days must be a number')
+		return False
+	return {
+		'method': method,
+		'force-full-days': force_full_days,
+	}
+
+def is_unchanged(state,name,fingerprint,force_full_days):
+	'''
+	Checks whether the dump of name from the previous run can be kept. A fingerprint of None means that
+	changes cannot be detected.
+	'''
+	if fingerprint is None or name not in state:
+		return False
+	previous=state[name]
+	if previous.get('fingerprint')!=fingerprint:
+		return False
+	try:
+		dumped=datetime.fromisoformat(previous['dumped'])
+	except (KeyError,TypeError,ValueError):
+		return False
+	return datetime.now()-dumped<timedelta(days=force_full_days)
+
+def remove_stale_files(target_dir,keep_files):
+	'''
+	Removes everything from a kept dump directory that does not belong to the current dump.
+	'''
+	for filename in os.listdir(target_dir):
+		if filename in (STATE_FILE,CHECKPOINT_FILE) or filename in keep_files:
+			continue
+		path=os.path.join(target_dir,filename)
+		log.info('Removing stale dump %s'%path)
+		if os.path.isdir(path) and not os.path.islink(path):
+			shutil.rmtree(path)
+		else:
+			os.unlink(path)
+
+def file_digest(path):
+	digest=hashlib.sha256()
+	with open(path,'rb') as f:
+		for block in iter(lambda: f.read(1024*1024),b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+def describe_files(target_dir,paths):
+	'''
+	Returns size and sha256 of the files below paths (files or directories), keyed by their path relative to target_dir.
+	Missing paths are left out.
+	'''
+	files={}
+	for path in paths:
+		if os.path.isdir(path):
+			for root,dirs,filenames in os.walk(path):
+				dirs.sort()
+				for filename in sorted(filenames):
+					if not filename.startswith((STATE_FILE,CHECKPOINT_FILE)):
+						files.update(describe_files(target_dir,[os.path.join(root,filename)]))
+		elif os.path.exists(path):
+			files[os.path.relpath(path,target_dir)]={
+				'size': os.path.getsize(path),
+				'sha256': file_digest(path),
+			}
+	return files
+
+class Checkpoint:
+	'''
+	Records the databases/indices (units) of a dump directory that were dumped completely, with size and sha256 of their files,
+	in CHECKPOINT_FILE. A resumed run keeps the units whose files did not change and dumps only the failed and missing ones.
+	A failed unit is dumped again up to retries times, after retry_delay seconds (doubled for each further retry).
+	Without target_dir (dumps streamed to restic, runs without --resume) nothing is recorded, only the retries apply.
+	'''
+	def __init__(self,name,target_dir=None,retries=0,retry_delay=60,units=None,started=None):
+		self.name=name
+		self.target_dir=target_dir
+		self.retries=retries
+		self.retry_delay=retry_delay
+		self.units=units or {}
+		self.started=started or datetime.now().isoformat(timespec='seconds')
+		self.lock=threading.Lock()
+
+	def save(self):
+		save_state(self.target_dir,{'started': self.started,'units': self.units},CHECKPOINT_FILE)
+
+	def completed(self,unit,files):
+		with self.lock:
+			recorded=self.units.get(unit)
+		return recorded is not None and recorded.get('files')==describe_files(self.target_dir,files)
+
+	def record(self,unit,files):
+		description=describe_files(self.target_dir,files)
+		with self.lock:
+			self.units[unit]={
+				'files': description,
+				'completed': datetime.now().isoformat(timespec='seconds'),
+			}
+			self.save()
+
+	def discard(self,unit):
+		with self.lock:
+			if self.units.pop(unit,None) is not None:
+				self.save()
+
+	def job(self,unit,job,files=None):
+		'''
+		Wraps a job of workerpool.run_parallel that dumps unit to files.
+		'''
+		recording=self.target_dir is not None and bool(files)
+		def run(cancel):
+			if recording and unit in self.units:
+				if self.completed(unit,files):
+					log.info('%s: %s was dumped completely by the interrupted run, keeping it'%(self.name,unit))
+					return True
+				log.info('%s: dump of %s changed since the interrupted run, dumping it again'%(self.name,unit))
+				self.discard(unit)
+			attempt=0
+			while not job(cancel):
+				if attempt>=self.retries or (cancel is not None and cancel.is_set()):
+					return False
+				delay=self.retry_delay*2**attempt
+				attempt+=1
+				log.warning('%s: dump of %s failed, retrying in %ss (%s/%s)'%(self.name,unit,delay,attempt,self.retries))
+				if cancel is None:
+					time.sleep(delay)
+				elif cancel.wait(delay):
+					raise workerpool.Cancelled()
+			if recording:
+				self.record(unit,files)
+			return True
+		return run
+
+def checkpointed(checkpoint,unit,job,files=None):
+	'''
+	Wraps a dump job with checkpoint.job() if there is a checkpoint.
+	'''
+	return job if checkpoint is None else checkpoint.job(unit,job,files)
+
+def load_checkpoint(name,target_dir,max_age=DEFAULT_RESUME_MAX_AGE,retries=0,retry_delay=60):
+	'''
+	Returns the Checkpoint of the unfinished run in target_dir or None if there is none or it is older than max_age hours.
+	'''
+	if not os.path.exists(os.path.join(target_dir,CHECKPOINT_FILE)):
+		return None
+	manifest=load_state(target_dir,CHECKPOINT_FILE)
+	try:
+		started=datetime.fromisoformat(manifest['started'])
+		if type(manifest['units']) is not dict:
+			raise TypeError('units must be an object')
+	except (KeyError,TypeError,ValueError) as e:
+		log.warning('%s: ignoring invalid checkpoint: %s'%(name,e))
+		return None
+	if datetime.now()-started>timedelta(hours=max_age):
+		log.info('%s: checkpoint of the run started at %s is older than %s hours, dumping everything'%(name,manifest['started'],max_age))
+		return None
+	log.info('%s: resuming the run started at %s (%s completed)'%(name,manifest['started'],len(manifest['units'])))
+	return Checkpoint(name,target_dir,retries,retry_delay,manifest['units'],manifest['started'])
+
+def remove_checkpoint(target_dir):
+	try:
+		os.unlink(os.path.join(target_dir,CHECKPOINT_FILE))
+	except FileNotFoundError:
+		pass
+
+def same_content(path,other):
+	'''
+	Compares two files by size and a streaming sha256 of their content.
+	'''
+	return os.path.getsize(path)==os.path.getsize(other) and file_digest(path)==file_digest(other)
+
+def merge_dump_dir(new_dir,target_dir,name):
+	'''
+	Moves the dump written to new_dir into target_dir and removes new_dir. Files whose content did not change are not
+	replaced, so they keep their mtime and restic does not read them again. Changed files are replaced atomically,
+	files that are not part of the new dump are removed.
+	'''
+	new_files=set()
+	new_dirs=set()
+	unchanged=0
+	for root,dirs,filenames in os.walk(new_dir):
+		rel_root=os.path.relpath(root,new_dir)
+		for dirname in dirs:
+			new_dirs.add(os.path.normpath(os.path.join(rel_root,dirname)))
+		for filename in filenames:
+			if filename.startswith(CHECKPOINT_FILE):
+				continue
+			rel_path=os.path.normpath(os.path.join(rel_root,filename))
+			new_files.add(rel_path)
+			source=os.path.join(new_dir,rel_path)
+			target=os.path.join(target_dir,rel_path)
+			if os.path.isdir(target) and not os.path.islink(target):
+				shutil.rmtree(target)
+			if os.path.isfile(target) and same_content(source,target):
+				unchanged+=1
+				continue
+			os.makedirs(os.path.dirname(target),exist_ok=True)
+			os.replace(source,target)
+	for root,dirs,filenames in os.walk(target_dir,topdown=False):
+		rel_root=os.path.relpath(root,target_dir)
+		for filename in filenames:
+			rel_path=os.path.normpath(os.path.join(rel_root,filename))
+			if rel_path not in new_files:
+				os.unlink(os.path.join(target_dir,rel_path))
+		for dirname in dirs:
+			rel_path=os.path.normpath(os.path.join(rel_root,dirname))
+			if rel_path not in new_dirs and not os.listdir(os.path.join(target_dir,rel_path)):
+				os.rmdir(os.path.join(target_dir,rel_path))
+	for rel_path in new_dirs:
+		os.makedirs(os.path.join(target_dir,rel_path),exist_ok=True)
+	shutil.rmtree(new_dir)
+	log.info('%s: %s of %s dump files changed, kept the others'%(name,len(new_files)-unchanged,len(new_files)))
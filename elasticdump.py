@@ -2,17 +2,45 @@
 
 import logging as log
 import requests
+import requests.adapters
+import json
+import functools
 import os.path
+import shutil
 import subprocess
+import tempfile
 import urllib
-import re
+import workerpool
+import dumppipe
+import shlex
+import dumpstate
+import backupconfig
+import metrics
+from datetime import datetime
 
-def es_list_indices(url,username,password):
+# keep alive of point in time / scroll contexts between two pages of the native exporter
+SEARCH_KEEP_ALIVE='5m'
+# first elasticsearch version with the _shard_doc sort of point in time searches (before, the native exporter scrolls)
+PIT_MIN_VERSION=(7,12)
+
+def es_session(username,password,pool_size=1):
+	'''
+	A session with a connection pool large enough for all slices of the native exporter.
+	'''
+	session=requests.Session()
+	if username is not None and password is not None:
+		session.auth=(username,password)
+	adapter=requests.adapters.HTTPAdapter(pool_connections=1,pool_maxsize=max(1,pool_size))
+	session.mount('http://',adapter)
+	session.mount('https://',adapter)
+	return session
+
+def es_list_indices(url,username,password,session=None):
 	if username is not None and password is not None:
 		auth=(username,password)
 	else:
 		auth=None
-	response=requests.get('%s/_cat/indices?v&format=json'%url,auth=auth)
+	response=(session or requests).get('%s/_cat/indices?v&format=json'%url,auth=auth)
 	if (response.status_code != 200):
 		log.error("Unable to list elasticsearch indices: %s"%response.text)
 		return None
@@ -21,65 +49,277 @@ def es_list_indices(url,username,password):
 		result.append(indexData['index'])
 	return result
 
-def es_dump_with_config(target_dir,config):
+def es_version(session,url):
+	'''
+	Returns major and minor version of elasticsearch, or None if it cannot be read.
+	'''
+	try:
+		response=session.get('%s/'%url)
+		if response.status_code!=200:
+			return None
+		return tuple([int(part) for part in response.json()['version']['number'].split('-')[0].split('.')[:2]])
+	except (requests.RequestException,ValueError,KeyError,TypeError):
+		return None
+
+def es_index_stats(url,username,password,session=None):
+	'''
+	Returns primary doc count, primary store size and the max sequence number of each primary shard per index.
+	These only change if documents of the index were written (or segments were merged).
+	'''
+	if username is not None and password is not None:
+		auth=(username,password)
+	else:
+		auth=None
+	response=(session or requests).get('%s/_stats/docs,store?level=shards'%url,auth=auth)
+	if (response.status_code != 200):
+		log.warning("Unable to get elasticsearch index stats: %s"%response.text)
+		return {}
+	result={}
+	for index,indexStats in response.json()['indices'].items():
+		max_seq_no={}
+		for shard,copies in indexStats.get('shards',{}).items():
+			for copy in copies:
+				if copy.get('routing',{}).get('primary'):
+					max_seq_no[shard]=copy.get('seq_no',{}).get('max_seq_no')
+		result[index]={
+			'docs.count': indexStats['primaries']['docs']['count'],
+			'store.size': indexStats['primaries']['store']['size_in_bytes'],
+			'max_seq_no': max_seq_no,
+		}
+	return result
+
+def es_dump_settings(config):
+	'''
+	Parses the elasticdump section of the config into the arguments of es_dump. Returns None if the config is invalid.
+	'''
 	if 'url' not in config:
 		log.error('Missing elasticdump config: url')
-	url=config['url']
-	username=config['username'] if 'username' in config else None
-	password=config['password'] if 'password' in config else None
-	include_patterns=config['include'] if 'include' in config else None
-	exclude_patterns=config['exclude'] if 'exclude' in config else None
-	return es_dump(target_dir,url,username,password,include_patterns,exclude_patterns)
-
-def es_dump(target_dir,url,username,password,include_patterns,exclude_patterns):
-	if include_patterns and exclude_patterns:
-		log.error("Either inclusion or exclusion of indices is allowed, not both!")
-	indices=es_list_indices(url,username,password)
+		return None
+	skip_unchanged=dumpstate.skip_unchanged_settings(config['skip-unchanged'] if 'skip-unchanged' in config else None,['stats'])
+	if skip_unchanged is False:
+		return None
+	exporter=config['exporter'] if 'exporter' in config else 'elasticdump'
+	if exporter not in ('elasticdump','native'):
+		log.error('Invalid elasticdump exporter: %s (allowed: elasticdump, native)'%exporter)
+		return None
+	try:
+		slices=int(config['slices']) if 'slices' in config else 2
+		batch_size=int(config['batch-size']) if 'batch-size' in config else 1000
+	except ValueError:
+		log.error('Invalid elasticdump config: slices and batch-size must be numbers')
+		return None
+	return {
+		'url': config['url'],
+		'username': config['username'] if 'username' in config else None,
+		'password': config['password'] if 'password' in config else None,
+		'name_filter': backupconfig.name_filter(config),
+		'skip_unchanged': skip_unchanged,
+		'exporter': exporter,
+		'slices': slices,
+		'batch_size': batch_size,
+	}
+
+def es_dump_with_config(target_dir,settings,cancel=None,stream=None,checkpoint=None):
+	return es_dump(target_dir,cancel=cancel,stream=stream,checkpoint=checkpoint,**settings)
+
+def es_dump(target_dir,url,username,password,name_filter,cancel=None,stream=None,skip_unchanged=None,exporter='elasticdump',slices=2,batch_size=1000,checkpoint=None):
+	url=url.rstrip('/')
+	session=es_session(username,password,slices)
+	indices=es_list_indices(url,username,password,session)
 	if indices is None:
 		return False
-	if username is not None and password is not None:
+	selected=name_filter.select(indices,'Elasticsearch','index')
+
+	if skip_unchanged is not None and stream is not None:
+		log.warning('Elasticsearch: skip-unchanged is not supported with stream-to-restic. Dumping all indices.')
+		skip_unchanged=None
+	if skip_unchanged is not None:
+		previous_state=dumpstate.load_state(target_dir)
+		index_stats=es_index_stats(url,username,password,session)
+		# indices kept by a checkpoint keep their state
+		state={index: previous_state[index] for index in selected if index in previous_state}
+		dumped_files=[]
+
+	use_pit=True
+	if exporter=='native':
+		version=es_version(session,url)
+		if version is not None and version<PIT_MIN_VERSION:
+			log.info('Elasticsearch: version %s has no _shard_doc sort for point in time searches, using scroll'%'.'.join(map(str,version)))
+			use_pit=False
+
+	if exporter=='elasticdump' and username is not None and password is not None:
 		urlparts=urllib.parse.urlparse(url)
 		url=urlparts._replace(netloc='%s:%s@%s'%(
 			username,
 			urllib.parse.quote(password),
 			urlparts.netloc)).geturl()
 
-	for index in indices:
-		if include_patterns:
-			included=False
-			for p in include_patterns:
-				if (re.compile(p).match(index)):
-					included=True
-					break
-			if included:
-				log.info('Elasticsearch: index %s is included for this dump.'%index)
-			else:
-				log.info('Elasticsearch: index %s is not included for this dump.'%index)
-				continue
-		if exclude_patterns:
-			excluded=False
-			for p in exclude_patterns:
-				if (re.compile(p).match(index)):
-					excluded=True
-					break
-			if excluded:
-				log.info('Elasticsearch: index %s is excluded for this dump.'%index)
-				continue
+	def dump_index(index,cancel):
+		datatypes=['alias','mapping','data']
+		if skip_unchanged is not None:
+			fingerprint=index_stats[index] if index in index_stats else None
+			data_file=os.path.join(target_dir,'%s__data.json'%index)
+			if os.path.exists(data_file) and dumpstate.is_unchanged(previous_state,index,fingerprint,skip_unchanged['force-full-days']):
+				log.info('Elasticsearch: %s is unchanged since %s, keeping previous data dump'%(index,previous_state[index]['dumped']))
+				datatypes=['alias','mapping']
 			else:
-				log.info('Elasticsearch: index %s is not excluded for this dump.'%index)
+				state.pop(index,None)
+			dumped=datetime.now().isoformat(timespec='seconds')
 		try:
-			for datatype in ['alias','mapping','data']:
+			for datatype in datatypes:
 				log.info('Elasticsearch: Dumping %s for %s'%(datatype,index))
-				subprocess.run([
-					'elasticdump',
-					'--input','%s/%s'%(url,index),
-					'--type',datatype,
-					'--output',os.path.join(target_dir,'%s__%s.json'%(index,datatype))
-				], check=True)
-		except subprocess.CalledProcessError:
-			log.error('Elasticsearch dump failed.')
+				if exporter=='native':
+					es_export(session,url,target_dir,index,datatype,stream,slices,batch_size,cancel,use_pit)
+				elif stream is None:
+					workerpool.run_command([
+						'elasticdump',
+						'--input','%s/%s'%(url,index),
+						'--type',datatype,
+						'--output',os.path.join(target_dir,'%s__%s.json'%(index,datatype))
+					],cancel)
+				else:
+					workerpool.run_command(' '.join([
+						'elasticdump',
+						'--input',shlex.quote('%s/%s'%(url,index)),
+						'--type',datatype,
+						'--output',"'$'",
+						dumppipe.output_pipe(target_dir,'%s__%s.json'%(index,datatype),stream)
+					]),cancel)
+				if datatype=='data' and skip_unchanged is not None:
+					state[index]={
+						'fingerprint': fingerprint,
+						'dumped': dumped,
+					}
+		except (subprocess.CalledProcessError,requests.RequestException,EsExportError) as e:
+			log.error('Elasticsearch dump failed: %s'%e)
 			return False
-	return True
+		return True
+
+	ok=True
+	for index in selected:
+		if skip_unchanged is not None:
+			dumped_files+=['%s__%s.json'%(index,datatype) for datatype in ['alias','mapping','data']]
+		files=None if stream is not None else [os.path.join(target_dir,'%s__%s.json'%(index,datatype)) for datatype in ['alias','mapping','data']]
+		job=dumpstate.checkpointed(checkpoint,index,functools.partial(dump_index,index),files)
+		if not metrics.timed_job('dump_database',{'engine': 'elasticdump','database': index},job,files)(cancel):
+			ok=False
+			break
+
+	if skip_unchanged is not None:
+		dumpstate.save_state(target_dir,state)
+		if ok:
+			dumpstate.remove_stale_files(target_dir,dumped_files)
+	return ok
+
+class EsExportError(Exception):
+	pass
+
+def es_request(session,method,url,body=None):
+	response=session.request(method,url,json=body)
+	if response.status_code != 200:
+		raise EsExportError('%s %s returned %s: %s'%(method,url.split('?')[0],response.status_code,response.text[:500]))
+	return response.json()
+
+def es_export(session,url,target_dir,index,datatype,stream,slices,batch_size,cancel=None,use_pit=True):
+	'''
+	Native replacement for "elasticdump --type <datatype>": writes the same files (one json document per line),
+	but reuses the pooled connections of session and reads the data with several slices in parallel.
+	The data is read with point in time + search_after if use_pit is set and the server supports it, otherwise with scroll.
+	Each slice is buffered in a temporary file and the slices are written in order, so an unchanged index gives the same file.
+	'''
+	index_url='%s/%s'%(url,urllib.parse.quote(index,safe=''))
+	with dumppipe.OutputWriter(target_dir,'%s__%s.json'%(index,datatype),stream,dumppipe.NO_COMPRESSION) as output:
+		if datatype in ('alias','mapping'):
+			output.write(json.dumps(es_request(session,'GET','%s/_%s'%(index_url,datatype))).encode()+b'\n')
+			return
+		slice_files=[tempfile.TemporaryFile(prefix='es-slice') for slice_id in range(slices)] if slices>1 else None
+		def write_hits(slice_id,hits):
+			data=b''.join([json.dumps({k: v for k,v in hit.items() if k!='sort'}).encode()+b'\n' for hit in hits])
+			if slice_files is None:
+				output.write(data)
+			else:
+				slice_files[slice_id].write(data)
+
+		try:
+			pit=session.post('%s/_pit?keep_alive=%s'%(index_url,SEARCH_KEEP_ALIVE)) if use_pit else None
+			if pit is not None and pit.status_code==200:
+				es_export_pit(session,url,index,pit.json()['id'],write_hits,slices,batch_size,cancel)
+			else:
+				# point in time is not available before elasticsearch 7.10 and not sorted by _shard_doc before 7.12
+				es_export_scroll(session,url,index_url,index,write_hits,slices,batch_size,cancel)
+			for slice_file in slice_files or []:
+				slice_file.seek(0)
+				shutil.copyfileobj(slice_file,output)
+		finally:
+			for slice_file in slice_files or []:
+				slice_file.close()
+
+def es_slice(slice_id,slices):
+	return {'slice': {'id': slice_id,'max': slices}} if slices>1 else {}
+
+def es_export_pit(session,url,index,pit_id,write_hits,slices,batch_size,cancel):
+	def export_slice(slice_id,cancel):
+		current_pit_id=pit_id
+		search_after=None
+		while True:
+			if cancel.is_set():
+				raise workerpool.Cancelled()
+			body={
+				'size': batch_size,
+				'pit': {'id': current_pit_id,'keep_alive': SEARCH_KEEP_ALIVE},
+				'sort': [{'_shard_doc': 'asc'}],
+			}
+			body.update(es_slice(slice_id,slices))
+			if search_after is not None:
+				body['search_after']=search_after
+			result=es_request(session,'POST','%s/_search'%url,body)
+			current_pit_id=result.get('pit_id',current_pit_id)
+			hits=result['hits']['hits']
+			if not hits:
+				return True
+			write_hits(slice_id,hits)
+			search_after=hits[-1]['sort']
+
+	try:
+		es_export_slices(index,export_slice,slices,cancel)
+	finally:
+		session.delete('%s/_pit'%url,json={'id': pit_id})
+
+def es_export_scroll(session,url,index_url,index,write_hits,slices,batch_size,cancel):
+	def export_slice(slice_id,cancel):
+		body={
+			'size': batch_size,
+			'sort': ['_doc'],
+		}
+		body.update(es_slice(slice_id,slices))
+		result=es_request(session,'POST','%s/_search?scroll=%s'%(index_url,SEARCH_KEEP_ALIVE),body)
+		try:
+			while True:
+				hits=result['hits']['hits']
+				if not hits:
+					return True
+				write_hits(slice_id,hits)
+				if cancel.is_set():
+					raise workerpool.Cancelled()
+				result=es_request(session,'POST','%s/_search/scroll'%url,{'scroll': SEARCH_KEEP_ALIVE,'scroll_id': result['_scroll_id']})
+		finally:
+			session.delete('%s/_search/scroll'%url,json={'scroll_id': [result['_scroll_id']]})
+
+	es_export_slices(index,export_slice,slices,cancel)
+
+def es_export_slices(index,export_slice,slices,cancel):
+	errors=[]
+	def run_slice(slice_id,cancel):
+		try:
+			return export_slice(slice_id,cancel)
+		except (requests.RequestException,EsExportError) as e:
+			errors.append(e)
+			return False
+	jobs=[('slice %s'%slice_id,functools.partial(run_slice,slice_id)) for slice_id in range(slices)]
+	if not workerpool.run_parallel('Elasticsearch %s'%index,jobs,slices,cancel):
+		if cancel is not None and cancel.is_set():
+			raise workerpool.Cancelled()
+		raise errors[0] if errors else EsExportError('Export of %s failed'%index)
 
 def main():
 	log.basicConfig(level=log.INFO,format='%(asctime)s %(levelname)7s: %(message)s')
@@ -96,12 +336,24 @@ def main():
 		help='Indices to include (regular expression)')
 	parser.add_argument('-e','--exclude', metavar='expression', type=str, nargs='*',
 		help='Indices to exclude (regular expression)')
+	parser.add_argument('--native', action='store_true',
+		help='Use the built-in exporter instead of elasticdump')
+	parser.add_argument('--slices', metavar='slices', type=int, default=2,
+		help='Number of parallel slices to read the data of an index with (native exporter only)')
+	parser.add_argument('--batch-size', metavar='documents', type=int, default=1000,
+		help='Number of documents per request (native exporter only)')
 	args=parser.parse_args()
 	if not os.path.isdir(args.target_dir):
 		print('No such directory: %s'%args.target_dir)
 		quit(1)
 
-	ok=es_dump(args.target_dir,args.url,args.username,args.password,args.include,args.exclude)
+	try:
+		name_filter=backupconfig.NameFilter(args.include,args.exclude)
+	except backupconfig.ConfigError as e:
+		print(e)
+		quit(1)
+	ok=es_dump(args.target_dir,args.url,args.username,args.password,name_filter,
+		exporter='native' if args.native else 'elasticdump',slices=args.slices,batch_size=args.batch_size)
 	if ok:
 		print('Dump successfully created.')
 	else:
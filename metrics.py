@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import functools
+import logging as log
+import os
+import os.path
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# all metrics are gauges in the prometheus text format, names are prefixed with PREFIX
+PREFIX='restic_backup_'
+METRICS={
+	'phase_duration_seconds': 'Duration of the last run of a phase',
+	'phase_exit_code': 'Exit code of the last run of a phase (1 for failures without exit code)',
+	'phase_last_success_timestamp_seconds': 'Time of the last successful run of a phase',
+	'dump_size_bytes': 'Size of the last dump of a database',
+	'backup_files': 'Files of the last restic backup by state (new, changed, unmodified)',
+	'backup_data_added_bytes': 'Data added to the repository by the last restic backup (before compression)',
+	'backup_processed_bytes': 'Data read by the last restic backup',
+	'backup_path_data_added_bytes': 'Data added to the repository by the last restic backup per folder of the backup root (with report-data-added)',
+	'repository_calls_skipped': 'Restic init and unlock calls skipped since start because the repository state was known',
+	'repository_time_saved_seconds': 'Estimated time saved since start by skipped repository calls',
+}
+
+_samples={}
+_active={}
+_lock=threading.Lock()
+_settings={
+	'host': None,
+	'textfile': None,
+}
+
+def metrics_settings(config):
+	'''
+	Parses the "metrics" section of the config. Returns None if the config is invalid.
+	'''
+	if config is None:
+		config={}
+	if type(config) is not dict:
+		log.error('Invalid metrics config: %s'%config)
+		return None
+	listen=None
+	if 'listen' in config:
+		host,_,port=str(config['listen']).rpartition(':')
+		try:
+			listen=(host or '127.0.0.1',int(port))
+		except ValueError:
+			log.error('Invalid metrics config: listen must be [<address>:]<port>')
+			return None
+	return {
+		'textfile': config['textfile'] if 'textfile' in config else None,
+		'listen': listen,
+	}
+
+def configure(host,textfile=None):
+	'''
+	Sets the host label of all metrics and the node exporter textfile that write_textfile() updates.
+	'''
+	_settings['host']=host
+	_settings['textfile']=textfile
+
+def set_gauge(name,labels,value):
+	labels=dict(labels or {})
+	if _settings['host'] is not None:
+		labels['host']=_settings['host']
+	with _lock:
+		_samples[(name,tuple(sorted(labels.items())))]=value
+
+def record_phase(phase,started,exit_code,labels=None,success=None):
+	'''
+	Records the duration (since the time.time() value started) and exit code of a phase.
+	By default, only exit code 0 counts as success.
+	'''
+	now=time.time()
+	labels=dict(labels or {},phase=phase)
+	set_gauge('phase_duration_seconds',labels,now-started)
+	set_gauge('phase_exit_code',labels,exit_code)
+	if success if success is not None else exit_code==0:
+		set_gauge('phase_last_success_timestamp_seconds',labels,now)
+
+def timed(phase,fn,*args,labels=None,**kwargs):
+	'''
+	Calls fn and records its duration as phase. A false result or an exception counts as failure.
+	'''
+	started=time.time()
+	key=object()
+	with _lock:
+		_active[key]=(phase,dict(labels or {}),started)
+	try:
+		result=fn(*args,**kwargs)
+	except BaseException:
+		record_phase(phase,started,1,labels)
+		raise
+	finally:
+		with _lock:
+			del _active[key]
+	record_phase(phase,started,0 if result else 1,labels)
+	return result
+
+def active_phases():
+	'''
+	Returns the phases that are running right now (for status reports), oldest first.
+	'''
+	with _lock:
+		phases=sorted(_active.values(),key=lambda phase: phase[2])
+	return [{'phase': phase,'labels': labels,'started': started} for phase,labels,started in phases]
+
+def timed_job(phase,labels,job,files=None):
+	'''
+	Wraps a job of workerpool.run_parallel, so its duration is recorded as phase. If files (paths of the dump) are given,
+	their total size is recorded as dump size once the job succeeded.
+	'''
+	def run(cancel):
+		result=timed(phase,job,cancel,labels=labels)
+		if result and files:
+			record_size(labels,files)
+		return result
+	return run
+
+def phase_timer(phase):
+	'''
+	Decorator for timed().
+	'''
+	def decorate(fn):
+		@functools.wraps(fn)
+		def run(*args,**kwargs):
+			return timed(phase,fn,*args,**kwargs)
+		return run
+	return decorate
+
+def path_size(path):
+	if os.path.isdir(path):
+		size=0
+		for root,dirs,files in os.walk(path):
+			for filename in files:
+				size+=path_size(os.path.join(root,filename))
+		return size
+	try:
+		return os.path.getsize(path)
+	except OSError:
+		return 0
+
+def record_size(labels,paths):
+	set_gauge('dump_size_bytes',labels,sum([path_size(path) for path in paths]))
+
+def record_backup_summary(summary,labels=None):
+	'''
+	Records the summary of a restic backup (see resticjson.run_backup).
+	'''
+	if 'snapshot_id' not in summary:
+		return
+	labels=labels or {}
+	for state in ['new','changed','unmodified']:
+		set_gauge('backup_files',dict(labels,state=state),summary.get('files_%s'%state,0))
+	set_gauge('backup_data_added_bytes',labels,summary.get('data_added',0))
+	set_gauge('backup_processed_bytes',labels,summary.get('total_bytes_processed',0))
+	for path,added in summary.get('data_added_by_path',{}).items():
+		set_gauge('backup_path_data_added_bytes',dict(labels,path=path),added)
+
+def escape_label(value):
+	return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def render():
+	with _lock:
+		samples=sorted(_samples.items())
+	lines=[]
+	for name,description in METRICS.items():
+		lines.append('# HELP %s%s %s'%(PREFIX,name,description))
+		lines.append('# TYPE %s%s gauge'%(PREFIX,name))
+		for (sample_name,labels),value in samples:
+			if sample_name!=name:
+				continue
+			lines.append('%s%s{%s} %s'%(PREFIX,name,','.join(['%s="%s"'%(k,escape_label(v)) for k,v in labels]),repr(float(value))))
+	return '\n'.join(lines)+'\n'
+
+def write_textfile():
+	'''
+	Writes all metrics to the configured textfile atomically (the node exporter may read it at any time).
+	'''
+	textfile=_settings['textfile']
+	if textfile is None:
+		return
+	try:
+		fd,tmp_file=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(textfile)),prefix='.metrics')
+		with os.fdopen(fd,'w') as f:
+			f.write(render())
+		os.chmod(tmp_file,0o644)
+		os.replace(tmp_file,textfile)
+	except OSError as e:
+		log.warning('Writing metrics to %s failed: %s'%(textfile,e))
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	def log_message(self,format,*args):
+		pass
+
+	def do_GET(self):
+		if self.path.split('?')[0] not in ('/','/metrics'):
+			self.send_error(404)
+			return
+		data=render().encode()
+		self.send_response(200)
+		self.send_header('Content-Type','text/plain; version=0.0.4')
+		self.send_header('Content-Length',str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+def serve(listen):
+	'''
+	Serves the metrics on http://<address>:<port>/metrics from a background thread.
+	'''
+	server=ThreadingHTTPServer(listen,MetricsHandler)
+	threading.Thread(target=server.serve_forever,name='metrics',daemon=True).start()
+	log.info('Serving metrics on http://%s:%s/metrics'%listen)
+	return server
@@ -1,24 +1,122 @@
 #!/usr/bin/env python3
 
 import logging as log
+import functools
+import json
+import os
 import os.path
+import shlex
+import shutil
 import subprocess
+import tempfile
+import dumppipe
+import dumpstate
+import metrics
+import backupconfig
+import workerpool
+try:
+	import pymongo
+except ImportError:
+	# outside of the docker image, the databases are listed with the mongo shell
+	pymongo=None
 
-def mongodump_with_config(target_dir,config):
-	if 'host' not in config:
-		log.error('Missing mongodump config: host')
-	if 'username' not in config:
-		log.error('Missing mongodump config: username')
-	if 'password' not in config:
-		log.error('Missing mongodump config: password')
-	host=config['host']
-	username=config['username']
-	password=config['password']
-	port=config['port'] if 'port' in config else 27017
-	dump_version=config['dump_version'] if 'dump_version' in config else 3
-	return mongodump(target_dir,host,port,username,password,dump_version)
+def mongodump_settings(config):
+	'''
+	Parses the mongodump section of the config into the arguments of mongodump. Returns None if the config is invalid.
+	'''
+	for key in ['host','username','password']:
+		if key not in config:
+			log.error('Missing mongodump config: %s'%key)
+			return None
+	compression=dumppipe.compression_settings(config['compression'] if 'compression' in config else None)
+	if compression is None:
+		return None
+	try:
+		port=int(config['port']) if 'port' in config else 27017
+		dump_version=int(config['dump_version']) if 'dump_version' in config else 3
+		parallel_collections=int(config['parallel-collections']) if 'parallel-collections' in config else None
+		parallelism=int(config['parallelism']) if 'parallelism' in config else 1
+	except ValueError:
+		log.error('Invalid mongodump config: port, dump_version, parallel-collections and parallelism must be numbers')
+		return None
+	if dump_version not in (3,4):
+		log.error('Invalid mongodump config: dump_version must be 3 or 4')
+		return None
+	per_database=bool(config['per-database']) if 'per-database' in config else False
+	if not per_database and ('include' in config or 'exclude' in config or parallelism>1):
+		log.warning('Mongodump: include, exclude and parallelism are only used with per-database')
+	return {
+		'host': config['host'],
+		'port': port,
+		'username': config['username'],
+		'password': config['password'],
+		'dump_version': dump_version,
+		'parallel_collections': parallel_collections,
+		'per_database': per_database,
+		'name_filter': backupconfig.name_filter(config),
+		'parallelism': parallelism,
+		'archive': bool(config['archive']) if 'archive' in config else False,
+		'compression': compression,
+	}
+
+def mongodump_with_config(target_dir,settings,cancel=None,stream=None,checkpoint=None):
+	if stream is not None and not settings['archive']:
+		log.info('Mongodump: streaming to restic requires archive, writing dump files to %s'%target_dir)
+		stream=None
+	return mongodump(target_dir,cancel=cancel,stream=stream,checkpoint=checkpoint,**settings)
+
+def mongo_list_databases(host,port,username,password):
+	'''
+	Lists the databases with pymongo or, if it is not installed, with the mongo shell.
+	'''
+	log.info('Mongodump: Getting list of databases')
+	if pymongo is not None:
+		try:
+			with pymongo.MongoClient(host,int(port),username=username,password=password,authSource='admin') as client:
+				names=client.list_database_names()
+		except pymongo.errors.PyMongoError as e:
+			log.error('Mongodump: Listing databases failed: %s'%e)
+			return None
+	else:
+		names=mongo_shell_list_databases(host,port,username,password)
+		if names is None:
+			return None
+	# local holds the replication state and is never dumped by mongodump
+	return [name for name in names if name!='local']
+
+def mongo_shell_list_databases(host,port,username,password):
+	'''
+	Lists the databases with the mongo shell. The script (including the credentials) is passed on stdin, not on the command line.
+	It is a single statement without a value, so the shell prints nothing but the names.
+	'''
+	shells=[shell for shell in ('mongosh','mongo') if shutil.which(shell)]
+	if not shells:
+		log.error('Mongodump: per-database requires pymongo or the mongo shell (mongosh or mongo)')
+		return None
+	script='''(function() {
+	var admin=new Mongo(%s).getDB('admin');
+	if (!admin.auth(%s,%s)) { quit(1); }
+	admin.adminCommand({listDatabases: 1, nameOnly: true}).databases.forEach(function(d) { print(d.name); });
+})();
+'''%(json.dumps('%s:%s'%(host,port)),json.dumps(username),json.dumps(password))
+	try:
+		output=subprocess.run([shells[0],'--nodb','--quiet'],input=script.encode(),stdout=subprocess.PIPE,check=True).stdout.decode()
+	except subprocess.CalledProcessError:
+		log.error('Mongodump: Listing databases failed.')
+		return None
+	return [line.strip() for line in output.split('\n') if line.strip()!='']
+
+def mongo_password_file(password):
+	'''
+	Writes the password to a mongodump config file (readable only by the current user), so it does not show up in the process list.
+	'''
+	fd,config_file=tempfile.mkstemp(prefix='mongodump',suffix='.yaml')
+	with os.fdopen(fd,'w') as f:
+		f.write('password: %s\n'%json.dumps(password))
+	return config_file
 
-def mongodump(target_dir,host,port,username,password,dump_version):
+def mongodump(target_dir,host,port,username,password,dump_version,cancel=None,parallel_collections=None,per_database=False,
+		name_filter=None,parallelism=1,archive=False,compression=dumppipe.DEFAULT_COMPRESSION,stream=None,checkpoint=None):
 	log.info('Setting binary.')
 	if dump_version == 3:
 		binary = "mongodump"
@@ -28,21 +126,66 @@ def mongodump(target_dir,host,port,username,password,dump_version):
 		log.error('Couldnt set binary.')
 		return False
 
+	if per_database:
+		databases=mongo_list_databases(host,port,username,password)
+		if databases is None:
+			return False
+		if name_filter is not None:
+			databases=name_filter.select(databases,'Mongodump')
+	else:
+		# a single dump of the whole server
+		databases=[None]
+
+	config_file=mongo_password_file(password)
+	try:
+		jobs=[]
+		for database in databases:
+			if stream is not None:
+				files=None
+			elif archive:
+				files=[os.path.join(target_dir,dumppipe.output_filename('MONGO_%s.archive'%database if database else 'MONGO.archive',compression))]
+			else:
+				files=[os.path.join(target_dir,database) if database else target_dir]
+			jobs.append((database or host,metrics.timed_job('dump_database',{'engine': 'mongodump','database': database or ''},
+				dumpstate.checkpointed(checkpoint,database or host,functools.partial(mongodump_database,target_dir,binary,host,port,username,
+				config_file,database,parallel_collections,archive,compression,stream),files),files)))
+		if parallelism>1:
+			log.info('Mongodump: Dumping %s databases with %s parallel workers'%(len(jobs),parallelism))
+		return workerpool.run_parallel('Mongodump',jobs,parallelism,cancel)
+	finally:
+		os.unlink(config_file)
+
+def mongodump_database(target_dir,binary,host,port,username,config_file,database=None,parallel_collections=None,archive=False,
+		compression=dumppipe.DEFAULT_COMPRESSION,stream=None,cancel=None):
+	'''
+	Dumps one database (or the whole server if database is None) either as directory of BSON files to target_dir
+	or as a single archive to MONGO_<db>.archive (compressed like the other dumps, or streamed to restic).
+	'''
+	cmd=[
+		'nice -n 19',
+		'ionice -c3',
+		binary,
+		'--host=%s'%shlex.quote(host),
+		'--port=%s'%port,
+		'--username=%s'%shlex.quote(username),
+		'--config=%s'%shlex.quote(config_file),
+		'--forceTableScan',
+	]
+	if parallel_collections is not None:
+		cmd.append('--numParallelCollections=%s'%parallel_collections)
+	if database is not None:
+		# users of a whole-server dump authenticate against admin, keep that when dumping a single database
+		cmd+=['--authenticationDatabase=admin','--db=%s'%shlex.quote(database)]
+	if archive:
+		cmd.append('--archive')
+		cmd.append(dumppipe.output_pipe(target_dir,'MONGO_%s.archive'%database if database else 'MONGO.archive',stream,compression))
+	else:
+		cmd.append('--out=%s'%shlex.quote(target_dir))
 	try:
-		log.info('Dumping mongodb at %s'%host)
-		subprocess.run("".join([
-			'nice -n 19 '
-			'ionice -c3 '
-			'%s '%binary,
-			'--host=%s '%host,
-			'--port=%s '%port,
-			'--username=%s '%username,
-			'--password=%s '%password,
-			'--forceTableScan ',
-			'-o %s '%target_dir
-		]),shell=True,check=True)
+		log.info('Dumping mongodb %sat %s'%('database %s '%database if database else '',host))
+		workerpool.run_command(' '.join(cmd),cancel)
 	except subprocess.CalledProcessError:
-		log.error('Mongodump failed.')
+		log.error('Mongodump%s failed.'%(' of %s'%database if database else ''))
 		return False
 	return True
 
@@ -57,12 +200,28 @@ def main():
 	parser.add_argument('-u','--username', metavar='username', type=str, help='Mongodb username', required=True)
 	parser.add_argument('-p','--password', metavar='password', type=str, help='Mongodb password', required=True)
 	parser.add_argument('--dump_version', metavar='3 or 4', type=int, help='Choose between mongodump version 3.x.x and 4.x.x. Implemented to avoid failing dumps due to version mismatch. Default 3.', default=3)
+	parser.add_argument('--parallel-collections', metavar='n', type=int, help='Number of collections mongodump reads at the same time')
+	parser.add_argument('--per-database', action='store_true', help='Run one mongodump per database')
+	parser.add_argument('-i','--include', metavar='expression', type=str, nargs='*', help='Dump only databases matching these regular expressions (with --per-database)')
+	parser.add_argument('-e','--exclude', metavar='expression', type=str, nargs='*', help='Skip databases matching these regular expressions (with --per-database)')
+	parser.add_argument('-j','--parallelism', metavar='n', type=int, help='Number of databases to dump at the same time (with --per-database)', default=1)
+	parser.add_argument('--archive', action='store_true', help='Write a single archive per dump instead of a directory of BSON files')
+	parser.add_argument('-c','--compression', metavar='codec', type=str, help='Compression of archives (gzip, pigz, zstd or none)', default='gzip')
 	args=parser.parse_args()
 	if not os.path.isdir(args.target_dir):
 		print('No such directory: %s'%args.target_dir)
 		quit(1)
 
-	ok=mongodump(args.target_dir,args.host,args.port,args.username,args.password,args.dump_version)
+	compression=dumppipe.compression_settings(args.compression)
+	if compression is None:
+		quit(1)
+	try:
+		name_filter=backupconfig.NameFilter(args.include,args.exclude)
+	except backupconfig.ConfigError as e:
+		print(e)
+		quit(1)
+	ok=mongodump(args.target_dir,args.host,args.port,args.username,args.password,args.dump_version,None,args.parallel_collections,
+		args.per_database,name_filter,args.parallelism,args.archive,compression)
 	if ok:
 		print('Dump successfully created.')
 	else:
@@ -6,6 +6,18 @@ from requests.utils import requote_uri
 import os.path
 import subprocess
 import re
+import functools
+import workerpool
+import dumppipe
+import dumpstate
+import backupconfig
+import metrics
+import hashlib
+import math
+import shlex
+import shutil
+import threading
+from datetime import datetime
 
 def mysql_list_database(host,port,username,password):
 
@@ -16,7 +28,7 @@ def mysql_list_database(host,port,username,password):
 			'--host=%s'%host,
 			'--port=%s'%port,
 			'--user=%s'%username
-		],env={'MYSQL_PWD': password}).decode()
+		],env=dict(os.environ,MYSQL_PWD=password)).decode()
 	except subprocess.CalledProcessError:
 		log.error('Mysqlshow failed.')
 		return None
@@ -37,85 +49,469 @@ def mysql_list_database(host,port,username,password):
 
 	return result
 
-def mysql_dump_with_config(target_dir,config):
-	if 'host' not in config:
-		log.error('Missing mysql config: host')
-	if 'username' not in config:
-		log.error('Missing mysql config: username')
-	if 'password' not in config:
-		log.error('Missing mysql config: password')
-	host=config['host']
-	username=config['username']
-	password=config['password']
-	port=config['port'] if 'port' in config else 3306
-	include_patterns=config['include'] if 'include' in config else None
-	exclude_patterns=config['exclude'] if 'exclude' in config else None
-	mysqldump_extra_args=config['mysqldump-extra-args'] if 'mysqldump-extra-args' in config else []
-	return mysql_dump(target_dir,host,port,username,password,include_patterns,exclude_patterns,mysqldump_extra_args)
-
-def mysql_dump(target_dir,host,port,username,password,include_patterns,exclude_patterns,mysqldump_extra_args):
-	if include_patterns and exclude_patterns:
-		log.error("Either inclusion or exclusion of indices is allowed, not both!")
+def mysql_dump_settings(config):
+	'''
+	Parses the mysqldump section of the config into the arguments of mysql_dump. Returns None if the config is invalid.
+	'''
+	for key in ['host','username','password']:
+		if key not in config:
+			log.error('Missing mysql config: %s'%key)
+			return None
+	compression=dumppipe.compression_settings(config['compression'] if 'compression' in config else None)
+	if compression is None:
+		return None
+	skip_unchanged=dumpstate.skip_unchanged_settings(config['skip-unchanged'] if 'skip-unchanged' in config else None,['checksum','metadata'])
+	if skip_unchanged is False:
+		return None
+	per_table=mysql_per_table_settings(config['per-table'] if 'per-table' in config else None)
+	if per_table is False:
+		return None
+	try:
+		port=int(config['port']) if 'port' in config else 3306
+		parallelism=int(config['parallelism']) if 'parallelism' in config else 1
+	except ValueError:
+		log.error('Invalid mysql config: port and parallelism must be numbers')
+		return None
+	return {
+		'host': config['host'],
+		'port': port,
+		'username': config['username'],
+		'password': config['password'],
+		'name_filter': backupconfig.name_filter(config),
+		'mysqldump_extra_args': backupconfig.as_list(config['mysqldump-extra-args'] if 'mysqldump-extra-args' in config else None),
+		'parallelism': parallelism,
+		'compression': compression,
+		'skip_unchanged': skip_unchanged,
+		'per_table': per_table,
+		'order_by_primary': bool(config['order-by-primary']) if 'order-by-primary' in config else False,
+	}
+
+def mysql_dump_with_config(target_dir,settings,cancel=None,stream=None,checkpoint=None):
+	return mysql_dump(target_dir,cancel=cancel,stream=stream,checkpoint=checkpoint,**settings)
+
+def mysql_per_table_settings(config):
+	'''
+	Parses the "per-table" option. Returns None if databases should be dumped as a whole and False if the config is invalid.
+	'''
+	if config is None or config is False:
+		return None
+	if config is True:
+		config={}
+	if type(config) is not dict:
+		log.error('Invalid per-table config: %s'%config)
+		return False
+	consistency=config['consistency'] if 'consistency' in config else 'table'
+	if consistency not in ('table','locked'):
+		log.error('Invalid per-table consistency: %s (allowed: table, locked)'%consistency)
+		return False
+	if consistency=='table':
+		log.warning('Mysql: per-table consistency "table" dumps each table in its own transaction, the tables of a database are not consistent with each other')
+	try:
+		return {
+			'databases': backupconfig.NameFilter(config['databases']) if 'databases' in config else None,
+			'parallelism': int(config['parallelism']) if 'parallelism' in config else 4,
+			'chunk-rows': int(config['chunk-rows']) if 'chunk-rows' in config else None,
+			'consistency': consistency,
+		}
+	except ValueError:
+		log.error('Invalid per-table config: parallelism and chunk-rows must be numbers')
+		return False
+
+def mysql_uses_per_table(per_table,database):
+	if per_table is None:
+		return False
+	return per_table['databases'] is None or per_table['databases'].matches(database)
+
+def mysql_dump(target_dir,host,port,username,password,name_filter,mysqldump_extra_args,parallelism=1,cancel=None,stream=None,compression=dumppipe.DEFAULT_COMPRESSION,skip_unchanged=None,per_table=None,checkpoint=None,order_by_primary=False):
 	databases=mysql_list_database(host,port,username,password)
 	if databases is None:
 		return False
 
-	for database in databases:
-		if include_patterns:
-			included=False
-			for p in include_patterns:
-				if (re.compile(p).match(database)):
-					included=True
-					break
-			if included:
-				log.info('Mysql: database %s is included for this dump.'%database)
-			else:
-				log.info('Mysql: database %s is not included for this dump.'%database)
-				continue
-		if exclude_patterns:
-			excluded=False
-			for p in exclude_patterns:
-				if (re.compile(p).match(database)):
-					excluded=True
-					break
-			if excluded:
-				log.info('Mysql: database %s is excluded for this dump.'%database)
-				continue
-			else:
-				log.info('Mysql: database %s is not excluded for this dump.'%database)
-		try:
+	if order_by_primary:
+		# rows in a stable order, so unchanged parts of a table dump stay identical and restic deduplicates them
+		mysqldump_extra_args=mysqldump_extra_args+['--order-by-primary']
+
+	selected=name_filter.select(databases,'Mysql')
+
+	if skip_unchanged is not None and stream is not None:
+		log.warning('Mysql: skip-unchanged is not supported with stream-to-restic. Dumping all databases.')
+		skip_unchanged=None
+
+	jobs=[]
+	if skip_unchanged is None:
+		for database in selected:
+			jobs.append((database,functools.partial(mysql_dump_database,target_dir,host,port,username,password,database,mysqldump_extra_args,stream,compression,per_table)))
+	else:
+		previous_state=dumpstate.load_state(target_dir)
+		state={database: previous_state[database] for database in selected if database in previous_state}
+		state_lock=threading.Lock()
+		for database in selected:
+			jobs.append((database,functools.partial(mysql_dump_database_if_changed,previous_state,state,state_lock,skip_unchanged,
+				target_dir,host,port,username,password,database,mysqldump_extra_args,compression,per_table)))
+	def dump_job(database,job):
+		files=None if stream is not None else [os.path.join(target_dir,f) for f in mysql_dump_files(database,compression,mysql_uses_per_table(per_table,database))]
+		return metrics.timed_job('dump_database',{'engine': 'mysqldump','database': database},dumpstate.checkpointed(checkpoint,database,job,files),files)
+	jobs=[(database,dump_job(database,job)) for database,job in jobs]
+
+	if parallelism>1:
+		log.info('Mysql: Dumping %s databases with %s parallel workers'%(len(jobs),parallelism))
+	ok=workerpool.run_parallel('Mysql',jobs,parallelism,cancel)
+
+	if skip_unchanged is not None:
+		dumpstate.save_state(target_dir,state)
+		if ok:
+			keep_files=[]
+			for database in selected:
+				keep_files+=mysql_dump_files(database,compression,mysql_uses_per_table(per_table,database))
+			dumpstate.remove_stale_files(target_dir,keep_files)
+	return ok
+
+def mysql_dump_files(database,compression=dumppipe.DEFAULT_COMPRESSION,per_table=False):
+	if per_table:
+		return [
+			dumppipe.output_filename('MYSQL_%s_DROP_CREATE.sql'%(database),compression),
+			dumppipe.output_filename('MYSQL_%s_SCHEMA.sql'%(database),compression),
+			dumppipe.output_filename('MYSQL_%s_TRIGGERS.sql'%(database),compression),
+			'MYSQL_%s'%(database),
+		]
+	return [
+		dumppipe.output_filename('MYSQL_%s_DROP_CREATE.sql'%(database),compression),
+		dumppipe.output_filename('MYSQL_%s_DATA.sql'%(database),compression),
+	]
+
+def mysql_query(host,port,username,password,query,timeout=None):
+	return subprocess.check_output([
+		'mysql',
+		'--host=%s'%host,
+		'--port=%s'%port,
+		'--user=%s'%username,
+		'--batch',
+		'--skip-column-names',
+		'--execute=%s'%query
+	],env=dict(os.environ,MYSQL_PWD=password),timeout=timeout).decode()
+
+def mysql_probe(settings,query,timeout=None):
+	'''
+	Runs query against the server of the mysqldump settings (the latency probe of the throttle).
+	'''
+	mysql_query(settings['host'],settings['port'],settings['username'],settings['password'],query,timeout)
+
+def mysql_fingerprint(host,port,username,password,database,method):
+	'''
+	Returns a fingerprint of the content of a database or None if it cannot be determined.
+	"checksum" runs CHECKSUM TABLE on all tables. "metadata" uses create/update time, row count and size of each table from
+	information_schema, which is cheaper but heuristic: InnoDB row counts are estimates, MySQL 8 caches the values (see
+	information_schema_stats_expiry) and in-place updates may change none of them.
+	'''
+	schema=database.replace('\\','\\\\').replace("'","\\'")
+	try:
+		if method=='checksum':
+			tables=mysql_query(host,port,username,password,
+				"SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA='%s' AND TABLE_TYPE='BASE TABLE' ORDER BY TABLE_NAME"%schema).split('\n')
+			tables=['`%s`.`%s`'%(database.replace('`','``'),table.replace('`','``')) for table in tables if table!='']
+			output=mysql_query(host,port,username,password,'CHECKSUM TABLE %s'%', '.join(tables)) if tables else ''
+		else:
+			output=mysql_query(host,port,username,password,
+				"SELECT TABLE_NAME,TABLE_TYPE,ENGINE,TABLE_ROWS,DATA_LENGTH,INDEX_LENGTH,CREATE_TIME,UPDATE_TIME FROM information_schema.TABLES WHERE TABLE_SCHEMA='%s' ORDER BY TABLE_NAME"%schema)
+	except subprocess.CalledProcessError:
+		log.warning('Mysql: unable to get fingerprint of %s'%database)
+		return None
+	return '%s:%s'%(method,hashlib.sha256(output.encode()).hexdigest())
+
+def mysql_dump_database_if_changed(previous_state,state,state_lock,skip_unchanged,target_dir,host,port,username,password,database,mysqldump_extra_args,compression,per_table=None,cancel=None):
+	fingerprint=mysql_fingerprint(host,port,username,password,database,skip_unchanged['method'])
+	files_exist=all([os.path.exists(os.path.join(target_dir,f)) for f in mysql_dump_files(database,compression,mysql_uses_per_table(per_table,database))])
+	if files_exist and dumpstate.is_unchanged(previous_state,database,fingerprint,skip_unchanged['force-full-days']):
+		log.info('Mysql: %s is unchanged since %s, keeping previous dump'%(database,previous_state[database]['dumped']))
+		return True
+
+	with state_lock:
+		state.pop(database,None)
+	dumped=datetime.now().isoformat(timespec='seconds')
+	if not mysql_dump_database(target_dir,host,port,username,password,database,mysqldump_extra_args,None,compression,per_table,cancel):
+		return False
+	with state_lock:
+		state[database]={
+			'fingerprint': fingerprint,
+			'dumped': dumped,
+		}
+	return True
+
+def mysql_dump_database(target_dir,host,port,username,password,database,mysqldump_extra_args,stream=None,compression=dumppipe.DEFAULT_COMPRESSION,per_table=None,cancel=None):
+	try:
+		if mysql_uses_per_table(per_table,database):
 			log.info('Mysql: Dumping DROP/CREATE statements for %s'%(database))
-			subprocess.run("".join([
+			workerpool.run_command("".join([
 				'nice -n 19 '
 				'ionice -c3 '
 				'mysqldump '
 				'--host=%s '%host,
 				'--port=%s '%port,
 				'--user=%s '%username,
+				'--skip-dump-date ',
 				'--no-data ',
 				'--add-drop-database ',
 				'--no-create-info ',
 				' '.join(mysqldump_extra_args),
 				' --databases %s '%database,
-				' | nice -n 19 gzip --best --rsyncable > %s '%os.path.join(target_dir,'MYSQL_%s_DROP_CREATE.sql.gz'%(database))
-			]),env={'MYSQL_PWD': password},shell=True,check=True)
-			log.info('Mysql: Dumping DATA for %s'%(database))
-			subprocess.run("".join([
-				'nice -n 19 '
-				'ionice -c3 '
-				'mysqldump '
-				'--host=%s '%host,
-				'--port=%s '%port,
-				'--user=%s '%username,
-				'--no-create-db ',
-				' '.join(mysqldump_extra_args),
-				' ',
-                database,
-				'| nice -n 19 gzip --best --rsyncable > %s '%os.path.join(target_dir,'MYSQL_%s_DATA.sql.gz'%(database))
-			]),env={'MYSQL_PWD': password},shell=True,check=True)
-		except subprocess.CalledProcessError as e:
-			log.error('Mysqldump failed.')
-			return False
+				dumppipe.output_pipe(target_dir,'MYSQL_%s_DROP_CREATE.sql'%(database),stream,compression)
+			]),cancel,env=dict(os.environ,MYSQL_PWD=password))
+			return mysql_dump_tables(target_dir,host,port,username,password,database,mysqldump_extra_args,stream,compression,per_table,cancel)
+		log.info('Mysql: Dumping DROP/CREATE statements and DATA for %s'%(database))
+		mysql_dump_single_pass(target_dir,host,port,username,password,database,mysqldump_extra_args,stream,compression,cancel)
+	except (subprocess.CalledProcessError,MysqlDumpError) as e:
+		log.error('Mysqldump of %s failed.'%database)
+		if isinstance(e,MysqlDumpError):
+			log.error(str(e))
+		return False
+	return True
+
+class MysqlDumpError(Exception):
+	pass
+
+# lines that start the database section (DROP/CREATE/USE) of "mysqldump --databases"
+MYSQL_DATABASE_SECTION=(b'-- Current Database:',b'/*!40000 DROP DATABASE',b'CREATE DATABASE',b'USE ')
+# header lines that are read at most before the USE statement, everything after it is copied in blocks
+MYSQL_MAX_HEADER_LINES=1000
+MYSQL_BLOCK_SIZE=1024*1024
+# the footer restores the session variables changed by the header, it is found in this many bytes at the end of the dump
+MYSQL_TAIL_SIZE=64*1024
+MYSQL_FOOTER=re.compile(rb'^(?:/\*!\d+ SET [^\n@]*=@OLD_[^\n]*\*/;|-- Dump completed[^\n]*)$',re.M)
+
+def mysql_dump_single_pass(target_dir,host,port,username,password,database,mysqldump_extra_args,stream,compression,cancel=None):
+	'''
+	Dumps a database with a single mysqldump run and splits its output into MYSQL_<db>_DROP_CREATE.sql (the database section
+	up to the USE statement) and MYSQL_<db>_DATA.sql (tables and rows), each with the header and footer of the dump.
+	'''
+	if cancel is not None and cancel.is_set():
+		raise workerpool.Cancelled()
+	cmd=[
+		'nice','-n','19',
+		'ionice','-c3',
+		'mysqldump',
+		'--host=%s'%host,
+		'--port=%s'%port,
+		'--user=%s'%username,
+		'--skip-dump-date',
+		'--add-drop-database',
+	]+shlex.split(' '.join(mysqldump_extra_args))+['--databases',database]
+	use_statement=('USE `%s`;\n'%database.replace('`','``')).encode()
+	proc=workerpool.open_command(cmd,env=dict(os.environ,MYSQL_PWD=password))
+	try:
+		with dumppipe.OutputWriter(target_dir,'MYSQL_%s_DROP_CREATE.sql'%(database),stream,compression) as drop_create, \
+				dumppipe.OutputWriter(target_dir,'MYSQL_%s_DATA.sql'%(database),stream,compression) as data:
+			header=[]
+			section=None
+			for line in iter(proc.stdout.readline,b''):
+				if section is None and line.startswith(MYSQL_DATABASE_SECTION):
+					# the comment block around "-- Current Database" belongs to the section
+					section=[header.pop()] if header and header[-1]==b'--\n' else []
+				(header if section is None else section).append(line)
+				if section is not None and line==use_statement:
+					break
+				if len(header)+len(section or [])>MYSQL_MAX_HEADER_LINES:
+					raise MysqlDumpError('No USE statement for %s at the start of the mysqldump output'%database)
+			else:
+				workerpool.close_command(proc,cmd,cancel)
+				raise MysqlDumpError('No USE statement for %s in the mysqldump output'%database)
+			drop_create.write(b''.join(header+section))
+			data.write(b''.join(header))
+			tail=b''
+			while True:
+				if cancel is not None and cancel.is_set():
+					raise workerpool.Cancelled()
+				block=proc.stdout.read1(MYSQL_BLOCK_SIZE)
+				if not block:
+					break
+				data.write(block)
+				tail=(tail+block)[-MYSQL_TAIL_SIZE:]
+			footer=MYSQL_FOOTER.findall(tail)
+			if footer:
+				drop_create.write(b'\n'.join(footer)+b'\n')
+			workerpool.close_command(proc,cmd,cancel)
+	except BaseException:
+		workerpool.kill_process_group(proc)
+		raise
+
+def mysql_list_tables(host,port,username,password,database):
+	'''
+	Returns name, estimated row count and the primary key column (if it is a single integer column) of each table.
+	'''
+	schema=database.replace('\\','\\\\').replace("'","\\'")
+	output=mysql_query(host,port,username,password,' '.join([
+		"SELECT t.TABLE_NAME,IFNULL(t.TABLE_ROWS,0),GROUP_CONCAT(c.COLUMN_NAME),GROUP_CONCAT(c.DATA_TYPE)",
+		"FROM information_schema.TABLES t LEFT JOIN information_schema.COLUMNS c",
+		"ON c.TABLE_SCHEMA=t.TABLE_SCHEMA AND c.TABLE_NAME=t.TABLE_NAME AND c.COLUMN_KEY='PRI'",
+		"WHERE t.TABLE_SCHEMA='%s' AND t.TABLE_TYPE='BASE TABLE'"%schema,
+		"GROUP BY t.TABLE_NAME,t.TABLE_ROWS ORDER BY t.TABLE_NAME"
+	]))
+	result=[]
+	for line in output.split('\n'):
+		if line=='':
+			continue
+		table,rows,pk_columns,pk_types=line.split('\t')
+		pk=None
+		if ',' not in pk_columns and pk_types in ('tinyint','smallint','mediumint','int','bigint'):
+			pk=pk_columns
+		result.append((table,int(rows),pk))
+	return result
+
+def mysql_table_chunks(host,port,username,password,database,table,rows,pk,chunk_rows):
+	'''
+	Splits a table into primary key ranges of about chunk_rows rows. Returns a list of where conditions ([None] for the whole table).
+	The first and last range are open, so rows inserted meanwhile are not lost.
+	'''
+	if chunk_rows is None or pk is None or rows<=chunk_rows:
+		return [None]
+	output=mysql_query(host,port,username,password,'SELECT MIN(`%s`),MAX(`%s`) FROM `%s`.`%s`'%(
+		pk.replace('`','``'),pk.replace('`','``'),database.replace('`','``'),table.replace('`','``'))).strip()
+	lowest,highest=output.split('\t')
+	if lowest=='NULL':
+		return [None]
+	lowest,highest=int(lowest),int(highest)
+	step=max(1,math.ceil((highest-lowest+1)/math.ceil(rows/chunk_rows)))
+	column='`%s`'%pk.replace('`','``')
+	chunks=[]
+	previous=None
+	for bound in range(lowest+step,highest+1,step):
+		if previous is None:
+			chunks.append('%s<%d'%(column,bound))
+		else:
+			chunks.append('%s>=%d AND %s<%d'%(column,previous,column,bound))
+		previous=bound
+	chunks.append(None if previous is None else '%s>=%d'%(column,previous))
+	return chunks
+
+def mysql_lock_tables(host,port,username,password,database,tables):
+	'''
+	Opens a session which holds a read lock on all tables of database until mysql_unlock_tables is called.
+	Other sessions can still read the tables, so all dump processes see the same data while writes are blocked.
+	'''
+	proc=subprocess.Popen([
+		'mysql',
+		'--host=%s'%host,
+		'--port=%s'%port,
+		'--user=%s'%username,
+		'--batch',
+		'--skip-column-names',
+		'--unbuffered'
+	],stdin=subprocess.PIPE,stdout=subprocess.PIPE,env=dict(os.environ,MYSQL_PWD=password))
+	proc.stdin.write(('LOCK TABLES %s;\nSELECT "LOCKED";\n'%', '.join([
+		'`%s`.`%s` READ'%(database.replace('`','``'),table.replace('`','``')) for table in tables])).encode())
+	proc.stdin.flush()
+	if proc.stdout.readline().strip()!=b'LOCKED':
+		proc.kill()
+		proc.wait()
+		raise subprocess.CalledProcessError(proc.returncode,'LOCK TABLES')
+	return proc
+
+def mysql_unlock_tables(proc):
+	try:
+		proc.stdin.write(b'UNLOCK TABLES;\n')
+		proc.stdin.close()
+	except OSError:
+		pass
+	proc.wait()
+
+def mysql_dump_tables(target_dir,host,port,username,password,database,mysqldump_extra_args,stream,compression,per_table,cancel=None):
+	'''
+	Dumps the schema of database to MYSQL_<db>_SCHEMA.sql, its triggers to MYSQL_<db>_TRIGGERS.sql (restored after the data)
+	and the data of each table (or primary key range of large tables) to MYSQL_<db>/<table>[.<chunk>].sql with several
+	mysqldump processes in parallel.
+	'''
+	table_dir='MYSQL_%s'%database
+	if stream is None:
+		if os.path.isdir(os.path.join(target_dir,table_dir)):
+			shutil.rmtree(os.path.join(target_dir,table_dir))
+		os.mkdir(os.path.join(target_dir,table_dir))
+	env=dict(os.environ,MYSQL_PWD=password)
+	mysqldump_cmd=' '.join([
+		'nice -n 19',
+		'ionice -c3',
+		'mysqldump',
+		'--host=%s'%host,
+		'--port=%s'%port,
+		'--user=%s'%username,
+		# without the date, dumps of unchanged tables are byte-identical, so the previous file is kept
+		'--skip-dump-date',
+	]+mysqldump_extra_args)
+
+	log.info('Mysql: Dumping schema for %s'%(database))
+	workerpool.run_command(' '.join([
+		mysqldump_cmd,
+		'--no-data',
+		'--skip-triggers',
+		shlex.quote(database),
+		dumppipe.output_pipe(target_dir,'MYSQL_%s_SCHEMA.sql'%(database),stream,compression)
+	]),cancel,env=env)
+
+	tables=mysql_list_tables(host,port,username,password,database)
+	lock=None
+	if per_table['consistency']=='locked' and tables:
+		log.warning('Mysql: Locking %s tables of %s, writes to %s are blocked until its data is dumped (consistency: locked)'%(
+			len(tables),database,database))
+		lock=mysql_lock_tables(host,port,username,password,database,[table for table,rows,pk in tables])
+	try:
+		jobs=[]
+		for table,rows,pk in tables:
+			chunks=mysql_table_chunks(host,port,username,password,database,table,rows,pk,per_table['chunk-rows'])
+			for i,where in enumerate(chunks):
+				if len(chunks)==1:
+					label,filename='%s.%s'%(database,table),'%s/%s.sql'%(table_dir,table)
+				else:
+					label,filename='%s.%s[%s]'%(database,table,i),'%s/%s.%04d.sql'%(table_dir,table,i)
+				jobs.append((label,functools.partial(mysql_dump_table,target_dir,mysqldump_cmd,env,database,table,where,
+					filename,lock is None,stream,compression)))
+		log.info('Mysql: Dumping DATA for %s in %s parts with %s parallel workers'%(database,len(jobs),per_table['parallelism']))
+		ok=workerpool.run_parallel('Mysql',jobs,per_table['parallelism'],cancel)
+	finally:
+		if lock is not None:
+			mysql_unlock_tables(lock)
+	if not ok:
+		return False
+
+	log.info('Mysql: Dumping triggers for %s'%(database))
+	workerpool.run_command(' '.join([
+		mysqldump_cmd,
+		'--no-data',
+		'--no-create-info',
+		'--skip-routines',
+		'--skip-events',
+		'--triggers',
+		shlex.quote(database),
+		dumppipe.output_pipe(target_dir,'MYSQL_%s_TRIGGERS.sql'%(database),stream,compression)
+	]),cancel,env=env)
+	return True
+
+def mysql_dump_table(target_dir,mysqldump_cmd,env,database,table,where,filename,single_transaction,stream,compression,cancel=None):
+	cmd=[
+		mysqldump_cmd,
+		'--no-create-info',
+		'--skip-triggers',
+		'--skip-routines',
+		'--skip-events',
+	]
+	if single_transaction:
+		cmd.append('--single-transaction')
+	else:
+		# the tables are already locked by mysql_lock_tables
+		cmd.append('--skip-lock-tables')
+	if where is not None:
+		cmd.append(shlex.quote('--where=%s'%where))
+	cmd+=[
+		shlex.quote(database),
+		shlex.quote(table),
+		dumppipe.output_pipe(target_dir,filename,stream,compression)
+	]
+	try:
+		if where is None:
+			log.info('Mysql: Dumping DATA for %s.%s'%(database,table))
+		else:
+			log.info('Mysql: Dumping DATA for %s.%s where %s'%(database,table,where))
+		workerpool.run_command(' '.join(cmd),cancel,env=env)
+	except subprocess.CalledProcessError:
+		log.error('Mysqldump of %s.%s failed.'%(database,table))
+		return False
 	return True
 
 def main():
@@ -132,12 +528,22 @@ def main():
 		help='Databases to include (regular expression)')
 	parser.add_argument('-e','--exclude', metavar='expression', type=str, nargs='*',
 		help='Databases to exclude (regular expression)')
+	parser.add_argument('-j','--parallelism', metavar='workers', type=int, default=1,
+		help='Number of databases to dump in parallel')
+	parser.add_argument('-c','--compression', metavar='codec', type=str, default='gzip',
+		choices=list(dumppipe.COMPRESSION_CODECS), help='Compression of the dump files (default: gzip)')
 	args=parser.parse_args()
 	if not os.path.isdir(args.target_dir):
 		print('No such directory: %s'%args.target_dir)
 		quit(1)
 
-	ok=mysql_dump(args.target_dir,args.host,args.port,args.username,args.password,args.include,args.exclude,[])
+	try:
+		name_filter=backupconfig.NameFilter(args.include,args.exclude)
+	except backupconfig.ConfigError as e:
+		print(e)
+		quit(1)
+	ok=mysql_dump(args.target_dir,args.host,args.port,args.username,args.password,name_filter,[],args.parallelism,
+		compression=dumppipe.compression_settings(args.compression))
 	if ok:
 		print('Dump successfully created.')
 	else:
@@ -5,20 +5,30 @@ import requests
 from requests.utils import requote_uri
 import os.path
 import subprocess
-import re
+import functools
+import workerpool
+import dumppipe
+import dumpstate
+import metrics
+import backupconfig
+import shlex
+import shutil
+
+# supported output formats of pg_dump: plain sql, custom archive (for pg_restore -j) and directory (dumped with --jobs)
+PG_DUMP_FORMATS=['plain','custom','directory']
 
 def pg_list_database(host,port,username,password):
 
 	try:
 		log.info('Getting list of databases')
 		output=subprocess.check_output([" ".join([
-				'/usr/bin/psql',
+				'psql',
 				'--host=%s'%host,
 				'--port=%s'%port,
 				'--username=%s'%username,
 				'-P pager=off -P tuples_only=on -l',
 				"| cut -d'|' -f1 | tr -d '[:blank:]'"
-		])],env={'PGPASSWORD': password},shell=True).decode()
+		])],env=dict(os.environ,PGPASSWORD=password),shell=True).decode()
 	except subprocess.CalledProcessError:
 		log.error('Listing of databases failed.')
 		return None
@@ -36,67 +46,130 @@ def pg_list_database(host,port,username,password):
 
 	return result
 
-def pg_dump_with_config(target_dir,config):
-	if not 'host' in config:
-		log.error('Missing pg config: host')
-	if not 'username' in config:
-		log.error('Missing pg config: username')
-	if not 'password' in config:
-		log.error('Missing pg config: password')
-	host=config['host']
-	username=config['username']
-	password=config['password']
-	port=config['port'] if 'port' in config else 5432
-	include_patterns=config['include'] if 'include' in config else None
-	exclude_patterns=config['exclude'] if 'exclude' in config else None
-	return pg_dump(target_dir,host,port,username,password,include_patterns,exclude_patterns)
-
-def pg_dump(target_dir,host,port,username,password,include_patterns,exclude_patterns):
-	if include_patterns and exclude_patterns:
-		log.error("Either inclusion or exclusion of indices is allowed, not both!")
+def pg_probe(settings,query,timeout=None):
+	'''
+	Runs query against the server of the pgdump settings (the latency probe of the throttle).
+	'''
+	subprocess.run([
+		'psql',
+		'--host=%s'%settings['host'],
+		'--port=%s'%settings['port'],
+		'--username=%s'%settings['username'],
+		'--no-password',
+		'--dbname=postgres',
+		'--tuples-only',
+		'--command=%s'%query,
+	],env=dict(os.environ,PGPASSWORD=settings['password']),stdout=subprocess.DEVNULL,check=True,timeout=timeout)
+
+def pg_dump_settings(config):
+	'''
+	Parses the pgdump section of the config into the arguments of pg_dump. Returns None if the config is invalid.
+	'''
+	for key in ['host','username','password']:
+		if key not in config:
+			log.error('Missing pg config: %s'%key)
+			return None
+	compression=dumppipe.compression_settings(config['compression'] if 'compression' in config else None)
+	if compression is None:
+		return None
+	dump_format=config['format'] if 'format' in config else 'plain'
+	if dump_format not in PG_DUMP_FORMATS:
+		log.error('Invalid pgdump format: %s (allowed: %s)'%(dump_format,', '.join(PG_DUMP_FORMATS)))
+		return None
+	try:
+		port=int(config['port']) if 'port' in config else 5432
+		parallelism=int(config['parallelism']) if 'parallelism' in config else 1
+		jobs=int(config['jobs']) if 'jobs' in config else 1
+	except ValueError:
+		log.error('Invalid pg config: port, parallelism and jobs must be numbers')
+		return None
+	return {
+		'host': config['host'],
+		'port': port,
+		'username': config['username'],
+		'password': config['password'],
+		'name_filter': backupconfig.name_filter(config),
+		'parallelism': parallelism,
+		'compression': compression,
+		'dump_format': dump_format,
+		'jobs': jobs,
+	}
+
+def pg_dump_with_config(target_dir,settings,cancel=None,stream=None,checkpoint=None):
+	return pg_dump(target_dir,cancel=cancel,stream=stream,checkpoint=checkpoint,**settings)
+
+def pg_dump(target_dir,host,port,username,password,name_filter,parallelism=1,cancel=None,stream=None,compression=dumppipe.DEFAULT_COMPRESSION,dump_format='plain',jobs=1,checkpoint=None):
 	databases=pg_list_database(host,port,username,password)
 	if not databases:
 		return False
 
-	for database in databases:
-		if include_patterns:
-			included=False
-			for p in include_patterns:
-				if (re.compile(p).match(database)):
-					included=True
-					break
-			if included:
-				log.info('Postgresql: database %s is included for this dump.'%database)
-			else:
-				log.info('Postgresql: database %s is not included for this dump.'%database)
-				continue
-		if exclude_patterns:
-			excluded=False
-			for p in exclude_patterns:
-				if (re.compile(p).match(database)):
-					excluded=True
-					break
-			if excluded:
-				log.info('Postgresql: database %s is excluded for this dump.'%database)
-				continue
-			else:
-				log.info('Postgresql: database %s is not excluded for this dump.'%database)
-		try:
-			log.info('Postgresql: Dumping %s'%(database))
-			subprocess.run(" ".join([
-				'nice -n 19 '
-				'ionice -c3 '
-				'/usr/bin/pg_dump',
-				'--no-password',
-				'--host=%s '%host,
-				'--port=%s '%port,
-				'--user=%s '%username,
+	if dump_format=='directory' and stream is not None:
+		log.warning('Postgresql: directory format cannot be streamed to restic. Writing dumps to %s'%target_dir)
+		stream=None
+
+	dump_jobs=[]
+	for database in name_filter.select(databases,'Postgresql'):
+		files=None if stream is not None else [os.path.join(target_dir,pg_dump_file(database,compression,dump_format))]
+		dump_jobs.append((database,metrics.timed_job('dump_database',{'engine': 'pgdump','database': database},
+			dumpstate.checkpointed(checkpoint,database,
+			functools.partial(pg_dump_database,target_dir,host,port,username,password,database,stream,compression,dump_format,jobs),files),files)))
+
+	if parallelism>1:
+		log.info('Postgresql: Dumping %s databases with %s parallel workers'%(len(dump_jobs),parallelism))
+	return workerpool.run_parallel('Postgresql',dump_jobs,parallelism,cancel)
+
+def pg_dump_file(database,compression=dumppipe.DEFAULT_COMPRESSION,dump_format='plain'):
+	if dump_format=='plain':
+		return dumppipe.output_filename('PGSQL_%s.sql'%(database),compression)
+	if dump_format=='custom':
+		return 'PGSQL_%s.dump'%(database)
+	return 'PGSQL_%s'%(database)
+
+def pg_dump_database(target_dir,host,port,username,password,database,stream=None,compression=dumppipe.DEFAULT_COMPRESSION,dump_format='plain',jobs=1,cancel=None):
+	cmd=[
+		'nice -n 19 '
+		'ionice -c3 '
+		'pg_dump',
+		'--no-password',
+		'--host=%s '%host,
+		'--port=%s '%port,
+		'--user=%s '%username,
+	]
+	if dump_format=='plain':
+		cmd+=[
+			database,
+			dumppipe.output_pipe(target_dir,'PGSQL_%s.sql'%(database),stream,compression)
+		]
+	else:
+		# custom and directory format are compressed by pg_dump itself
+		if compression['codec']=='none':
+			cmd.append('--compress=0')
+		if dump_format=='custom':
+			cmd+=[
+				'--format=custom',
 				database,
-				'| nice -n 19 gzip --best --rsyncable > %s '%os.path.join(target_dir,'PGSQL_%s.sql.gz'%(database))
-			]),env={'PGPASSWORD': password},shell=True,check=True)
-		except subprocess.CalledProcessError:
-			log.error('Pgdump failed.')
-			return False
+				dumppipe.output_pipe(target_dir,'PGSQL_%s.dump'%(database),stream,dumppipe.NO_COMPRESSION)
+			]
+		else:
+			dump_dir=os.path.join(target_dir,'PGSQL_%s'%(database))
+			if os.path.isdir(dump_dir):
+				# left over from a failed attempt, pg_dump only writes to new directories
+				shutil.rmtree(dump_dir)
+			cmd+=[
+				'--format=directory',
+				'--jobs=%s'%jobs,
+				'--file=%s'%shlex.quote(dump_dir),
+				database
+			]
+	try:
+		if dump_format=='plain':
+			log.info('Postgresql: Dumping %s'%(database))
+		else:
+			log.info('Postgresql: Dumping %s (%s format)'%(database,dump_format))
+		workerpool.run_command(" ".join(cmd),cancel,env=dict(os.environ,PGPASSWORD=password))
+	except subprocess.CalledProcessError:
+		log.error('Pgdump of %s failed.'%database)
+		return False
 	return True
 
 def main():
@@ -113,12 +186,26 @@ def main():
 		help='Databases to include (regular expression)')
 	parser.add_argument('-e','--exclude', metavar='expression', type=str, nargs='*',
 		help='Databases to exclude (regular expression)')
+	parser.add_argument('-j','--parallelism', metavar='workers', type=int, default=1,
+		help='Number of databases to dump in parallel')
+	parser.add_argument('-c','--compression', metavar='codec', type=str, default='gzip',
+		choices=list(dumppipe.COMPRESSION_CODECS), help='Compression of the dump files (default: gzip)')
+	parser.add_argument('-F','--format', metavar='format', type=str, default='plain',
+		choices=PG_DUMP_FORMATS, help='Output format of pg_dump (default: plain)')
+	parser.add_argument('--jobs', metavar='jobs', type=int, default=1,
+		help='Number of parallel pg_dump jobs per database (directory format only)')
 	args=parser.parse_args()
 	if not os.path.isdir(args.target_dir):
 		print('No such directory: %s'%args.target_dir)
 		quit(1)
 
-	ok=pg_dump(args.target_dir,args.host,args.port,args.username,args.password,args.include,args.exclude)
+	try:
+		name_filter=backupconfig.NameFilter(args.include,args.exclude)
+	except backupconfig.ConfigError as e:
+		print(e)
+		quit(1)
+	ok=pg_dump(args.target_dir,args.host,args.port,args.username,args.password,name_filter,args.parallelism,
+		compression=dumppipe.compression_settings(args.compression),dump_format=args.format,jobs=args.jobs)
 	if ok:
 		print('Dump successfully created.')
 	else:
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import json
+import logging as log
+import subprocess
+import time
+import metrics
+
+class Repository:
+	'''
+	What this process knows about a restic repository, so the expensive "restic init" and "restic unlock" (several
+	seconds of listing requests on S3) run only when needed: the repository is initialized at most once per process
+	and unlocked only if locks are found, which is checked once per job. A failed restic command makes the state unknown,
+	so the next job checks the repository config again (detecting a replaced repository) and looks for stale locks.
+	'''
+	def __init__(self,url):
+		self.url=url
+		# settings of the target, updated by get()
+		self.name='default'
+		self.env=None
+		self.keep=None
+		self.labels={}
+		self.initialized=False
+		self.config_id=None
+		self.locks_checked=False
+		self.verify=False
+		# duration of the last call of each kind, number of skipped calls of each kind and the time they would have taken
+		self.durations={}
+		self.skipped={}
+		self.saved=0.0
+
+	def restic(self,kind,args):
+		started=time.monotonic()
+		try:
+			return subprocess.run(['restic']+args,stdout=subprocess.PIPE,stderr=subprocess.PIPE,env=self.env,check=True).stdout.decode()
+		finally:
+			self.durations[kind]=time.monotonic()-started
+
+	def skip(self,kind,estimate=None):
+		'''
+		Counts a call that was not necessary. Its duration is estimated from the last call of the same kind (or of the kind
+		estimate, if it never ran).
+		'''
+		self.skipped[kind]=self.skipped.get(kind,0)+1
+		self.saved+=self.durations.get(kind,self.durations.get(estimate,0))
+
+	def begin_job(self):
+		# other hosts may have left stale locks since the last job
+		self.locks_checked=False
+
+	def command_failed(self):
+		self.locks_checked=False
+		self.verify=True
+
+	def read_config_id(self):
+		try:
+			return json.loads(self.restic('config',['cat','config']))['id']
+		except (subprocess.CalledProcessError,ValueError,KeyError,TypeError):
+			return None
+
+	def ensure_initialized(self,init):
+		'''
+		Makes sure the repository exists, using init (the function running "restic init", returns False on failure) only if
+		it does not. Returns False if the repository could not be initialized.
+		'''
+		if self.initialized and not self.verify:
+			self.skip('init','config')
+			return True
+		config_id=self.read_config_id()
+		if config_id is None:
+			started=time.monotonic()
+			ok=init()
+			self.durations['init']=time.monotonic()-started
+			if not ok:
+				return False
+			config_id=self.read_config_id()
+		else:
+			log.info('Repository exists (config id %s)'%config_id)
+		if self.config_id is not None and config_id!=self.config_id:
+			log.warning('Repository was replaced (config id %s, before %s)'%(config_id,self.config_id))
+		self.config_id=config_id
+		self.initialized=True
+		self.verify=False
+		return True
+
+	def ensure_unlocked(self):
+		'''
+		Removes stale locks if there are any. Raises subprocess.CalledProcessError if restic fails.
+		'''
+		if self.locks_checked:
+			self.skip('unlock','locks')
+			return
+		try:
+			locks=self.restic('locks',['list','locks','--no-lock']).split()
+			if locks:
+				log.info('Found %s lock(s), unlocking repository'%len(locks))
+				self.restic('unlock',['unlock'])
+			else:
+				log.info('Repository is not locked')
+		except subprocess.CalledProcessError as e:
+			log.error('Unlocking repository failed: %s'%e.stderr.decode(errors='replace').strip())
+			raise
+		self.locks_checked=True
+
+	def report(self):
+		'''
+		Logs and exports the skipped calls.
+		'''
+		for kind,count in sorted(self.skipped.items()):
+			metrics.set_gauge('repository_calls_skipped',dict(self.labels,call=kind),count)
+		metrics.set_gauge('repository_time_saved_seconds',self.labels,self.saved)
+		if self.skipped:
+			log.info('Repository calls skipped since start%s: %s (about %.1fs saved)'%(' (%s)'%self.name if self.labels else '',
+				', '.join(['%s: %s'%(kind,count) for kind,count in sorted(self.skipped.items())]),self.saved))
+
+_repositories={}
+
+def get(url,name='default',env=None,keep=None,labels=None):
+	'''
+	Returns the state of the repository url, which lives as long as the process, with the current settings of its target
+	(they may change when the config is reloaded): env is the environment of restic commands (None to inherit it),
+	keep the retention and labels are added to the metrics of the target.
+	'''
+	if url not in _repositories:
+		_repositories[url]=Repository(url)
+	repo=_repositories[url]
+	repo.name=name
+	repo.env=env
+	repo.keep=keep
+	repo.labels=labels or {}
+	return repo
+
+def all_repositories():
+	return list(_repositories.values())
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import json
+import logging as log
+import os.path
+import re
+import subprocess
+import threading
+import time
+import workerpool
+from datetime import datetime
+
+# default number of seconds between two progress lines of a running backup
+DEFAULT_PROGRESS_INTERVAL=60
+
+# last status message of each running backup by target name (for status reports)
+_progress={}
+_progress_lock=threading.Lock()
+
+def current_progress():
+	with _progress_lock:
+		return dict(_progress)
+
+def set_progress(target,status):
+	with _progress_lock:
+		if status is None:
+			_progress.pop(target,None)
+		else:
+			_progress[target]=status
+
+def watch_cancel(proc,cancel,poll_interval=0.5):
+	while proc.poll() is None:
+		if cancel.is_set():
+			workerpool.kill_process_group(proc)
+			return
+		time.sleep(poll_interval)
+
+def format_bytes(size):
+	for unit in ['B','KiB','MiB','GiB','TiB']:
+		if abs(size)<1024 or unit=='TiB':
+			return ('%d %s' if unit=='B' else '%.1f %s')%(size,unit)
+		size/=1024
+
+def format_duration(seconds):
+	seconds=int(seconds)
+	return '%d:%02d:%02d'%(seconds//3600,seconds//60%60,seconds%60)
+
+def format_progress(status):
+	elapsed=status.get('seconds_elapsed',0)
+	line='Backup progress: %.1f%%, %s/%s files, %s/%s'%(
+		status.get('percent_done',0)*100,
+		status.get('files_done',0),status.get('total_files',0),
+		format_bytes(status.get('bytes_done',0)),format_bytes(status.get('total_bytes',0)))
+	if elapsed:
+		line+=', %s/s'%format_bytes(status.get('bytes_done',0)/elapsed)
+	if status.get('seconds_remaining'):
+		line+=', ETA %s'%format_duration(status['seconds_remaining'])
+	if status.get('error_count'):
+		line+=', %s errors'%status['error_count']
+	return line
+
+def format_summary(summary):
+	'''
+	Returns a human readable summary (several lines) for logs and notifications.
+	'''
+	if 'snapshot_id' not in summary:
+		return 'No backup summary (exit code %s)'%summary['exit_code']
+	duration=summary.get('total_duration',0)
+	lines=[
+		'Snapshot: %s'%summary['snapshot_id'],
+		'Files: %s new, %s changed, %s unmodified'%(summary.get('files_new',0),summary.get('files_changed',0),summary.get('files_unmodified',0)),
+		'Dirs: %s new, %s changed, %s unmodified'%(summary.get('dirs_new',0),summary.get('dirs_changed',0),summary.get('dirs_unmodified',0)),
+		'Data added: %s (%s stored)'%(format_bytes(summary.get('data_added',0)),format_bytes(summary.get('data_added_packed',summary.get('data_added',0)))),
+		'Processed: %s files, %s in %s (%s/s)'%(summary.get('total_files_processed',0),format_bytes(summary.get('total_bytes_processed',0)),
+			format_duration(duration),format_bytes(summary.get('total_bytes_processed',0)/duration if duration else 0)),
+	]
+	if 'data_added_by_path' in summary:
+		added=summary['data_added_by_path']
+		lines.append('Data added by folder: %s'%(', '.join(['%s %s'%(path,format_bytes(added[path])) for path in sorted(added)]) or 'none'))
+	return '\n'.join(lines)
+
+def parse_time(value):
+	'''
+	Parses the time of a snapshot (RFC 3339 with up to nanoseconds) into a unix timestamp. Raises ValueError if it is invalid.
+	'''
+	match=re.match(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)$',value)
+	if match is None:
+		raise ValueError('Invalid time: %s'%value)
+	zone='+00:00' if match.group(3)=='Z' else match.group(3)
+	return datetime.fromisoformat(match.group(1)+zone).timestamp()+float('0.%s'%(match.group(2) or 0))
+
+def log_messages(stream,prefix):
+	'''
+	Logs the stderr of restic. With --json, errors are json objects as well.
+	'''
+	workerpool.set_log_prefix(prefix)
+	for line in iter(stream.readline,b''):
+		line=line.decode(errors='replace').strip()
+		if not line:
+			continue
+		try:
+			message=json.loads(line)
+		except ValueError:
+			log.info('%s',line)
+			continue
+		if type(message) is dict and message.get('message_type')=='error':
+			error=message.get('error')
+			error=error.get('message',error) if type(error) is dict else error
+			log.warning('Backup error: %s%s'%(error,' (%s)'%message['item'] if message.get('item') else ''))
+		else:
+			log.info('%s',line)
+	stream.close()
+
+def top_level_path(root,item):
+	'''
+	Returns the first path component of item below root or None if item is not below root.
+	'''
+	path=os.path.relpath(item.rstrip('/'),root)
+	if path=='.' or path.startswith('..'):
+		return None
+	return path.split(os.sep)[0]
+
+def run_backup(cmd,progress_interval=DEFAULT_PROGRESS_INTERVAL,cancel=None,env=None,target='default',added_root=None):
+	'''
+	Runs a "restic backup --json" command and parses its status and summary messages while it runs.
+	A progress line is logged every progress_interval seconds (never if 0).
+	With added_root, the data added by the new and changed files (from the verbose_status messages of "restic -vv") is summed
+	up by folder below added_root as "data_added_by_path" of the summary.
+	Returns the summary message of restic as dict (empty on failure) with the exit code of restic added as "exit_code".
+	Raises workerpool.Cancelled if cancel was set while restic was running.
+	'''
+	if cancel is not None and cancel.is_set():
+		raise workerpool.Cancelled()
+	proc=subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE,env=env,start_new_session=True)
+	reader=threading.Thread(target=log_messages,args=(proc.stderr,workerpool.get_log_prefix()),daemon=True)
+	reader.start()
+	if cancel is not None:
+		threading.Thread(target=watch_cancel,args=(proc,cancel),daemon=True).start()
+	summary={}
+	added={}
+	last_progress=time.monotonic()
+	for line in iter(proc.stdout.readline,b''):
+		try:
+			message=json.loads(line)
+		except ValueError:
+			line=line.decode(errors='replace').rstrip()
+			if line:
+				log.info('%s',line)
+			continue
+		if type(message) is not dict:
+			continue
+		message_type=message.get('message_type')
+		if message_type=='status':
+			set_progress(target,message)
+			if progress_interval and time.monotonic()-last_progress>=progress_interval:
+				last_progress=time.monotonic()
+				log.info(format_progress(message))
+		elif message_type=='summary':
+			summary=message
+		elif message_type=='verbose_status' and added_root is not None and message.get('action') in ('new','modified'):
+			path=top_level_path(added_root,message.get('item',''))
+			if path is not None:
+				added[path]=added.get(path,0)+message.get('data_size_in_repo',0)
+	proc.stdout.close()
+	proc.wait()
+	reader.join(timeout=5)
+	set_progress(target,None)
+	if cancel is not None and cancel.is_set():
+		raise workerpool.Cancelled()
+	summary=dict(summary,exit_code=proc.returncode)
+	summary.pop('message_type',None)
+	if added_root is not None:
+		summary['data_added_by_path']=added
+	if 'snapshot_id' in summary:
+		for line in format_summary(summary).split('\n'):
+			log.info('Backup summary: %s'%line)
+	return summary
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+import heapq
+import logging as log
+import threading
+import time
+import workerpool
+from collections import deque
+from datetime import datetime
+
+# what happens if a lane fires while another job is running or waiting:
+# skip drops the run, queue runs it afterwards, coalesce queues it only if the lane is not already waiting
+OVERLAP_POLICIES=['skip','queue','coalesce']
+
+# the scheduler wakes up at least this often (seconds) to notice changes of the system clock
+MAX_SLEEP=60
+# a difference between elapsed wall clock and monotonic time above this (seconds) is treated as clock jump
+CLOCK_JUMP_THRESHOLD=5
+
+def next_fire_time(crontabs,after):
+	'''
+	Returns the first time (unix timestamp) after the timestamp after at which any of crontabs fires.
+	Cron expressions are matched against the local wall clock, so schedules follow DST changes: times in the gap
+	of a DST start fire right after the gap and times repeated at the end of DST fire once.
+	'''
+	result=None
+	for cron in crontabs:
+		local=datetime.fromtimestamp(after)
+		for attempt in range(3):
+			due=cron.next(local,default_utc=False,return_datetime=True)
+			if due is None:
+				break
+			timestamp=time.mktime(due.timetuple())
+			if timestamp>after:
+				if result is None or timestamp<result:
+					result=timestamp
+				break
+			# an ambiguous local time was resolved to the earlier occurrence, try the next match
+			local=due
+	return result
+
+class Lane:
+	'''
+	A kind of job (e.g. backup or prune) with its own schedule and overlap policy. Lanes without cron expressions
+	only run when triggered. The job is called with a workerpool.CancelToken and returns True on success.
+	'''
+	def __init__(self,name,crontabs,job,overlap='skip'):
+		if overlap not in OVERLAP_POLICIES:
+			raise ValueError('Invalid overlap policy: %s (allowed: %s)'%(overlap,', '.join(OVERLAP_POLICIES)))
+		self.name=name
+		self.crontabs=crontabs or []
+		self.job=job
+		self.overlap=overlap
+		self.next_run=None
+		# started, finished and result ('ok', 'failed' or 'cancelled') of the last run
+		self.last_run=None
+
+class Scheduler:
+	'''
+	Runs the jobs of several lanes at the times given by their cron expressions. A timer heap holds the next run
+	of each lane and the scheduler sleeps until the first one is due. Jobs run one at a time on a separate thread,
+	since all of them use the same repository, so a lane that fires meanwhile is handled by its overlap policy.
+	'''
+	def __init__(self):
+		self.lanes=[]
+		self.pending=deque()
+		self.running=None
+		self.running_since=None
+		self.cancel_token=None
+		self.stopped=False
+		self.condition=threading.Condition()
+
+	def add_lane(self,name,crontabs,job,overlap='skip'):
+		self.lanes.append(Lane(name,crontabs,job,overlap))
+
+	def stop(self):
+		with self.condition:
+			self.stopped=True
+			self.condition.notify_all()
+
+	def schedule(self,heap,index,after):
+		lane=self.lanes[index]
+		due=next_fire_time(lane.crontabs,after)
+		with self.condition:
+			lane.next_run=due
+		if due is None:
+			log.warning('No further %s is scheduled'%lane.name)
+			return
+		log.info('Scheduling next %s at %s'%(lane.name,datetime.fromtimestamp(due)))
+		heapq.heappush(heap,(due,index))
+
+	def run(self):
+		'''
+		Runs until stop() is called.
+		'''
+		runner=threading.Thread(target=self.run_jobs,name='scheduler-jobs',daemon=True)
+		runner.start()
+		heap=[]
+		now=time.time()
+		for index in range(len(self.lanes)):
+			if self.lanes[index].crontabs:
+				self.schedule(heap,index,now)
+		# keeps running without scheduled runs, lanes may still be triggered
+		while True:
+			with self.condition:
+				while not self.stopped:
+					now=time.time()
+					if heap and heap[0][0]<=now:
+						break
+					started=time.monotonic()
+					self.condition.wait(min(heap[0][0]-now,MAX_SLEEP) if heap else MAX_SLEEP)
+					jump=(time.time()-now)-(time.monotonic()-started)
+					if abs(jump)>CLOCK_JUMP_THRESHOLD:
+						heap=self.reschedule(heap,jump)
+				if self.stopped:
+					break
+			due,index=heapq.heappop(heap)
+			self.fire(self.lanes[index])
+			# runs missed while the machine was suspended or the clock was set forward are collapsed to one
+			self.schedule(heap,index,max(due,time.time()))
+		self.stop()
+		runner.join()
+
+	def reschedule(self,heap,jump):
+		'''
+		After a clock jump, runs that became due (clock set forward) are kept, all others are computed again from the
+		new time, so a clock set back does not delay them.
+		'''
+		log.warning('System clock jumped by %+d seconds, rescheduling'%jump)
+		now=time.time()
+		result=[]
+		for due,index in heap:
+			if due<=now:
+				heapq.heappush(result,(due,index))
+			else:
+				self.schedule(result,index,now)
+		return result
+
+	def fire(self,lane):
+		'''
+		Starts or queues a run of lane according to its overlap policy. Returns False if the run was skipped.
+		'''
+		with self.condition:
+			busy=self.running if self.running is not None else (self.pending[0] if self.pending else None)
+			if busy is not None:
+				if lane.overlap=='skip':
+					log.warning('Skipping %s, %s is still running'%(lane.name,busy.name))
+					return False
+				if lane.overlap=='coalesce' and lane in self.pending:
+					log.info('Skipping %s, it is already waiting to run'%lane.name)
+					return False
+				log.info('Queueing %s until %s is finished'%(lane.name,busy.name))
+			self.pending.append(lane)
+			self.condition.notify_all()
+			return True
+
+	def trigger(self,name):
+		'''
+		Runs the lane name now (subject to its overlap policy). Raises KeyError for unknown lanes.
+		'''
+		for lane in self.lanes:
+			if lane.name==name:
+				log.info('%s was triggered'%name)
+				return self.fire(lane)
+		raise KeyError(name)
+
+	def cancel(self):
+		'''
+		Asks the running job to stop. Returns the name of its lane or None if no job is running.
+		'''
+		with self.condition:
+			if self.running is None:
+				return None
+			log.warning('Cancelling %s'%self.running.name)
+			self.cancel_token.set()
+			return self.running.name
+
+	def status(self):
+		with self.condition:
+			return {
+				'running': None if self.running is None else {
+					'lane': self.running.name,
+					'started': self.running_since,
+					'cancelled': self.cancel_token.is_set(),
+				},
+				'pending': [lane.name for lane in self.pending],
+				'lanes': [{
+					'name': lane.name,
+					'overlap': lane.overlap,
+					'next_run': lane.next_run,
+					'last_run': lane.last_run,
+				} for lane in self.lanes],
+			}
+
+	def run_jobs(self):
+		while True:
+			with self.condition:
+				while not self.pending and not self.stopped:
+					self.condition.wait()
+				if self.stopped:
+					return
+				lane=self.pending.popleft()
+				self.running=lane
+				self.running_since=time.time()
+				self.cancel_token=workerpool.CancelToken()
+			result='failed'
+			try:
+				if lane.job(self.cancel_token):
+					result='ok'
+			except Exception:
+				log.exception('%s failed unexpectedly.'%lane.name)
+			finally:
+				with self.condition:
+					if self.cancel_token.is_set():
+						result='cancelled'
+					lane.last_run={'started': self.running_since,'finished': time.time(),'result': result}
+					self.running=None
+					self.running_since=None
+					self.cancel_token=None
+					self.condition.notify_all()
@@ -1,41 +1,183 @@
 
+import logging as log
+import queue
+import threading
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from smtplib import SMTP_SSL
+from smtplib import SMTP, SMTP_SSL, SMTPException
 
+SMTP_TLS_MODES = ["ssl", "starttls", "none"]
+SMTP_TIMEOUT = 60
+# delivery attempts after the first one fails and the delay before the first retry (doubled for each further retry)
+DEFAULT_RETRIES = 5
+DEFAULT_RETRY_DELAY = 30
+# seconds a command that exits afterwards waits for the delivery of queued mails
+DEFAULT_EXIT_TIMEOUT = 60
 
-class SMTPClient:
-
-    def __init__(self, config):
 
-        self.smtp_host = config.get("host")
-        self.smtp_username = config.get("username")
-        self.smtp_password = config.get("password")
-        self.mail_from = config.get("from")
-        self.mail_recipient = config.get("recipient")
+def smtp_settings(config):
+    '''
+    Parses the "smtp" section of the config. Returns None if the config is invalid.
+    '''
+    if type(config) is not dict:
+        log.error("Invalid smtp config: %s" % config)
+        return None
+    for key in ["host", "from", "recipient"]:
+        if key not in config:
+            log.error("'%s' is missing from 'smtp' config." % key)
+            return None
+    if ("username" in config) != ("password" in config):
+        log.error("'username' and 'password' of the 'smtp' config must be set both or not at all.")
+        return None
+    tls = config.get("tls", "ssl")
+    if tls not in SMTP_TLS_MODES:
+        log.error("Invalid smtp tls mode: %s (expected one of %s)" % (tls, ", ".join(SMTP_TLS_MODES)))
+        return None
+    try:
+        port = int(config["port"]) if "port" in config else None
+        retries = int(config.get("retries", DEFAULT_RETRIES))
+        retry_delay = float(config.get("retry-delay", DEFAULT_RETRY_DELAY))
+        exit_timeout = float(config.get("exit-timeout", DEFAULT_EXIT_TIMEOUT))
+    except ValueError:
+        log.error("Invalid smtp config: port, retries, retry-delay and exit-timeout must be numbers")
+        return None
+    return {
+        "host": config["host"],
+        "port": port,
+        "tls": tls,
+        "username": config.get("username"),
+        "password": config.get("password"),
+        "from": config["from"],
+        "recipient": config["recipient"],
+        "retries": retries,
+        "retry_delay": retry_delay,
+        "exit_timeout": exit_timeout,
+    }
 
-        assert self.smtp_host is not None, "'host' is missing from 'smtp' config."
-        assert self.smtp_username is not None, "'username' is missing from 'smtp' config."
-        assert self.smtp_password is not None, "'password' is missing from 'smtp' config."
-        assert self.mail_from is not None, "'from' is missing from 'smtp' config."
-        assert self.mail_recipient is not None, "'recipient' is missing from 'smtp' config."
 
-        self.smtp_client = SMTP_SSL(self.smtp_host)
-        self.smtp_client.login(user=self.smtp_username, password=self.smtp_password)
+class SMTPClient:
+    '''
+    Connects to the mail server only when a mail is sent and closes the connection afterwards, so no idle
+    connection is held while a backup runs.
+    '''
 
+    def __init__(self, settings):
 
-    def __del__(self):
+        self.settings = settings
 
-        self.smtp_client.close()
+    def connect(self):
 
+        host, port = self.settings["host"], self.settings["port"] or 0
+        if self.settings["tls"] == "ssl":
+            smtp = SMTP_SSL(host, port, timeout=SMTP_TIMEOUT)
+        else:
+            smtp = SMTP(host, port, timeout=SMTP_TIMEOUT)
+            if self.settings["tls"] == "starttls":
+                smtp.starttls()
+        if self.settings["username"] is not None:
+            smtp.login(user=self.settings["username"], password=self.settings["password"])
+        return smtp
 
     def send_mail(self, subject, body):
 
         message = MIMEMultipart()
-        message["From"] = self.mail_from
-        message["To"] = self.mail_recipient
+        message["From"] = self.settings["from"]
+        message["To"] = self.settings["recipient"]
         message["Subject"] = subject
 
         message.attach(MIMEText(body, "plain"))
 
-        self.smtp_client.sendmail(self.mail_from, self.mail_recipient, message.as_string())
+        smtp = self.connect()
+        try:
+            smtp.sendmail(self.settings["from"], self.settings["recipient"], message.as_string())
+        finally:
+            try:
+                smtp.quit()
+            except (SMTPException, OSError):
+                smtp.close()
+
+
+class MailQueue:
+    '''
+    Delivers mails from a background thread with retries, so callers never wait for the mail server.
+    Messages added between two flush() calls (e.g. all warnings of one backup run) are sent as one mail.
+    '''
+
+    def __init__(self, settings):
+
+        self.client = SMTPClient(settings)
+        self.retries = settings["retries"]
+        self.retry_delay = settings["retry_delay"]
+        self.exit_timeout = settings["exit_timeout"]
+        self.batch = []
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.deliver, name="mail", daemon=True)
+        self.worker.start()
+        # number of flushed batches that could not be delivered
+        self.failed = 0
+
+    def add(self, subject, body):
+
+        with self.lock:
+            self.batch.append((subject, body))
+
+    def flush(self):
+        '''
+        Hands the collected messages as one mail to the background thread. Does not block.
+        '''
+        with self.lock:
+            batch, self.batch = self.batch, []
+        if not batch:
+            return
+        if len(batch) == 1:
+            subject, body = batch[0]
+        else:
+            subject = "%s (and %s more)" % (batch[0][0], len(batch) - 1)
+            body = "\n\n".join(["%s\n%s\n%s" % (s, "=" * len(s), b) for s, b in batch])
+        self.queue.put((subject, body))
+
+    def wait(self, timeout=None):
+        '''
+        Waits until all flushed mails were delivered or given up. Returns False if one of them could not be sent
+        or the timeout passed.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    log.warning("Mail delivery did not finish in time.")
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return self.failed == 0
+
+    def deliver(self):
+
+        while True:
+            subject, body = self.queue.get()
+            try:
+                self.send(subject, body)
+            except Exception:
+                # the worker must survive, otherwise later mails are never sent and wait() blocks forever
+                log.exception("Sending notification '%s' failed unexpectedly." % subject)
+                self.failed += 1
+            finally:
+                self.queue.task_done()
+
+    def send(self, subject, body):
+
+        for attempt in range(self.retries + 1):
+            try:
+                self.client.send_mail(subject, body)
+                log.info("Sent notification: %s" % subject)
+                return
+            except (SMTPException, OSError) as e:
+                if attempt == self.retries:
+                    log.error("Sending notification '%s' failed: %s" % (subject, e))
+                    self.failed += 1
+                    return
+                delay = self.retry_delay * 2 ** attempt
+                log.warning("Sending notification '%s' failed: %s - retrying in %ss" % (subject, e, delay))
+                time.sleep(delay)
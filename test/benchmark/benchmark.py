@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+# Benchmarks run_backup of backup_client.py without database servers or a repository: the fake clients in bin/ (see
+# fakebin.py) produce synthetic dumps of a configurable size and rate and a fake restic reads them.
+# Reports wall time, CPU time (including child processes), peak RSS (of the whole process tree) and bytes written
+# (by all processes, including pipes) per phase. Phases of dump engines that run in parallel (dump-parallelism)
+# overlap, so their CPU time and bytes written are only exact if the engines run one after another.
+#
+# Usage: test/benchmark/benchmark.py [--engines mysqldump,pgdump] [--databases 4] [--size 64M] [--config extra.yaml] [--json]
+
+import argparse
+import json
+import logging as log
+import os
+import os.path
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import yaml
+
+BENCHMARK_DIR=os.path.dirname(os.path.abspath(__file__))
+REPO_DIR=os.path.dirname(os.path.dirname(BENCHMARK_DIR))
+ENGINES=['mysqldump','pgdump','mongodump','elasticdump']
+ES_PORT=19200
+
+def process_tree(root):
+	children={}
+	for entry in os.listdir('/proc'):
+		if not entry.isdigit():
+			continue
+		try:
+			with open('/proc/%s/stat'%entry) as f:
+				# the command name may contain spaces, the parent pid is the second field after it
+				ppid=int(f.read().rsplit(')',1)[1].split()[1])
+		except (OSError,IndexError,ValueError):
+			continue
+		children.setdefault(ppid,[]).append(int(entry))
+	result=[root]
+	for pid in result:
+		result+=children.get(pid,[])
+	return result
+
+def tree_rss(root):
+	page_size=os.sysconf('SC_PAGE_SIZE')
+	total=0
+	for pid in process_tree(root):
+		try:
+			with open('/proc/%s/statm'%pid) as f:
+				total+=int(f.read().split()[1])*page_size
+		except (OSError,IndexError,ValueError):
+			pass
+	return total
+
+def bytes_written():
+	'''
+	Bytes passed to write() by this process and all child processes that were waited for.
+	'''
+	with open('/proc/self/io') as f:
+		for line in f:
+			if line.startswith('wchar:'):
+				return int(line.split()[1])
+	return 0
+
+def cpu_time():
+	usage=[resource.getrusage(resource.RUSAGE_SELF),resource.getrusage(resource.RUSAGE_CHILDREN)]
+	return sum([u.ru_utime+u.ru_stime for u in usage])
+
+class PhaseRecorder:
+	def __init__(self,sample_interval):
+		self.sample_interval=sample_interval
+		self.phases=[]
+		self.peaks={}
+		self.lock=threading.Lock()
+		self.stopped=threading.Event()
+		self.sampler=threading.Thread(target=self.sample,daemon=True)
+		self.sampler.start()
+
+	def sample(self):
+		while not self.stopped.wait(self.sample_interval):
+			rss=tree_rss(os.getpid())
+			with self.lock:
+				for key in self.peaks:
+					self.peaks[key]=max(self.peaks[key],rss)
+
+	def stop(self):
+		self.stopped.set()
+		self.sampler.join()
+
+	def measure(self,name,fn,*args,**kwargs):
+		key=object()
+		with self.lock:
+			self.peaks[key]=tree_rss(os.getpid())
+		wall,cpu,written=time.monotonic(),cpu_time(),bytes_written()
+		try:
+			return fn(*args,**kwargs)
+		finally:
+			with self.lock:
+				peak=self.peaks.pop(key)
+			self.phases.append({
+				'phase': name,
+				'wall': time.monotonic()-wall,
+				'cpu': cpu_time()-cpu,
+				'peak_rss': peak,
+				'written': bytes_written()-written,
+			})
+
+	def wrap(self,name,fn):
+		def run(*args,**kwargs):
+			return self.measure(name(*args) if callable(name) else name,fn,*args,**kwargs)
+		return run
+
+def benchmark_config(engines,extra_config):
+	config={
+		'keep': {'last': 1},
+		'pre-backup-scripts': [{'script': 'true','description': 'benchmark'}],
+		'progress-interval': 0,
+	}
+	for engine in engines:
+		if engine=='elasticdump':
+			config[engine]={'url': 'http://127.0.0.1:%s'%ES_PORT}
+		else:
+			config[engine]={'host': 'localhost','username': 'bench','password': 'bench'}
+	for key,value in (extra_config or {}).items():
+		if type(value) is dict and type(config.get(key)) is dict:
+			config[key]=dict(config[key],**value)
+		else:
+			config[key]=value
+	return config
+
+def instrument(recorder):
+	import backup_client
+	import resticjson
+	backup_client.init_restic_repo=recorder.wrap('init',backup_client.init_restic_repo)
+	backup_client.run_pre_backup_script=recorder.wrap('pre_backup_script',backup_client.run_pre_backup_script)
+	backup_client.run_dump=recorder.wrap(lambda title,*args: 'dump %s'%title.lower(),backup_client.run_dump)
+	resticjson.run_backup=recorder.wrap('backup',resticjson.run_backup)
+	backup_client.forget_target=recorder.wrap('forget',backup_client.forget_target)
+	backup_client.prune_target=recorder.wrap('prune',backup_client.prune_target)
+	return backup_client
+
+def format_size(size):
+	return '%.1f'%(size/1024/1024)
+
+def print_report(phases,dump_size):
+	print('%-24s %10s %10s %14s %14s'%('phase','wall s','cpu s','peak rss MiB','written MiB'))
+	for phase in phases:
+		print('%-24s %10.2f %10.2f %14s %14s'%(phase['phase'],phase['wall'],phase['cpu'],format_size(phase['peak_rss']),format_size(phase['written'])))
+	print('dump output: %s MiB'%format_size(dump_size))
+
+def directory_size(path):
+	total=0
+	for root,dirs,files in os.walk(path):
+		for filename in files:
+			total+=os.path.getsize(os.path.join(root,filename))
+	return total
+
+def main():
+	parser=argparse.ArgumentParser(description='Benchmark run_backup with fake database clients and restic.')
+	parser.add_argument('--engines',type=str,default='mysqldump,pgdump,mongodump',help='Comma separated dump engines (%s)'%', '.join(ENGINES))
+	parser.add_argument('--databases',type=int,default=4,help='Databases (or indices) per engine')
+	parser.add_argument('--size',type=str,default='64M',help='Dump size per database (e.g. 512K, 64M, 1G)')
+	parser.add_argument('--dump-rate',type=str,default='0',help='Bytes per second of each dump process (0: unlimited)')
+	parser.add_argument('--restic-rate',type=str,default='0',help='Bytes per second restic reads (0: unlimited)')
+	parser.add_argument('--config',type=str,help='YAML file merged into the generated backup config (e.g. compression, parallelism)')
+	parser.add_argument('--sample-interval',type=float,default=0.05,help='Seconds between RSS samples')
+	parser.add_argument('--json',action='store_true',help='Print the results as json')
+	parser.add_argument('-v','--verbose',action='store_true',help='Show the log of the backup')
+	args=parser.parse_args()
+
+	engines=[engine for engine in args.engines.split(',') if engine]
+	for engine in engines:
+		if engine not in ENGINES:
+			parser.error('Unknown engine: %s'%engine)
+	extra_config=None
+	if args.config:
+		with open(args.config) as f:
+			extra_config=yaml.safe_load(f)
+
+	log.basicConfig(level=log.INFO if args.verbose else log.WARNING,format='%(asctime)s %(levelname)7s: %(message)s')
+	workdir=tempfile.mkdtemp(prefix='restic-benchmark')
+	es_server=None
+	try:
+		with open(os.path.join(workdir,'config.yaml'),'w') as f:
+			yaml.safe_dump(benchmark_config(engines,extra_config),f)
+		os.mkdir(os.path.join(workdir,'backup'))
+		os.environ.update({
+			'PATH': '%s:%s'%(os.path.join(BENCHMARK_DIR,'bin'),os.environ.get('PATH','')),
+			'BACKUP_ROOT': os.path.join(workdir,'backup'),
+			'BACKUP_CONFIG': os.path.join(workdir,'config.yaml'),
+			'BACKUP_HOSTNAME': 'benchmark',
+			'RESTIC_REPOSITORY': os.path.join(workdir,'repository'),
+			'RESTIC_PASSWORD': 'benchmark',
+			'RESTIC_PRUNE_TIMEOUT': '0s',
+			'BENCH_DATABASES': str(args.databases),
+			'BENCH_DUMP_BYTES': args.size,
+			'BENCH_DUMP_RATE': args.dump_rate,
+			'BENCH_RESTIC_RATE': args.restic_rate,
+		})
+		if 'elasticdump' in engines:
+			es_server=subprocess.Popen([sys.executable,os.path.join(REPO_DIR,'test','stubs','es_standin.py'),str(ES_PORT)],
+				env=dict(os.environ,STUB_ES_INDICES=' '.join(['bench%s'%i for i in range(args.databases)])))
+			time.sleep(0.5)
+
+		sys.path.insert(0,REPO_DIR)
+		recorder=PhaseRecorder(args.sample_interval)
+		backup_client=instrument(recorder)
+		ok=recorder.measure('total',backup_client.run_backup,True)
+		recorder.stop()
+		dump_size=directory_size(os.path.join(workdir,'backup'))
+	finally:
+		if es_server is not None:
+			es_server.terminate()
+			es_server.wait()
+		shutil.rmtree(workdir,ignore_errors=True)
+
+	if args.json:
+		print(json.dumps({'ok': bool(ok),'phases': recorder.phases,'dump_output': dump_size},indent=1))
+	else:
+		print_report(recorder.phases,dump_size)
+	if not ok:
+		print('Backup failed.',file=sys.stderr)
+		quit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+# Fake database clients and restic for test/benchmark/benchmark.py. The links in bin/ (mysqlshow, mysqldump, psql, pg_dump,
+# mongodump, elasticdump, restic) point to this script, which acts depending on the name it was called with.
+# Dumps are synthetic data of BENCH_DUMP_BYTES per database, written at BENCH_DUMP_RATE bytes/s (0: unlimited).
+# restic reads and hashes its input at BENCH_RESTIC_RATE bytes/s (0: unlimited). There are BENCH_DATABASES databases.
+
+import hashlib
+import json
+import os
+import os.path
+import random
+import sys
+import time
+
+BLOCK_SIZE=64*1024
+
+def env_size(name,default):
+	'''
+	Parses sizes like 512, 64K, 256M or 2G from the environment.
+	'''
+	value=os.environ.get(name,default).strip().upper()
+	factor=1
+	if value and value[-1] in 'KMGT':
+		factor=1024**('KMGT'.index(value[-1])+1)
+		value=value[:-1]
+	return int(float(value)*factor)
+
+DATABASES=['bench%s'%i for i in range(int(os.environ.get('BENCH_DATABASES','4')))]
+DUMP_BYTES=env_size('BENCH_DUMP_BYTES','64M')
+DUMP_RATE=env_size('BENCH_DUMP_RATE','0')
+RESTIC_RATE=env_size('BENCH_RESTIC_RATE','0')
+
+class Throttle:
+	'''
+	Sleeps whenever more than rate bytes per second were passed through.
+	'''
+	def __init__(self,rate):
+		self.rate=rate
+		self.started=time.monotonic()
+		self.total=0
+
+	def add(self,size):
+		self.total+=size
+		if self.rate:
+			ahead=self.total/self.rate-(time.monotonic()-self.started)
+			if ahead>0:
+				time.sleep(ahead)
+
+def synthetic_blocks():
+	'''
+	A few blocks of SQL-like rows with random values (about as compressible as real dumps), repeated in random order.
+	'''
+	rng=random.Random(42)
+	blocks=[]
+	for i in range(16):
+		rows=[]
+		size=0
+		while size<BLOCK_SIZE:
+			row="(%s,'%s',%s,'%s'),\n"%(rng.randrange(10**9),rng.randbytes(12).hex(),rng.random(),rng.choice(['alpha','beta','gamma','delta']))
+			rows.append(row)
+			size+=len(row)
+		blocks.append(''.join(rows).encode()[:BLOCK_SIZE])
+	while True:
+		yield rng.choice(blocks)
+
+def write_data(out,size,prefix=b'',suffix=b''):
+	throttle=Throttle(DUMP_RATE)
+	out.write(prefix)
+	remaining=size
+	for block in synthetic_blocks():
+		if remaining<=0:
+			break
+		block=block[:remaining]
+		out.write(block)
+		remaining-=len(block)
+		throttle.add(len(block))
+	out.write(suffix)
+	out.flush()
+
+def write_file(path,size,prefix=b'',suffix=b''):
+	os.makedirs(os.path.dirname(path),exist_ok=True)
+	with open(path,'wb') as f:
+		write_data(f,size,prefix,suffix)
+
+def option(args,name,default=None):
+	for i,arg in enumerate(args):
+		if arg.startswith(name+'='):
+			return arg[len(name)+1:]
+		if arg==name and i+1<len(args):
+			return args[i+1]
+	return default
+
+def mysqlshow(args):
+	print('+--------------------+')
+	print('|     Databases      |')
+	print('+--------------------+')
+	for database in DATABASES:
+		print('| %s |'%database)
+	print('+--------------------+')
+
+def mysqldump(args):
+	database=args[-1]
+	header=b'-- MySQL dump (benchmark)\n/*!40101 SET @OLD_CHARACTER_SET_CLIENT=@@CHARACTER_SET_CLIENT */;\n\n'
+	if '--databases' in args:
+		header+=(b'--\n-- Current Database: `%s`\n--\n\n/*!40000 DROP DATABASE IF EXISTS `%s`*/;\n\n'
+			b'CREATE DATABASE /*!32312 IF NOT EXISTS*/ `%s`;\n\nUSE `%s`;\n\n')%((database.encode(),)*4)
+	size=0 if '--no-data' in args else DUMP_BYTES
+	write_data(sys.stdout.buffer,size,header+b'CREATE TABLE `t` (`id` int, `v` text, `f` double, `c` text);\nINSERT INTO `t` VALUES\n',
+		b'(0,\'\',0,\'\');\n/*!40101 SET CHARACTER_SET_CLIENT=@OLD_CHARACTER_SET_CLIENT */;\n\n-- Dump completed\n')
+
+def psql(args):
+	for database in DATABASES:
+		print(' %s | postgres | UTF8 | C | C | '%database)
+
+def pg_dump(args):
+	target=option(args,'--file')
+	if target is not None:
+		write_file(os.path.join(target,'3000.dat'),DUMP_BYTES)
+		write_file(os.path.join(target,'toc.dat'),1024)
+		return
+	write_data(sys.stdout.buffer,DUMP_BYTES,b'-- PostgreSQL database dump (benchmark)\nCOPY t (id, v, f, c) FROM stdin;\n',b'\\.\n')
+
+def mongodump(args):
+	database=option(args,'--db')
+	if '--archive' in args:
+		write_data(sys.stdout.buffer,DUMP_BYTES*(1 if database else len(DATABASES)))
+		return
+	out=option(args,'--out','dump')
+	for name in [database] if database else DATABASES:
+		write_file(os.path.join(out,name,'collection.bson'),DUMP_BYTES)
+
+def elasticdump(args):
+	output=option(args,'--output')
+	size=DUMP_BYTES if option(args,'--type')=='data' else 1024
+	if output=='$':
+		write_data(sys.stdout.buffer,size)
+	else:
+		write_file(output,size)
+
+def restic_read(stream,throttle,digest):
+	total=0
+	for block in iter(lambda: stream.read(1024*1024),b''):
+		digest.update(block)
+		total+=len(block)
+		throttle.add(len(block))
+	return total
+
+def restic(args):
+	if not args or args[0]!='backup':
+		if args and args[0]=='init':
+			print('created restic repository 0000000000 at benchmark')
+		elif args[:2]==['cat','config']:
+			print(json.dumps({'version': 2,'id': '0000000000','chunker_polynomial': '3dea92648f6e83'}))
+		return
+	started=time.monotonic()
+	throttle=Throttle(RESTIC_RATE)
+	digest=hashlib.sha256()
+	total=0
+	files=0
+	if '--stdin' in args:
+		total=restic_read(sys.stdin.buffer,throttle,digest)
+		files=1
+	else:
+		paths=[arg for i,arg in enumerate(args) if not arg.startswith('-') and i>0 and not args[i-1] in ('--host','--tag','--cache-dir','--files-from','--exclude')]
+		for path in paths:
+			for root,dirs,filenames in os.walk(path):
+				for filename in filenames:
+					with open(os.path.join(root,filename),'rb') as f:
+						total+=restic_read(f,throttle,digest)
+					files+=1
+	if '--json' in args:
+		print(json.dumps({
+			'message_type': 'summary',
+			'files_new': files,
+			'files_changed': 0,
+			'files_unmodified': 0,
+			'dirs_new': 0,
+			'dirs_changed': 0,
+			'dirs_unmodified': 0,
+			'data_added': total,
+			'total_files_processed': files,
+			'total_bytes_processed': total,
+			'total_duration': time.monotonic()-started,
+			'snapshot_id': digest.hexdigest()[:8],
+		}))
+
+COMMANDS={
+	'mysqlshow': mysqlshow,
+	'mysqldump': mysqldump,
+	'psql': psql,
+	'pg_dump': pg_dump,
+	'mongodump': mongodump,
+	'elasticdump': elasticdump,
+	'restic': restic,
+}
+
+if __name__ == '__main__':
+	COMMANDS[os.path.basename(sys.argv[0])](sys.argv[1:])
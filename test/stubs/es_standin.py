@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Minimal stand-in for the elasticsearch REST API used by elasticdump.py (listing, stats, alias, mapping,
+# point in time + search_after and sliced scroll). Serves STUB_ES_INDICES (default: "logs-1 logs-2")
+# with STUB_ES_DOCS (default: 2500) documents each. Without point in time support if STUB_ES_NO_PIT is set.
+# Reports STUB_ES_VERSION (default: 8.11.0) and rejects the _shard_doc sort before 7.12, like elasticsearch.
+# Usage: es_standin.py <port>
+
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, unquote
+
+INDICES=os.environ.get('STUB_ES_INDICES','logs-1 logs-2').split()
+DOCS=int(os.environ.get('STUB_ES_DOCS','2500'))
+NO_PIT='STUB_ES_NO_PIT' in os.environ
+VERSION=os.environ.get('STUB_ES_VERSION','8.11.0')
+SHARD_DOC=tuple([int(part) for part in VERSION.split('.')[:2]])>=(7,12)
+
+contexts={}
+contexts_lock=threading.Lock()
+
+def documents(index,slice_spec,after):
+	slice_id,slice_max=(slice_spec['id'],slice_spec['max']) if slice_spec else (0,1)
+	for i in range(DOCS):
+		if i%slice_max==slice_id and (after is None or i>after):
+			yield i,{'_index': index,'_id': str(i),'_score': None,'_source': {'message': 'document %s of %s'%(i,index)}}
+
+def page(index,slice_spec,after,size):
+	hits=[]
+	for i,hit in documents(index,slice_spec,after):
+		hit=dict(hit,sort=[i])
+		hits.append(hit)
+		if len(hits)>=size:
+			break
+	return hits
+
+class Handler(BaseHTTPRequestHandler):
+	def log_message(self,format,*args):
+		pass
+
+	def reply(self,body,status=200):
+		data=json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header('Content-Type','application/json')
+		self.send_header('Content-Length',str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def body(self):
+		length=int(self.headers.get('Content-Length') or 0)
+		return json.loads(self.rfile.read(length)) if length else {}
+
+	def do_GET(self):
+		parts=[unquote(p) for p in urlparse(self.path).path.strip('/').split('/')]
+		if parts==['']:
+			return self.reply({'version': {'number': VERSION}})
+		if parts==['_cat','indices']:
+			return self.reply([{'index': index} for index in INDICES])
+		if parts[0]=='_stats':
+			return self.reply({'indices': {index: {
+				'primaries': {'docs': {'count': DOCS},'store': {'size_in_bytes': DOCS*100}},
+				'shards': {'0': [{'routing': {'primary': True},'seq_no': {'max_seq_no': DOCS-1}}]},
+			} for index in INDICES}})
+		if len(parts)==2 and parts[0] in INDICES and parts[1]=='_alias':
+			return self.reply({parts[0]: {'aliases': {}}})
+		if len(parts)==2 and parts[0] in INDICES and parts[1]=='_mapping':
+			return self.reply({parts[0]: {'mappings': {'properties': {'message': {'type': 'text'}}}}})
+		self.reply({'error': 'not found'},404)
+
+	def do_POST(self):
+		url=urlparse(self.path)
+		parts=[unquote(p) for p in url.path.strip('/').split('/')]
+		body=self.body()
+		if len(parts)==2 and parts[0] in INDICES and parts[1]=='_pit' and not NO_PIT:
+			with contexts_lock:
+				context_id='pit-%s'%len(contexts)
+				contexts[context_id]={'index': parts[0]}
+			return self.reply({'id': context_id})
+		if parts==['_search'] and 'pit' in body:
+			if not SHARD_DOC and '_shard_doc' in json.dumps(body.get('sort')):
+				return self.reply({'error': 'No mapping found for [_shard_doc] in order to sort on'},400)
+			index=contexts[body['pit']['id']]['index']
+			after=body['search_after'][0] if 'search_after' in body else None
+			hits=page(index,body.get('slice'),after,body['size'])
+			return self.reply({'pit_id': body['pit']['id'],'hits': {'hits': hits}})
+		if len(parts)==2 and parts[0] in INDICES and parts[1]=='_search' and 'scroll' in url.query:
+			hits=page(parts[0],body.get('slice'),None,body['size'])
+			with contexts_lock:
+				context_id='scroll-%s'%len(contexts)
+				contexts[context_id]={'index': parts[0],'slice': body.get('slice'),'size': body['size'],
+					'after': hits[-1]['sort'][0] if hits else DOCS}
+			return self.reply({'_scroll_id': context_id,'hits': {'hits': hits}})
+		if parts==['_search','scroll']:
+			context=contexts[body['scroll_id']]
+			hits=page(context['index'],context['slice'],context['after'],context['size'])
+			if hits:
+				context['after']=hits[-1]['sort'][0]
+			return self.reply({'_scroll_id': body['scroll_id'],'hits': {'hits': hits}})
+		self.reply({'error': 'not found'},404)
+
+	def do_DELETE(self):
+		self.body()
+		self.reply({'succeeded': True})
+
+if __name__ == '__main__':
+	ThreadingHTTPServer(('127.0.0.1',int(sys.argv[1])),Handler).serve_forever()
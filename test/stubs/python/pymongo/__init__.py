@@ -0,0 +1,25 @@
+# Stub for pymongo: lists STUB_MONGO_DATABASES (and local) and appends the connection arguments to STUB_PYMONGO_LOG.
+# With STUB_PYMONGO_MISSING set, the import fails like without pymongo, so the mongo shell is used.
+import os
+
+if os.environ.get('STUB_PYMONGO_MISSING'):
+	raise ImportError('No module named pymongo')
+
+from pymongo import errors
+
+version='stub'
+
+class MongoClient:
+	def __init__(self,host,port,username=None,password=None,authSource=None):
+		if 'STUB_PYMONGO_LOG' in os.environ:
+			with open(os.environ['STUB_PYMONGO_LOG'],'a') as f:
+				f.write('%s %s %s %s\n'%(host,port,username,authSource))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*args):
+		return False
+
+	def list_database_names(self):
+		return os.environ.get('STUB_MONGO_DATABASES','').split()+['local']
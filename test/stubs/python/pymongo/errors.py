@@ -0,0 +1,2 @@
+class PyMongoError(Exception):
+	pass
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# Minimal plain-text SMTP server for the notification tests (no TLS, any AUTH PLAIN/LOGIN is accepted).
+# Every received mail is written to STUB_SMTP_DIR (default: current directory) as mail-<n>.eml.
+# The first STUB_SMTP_FAIL (default: 0) connections are rejected with "421", so retries can be tested.
+# Usage: smtp_standin.py <port>
+
+import os
+import socketserver
+import sys
+import threading
+
+MAIL_DIR=os.environ.get('STUB_SMTP_DIR','.')
+FAIL=int(os.environ.get('STUB_SMTP_FAIL','0'))
+
+counter_lock=threading.Lock()
+counters={'connections': 0,'mails': 0}
+
+def count(name):
+	with counter_lock:
+		counters[name]+=1
+		return counters[name]
+
+class Handler(socketserver.StreamRequestHandler):
+	def reply(self,line):
+		self.wfile.write((line+'\r\n').encode())
+
+	def handle(self):
+		if count('connections')<=FAIL:
+			self.reply('421 stub: service not available')
+			return
+		self.reply('220 stub ESMTP')
+		for line in iter(self.rfile.readline,b''):
+			command=line.decode(errors='replace').strip()
+			verb=command.split(' ')[0].upper()
+			if verb=='EHLO':
+				self.reply('250-stub')
+				self.reply('250 AUTH PLAIN LOGIN')
+			elif verb=='AUTH':
+				if command.upper()=='AUTH LOGIN':
+					self.reply('334 VXNlcm5hbWU6')
+					self.rfile.readline()
+					self.reply('334 UGFzc3dvcmQ6')
+					self.rfile.readline()
+				self.reply('235 authenticated')
+			elif verb=='DATA':
+				self.reply('354 end with .')
+				lines=[]
+				for data in iter(self.rfile.readline,b''):
+					if data in (b'.\r\n',b'.\n'):
+						break
+					lines.append(data[1:] if data.startswith(b'..') else data)
+				with open(os.path.join(MAIL_DIR,'mail-%s.eml'%count('mails')),'wb') as f:
+					f.writelines(lines)
+				self.reply('250 queued')
+			elif verb=='QUIT':
+				self.reply('221 bye')
+				return
+			else:
+				# HELO, MAIL, RCPT, RSET and NOOP
+				self.reply('250 ok')
+
+class Server(socketserver.ThreadingTCPServer):
+	allow_reuse_address=True
+	daemon_threads=True
+
+if __name__ == '__main__':
+	Server(('127.0.0.1',int(sys.argv[1])),Handler).serve_forever()
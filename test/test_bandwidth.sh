@@ -0,0 +1,67 @@
+#!/bin/bash
+# Checks the bandwidth schedule: restic commands get the limits of the time they start and a backup that runs into
+# a change of the limits is restarted with the new ones. Uses the stubs in test/stubs.
+
+set -e
+
+cd "$(dirname "$0")/.."
+
+WORKDIR=$(mktemp -d)
+trap "rm -rf ${WORKDIR}" EXIT
+
+export PATH="$(pwd)/test/stubs:${PATH}"
+export STUB_RESTIC_DIR=${WORKDIR}/restic
+export STUB_RESTIC_BACKUP_DELAY=5
+export RESTIC_REPOSITORY=stub
+export RESTIC_PASSWORD=guest
+export RESTIC_PRUNE_TIMEOUT=12h
+export BACKUP_HOSTNAME=restic_host
+export BACKUP_ROOT=${WORKDIR}/backup
+export BACKUP_CONFIG=${WORKDIR}/config.yaml
+mkdir ${BACKUP_ROOT}
+echo "data" > ${BACKUP_ROOT}/file
+
+fail() {
+	cat ${WORKDIR}/client.log
+	echo "$1"
+	echo "Test failed."
+	exit 1
+}
+
+# the "office" window ends 3 seconds after the start, while the first backup is still running
+cat > ${WORKDIR}/config.yaml <<CONFIG
+keep:
+  last: 1
+progress-interval: 0
+bandwidth:
+  upload: 10M
+  schedule:
+    - name: office
+      from: "$(date +%H:%M:%S)"
+      to: "$(date -d '+3 seconds' +%H:%M:%S)"
+      upload: 1M
+      download: 512K
+CONFIG
+
+python3 backup_client.py run > ${WORKDIR}/client.log 2>&1 || fail "Backup failed"
+
+grep -q "Bandwidth: restic backup limited to upload 1.0 MiB/s, download 512.0 KiB/s (office)" ${WORKDIR}/client.log ||
+	fail "Backup was not limited by the office window"
+grep -q "Bandwidth: limits changed at .*, restarting backup" ${WORKDIR}/client.log || fail "Backup was not restarted"
+[ $(grep -c "^backup" ${STUB_RESTIC_DIR}/calls.log) -eq 2 ] || fail "Expected two backup calls"
+grep -q "^backup --limit-upload 1024 --limit-download 512 --json" ${STUB_RESTIC_DIR}/calls.log || fail "First backup without office limits"
+grep -q "^backup --limit-upload 10240 --json" ${STUB_RESTIC_DIR}/calls.log || fail "Restarted backup without default limits"
+grep -q "Backup summary: Snapshot: 0123abcd" ${WORKDIR}/client.log || fail "Restarted backup did not finish"
+grep -q "^forget --keep-last 1 --limit-upload 10240" ${STUB_RESTIC_DIR}/calls.log || fail "Forget was not limited"
+grep -q "^prune .*--limit-upload 10240" ${STUB_RESTIC_DIR}/calls.log || fail "Prune was not limited"
+
+# unquoted times are read as numbers by yaml
+sed -i 's/from: ".*"/from: 8:00/' ${WORKDIR}/config.yaml
+if python3 backup_client.py run > ${WORKDIR}/client.log 2>&1; then
+	fail "Invalid bandwidth config was accepted"
+fi
+grep -q "times must be quoted" ${WORKDIR}/client.log || fail "Missing error for unquoted time"
+
+echo "Test succeeded."
+
+exit 0
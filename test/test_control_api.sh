@@ -0,0 +1,77 @@
+#!/bin/bash
+# Checks the control API of the schedule mode: triggering, status with progress and cancelling a running backup.
+# Uses the stub binaries in test/stubs and a unix socket, so neither restic nor a network port is required.
+
+set -e
+
+cd "$(dirname "$0")/.."
+
+WORKDIR=$(mktemp -d)
+SOCKET=${WORKDIR}/control.sock
+CLIENT_PID=""
+trap '[ -n "${CLIENT_PID}" ] && kill ${CLIENT_PID}; rm -rf ${WORKDIR}' EXIT
+
+cat > ${WORKDIR}/config.yaml <<CONFIG
+keep:
+  last: 1
+progress-interval: 0
+control:
+  listen: ${SOCKET}
+CONFIG
+
+export PATH="$(pwd)/test/stubs:${PATH}"
+export STUB_RESTIC_DIR=${WORKDIR}/restic
+export STUB_RESTIC_BACKUP_DELAY=30
+export RESTIC_REPOSITORY=stub
+export RESTIC_PASSWORD=guest
+export RESTIC_PRUNE_TIMEOUT=12h
+export BACKUP_HOSTNAME=restic_host
+export BACKUP_ROOT=${WORKDIR}/backup
+export BACKUP_CONFIG=${WORKDIR}/config.yaml
+mkdir ${BACKUP_ROOT}
+
+api() {
+	curl -s --unix-socket ${SOCKET} "$@"
+}
+
+fail() {
+	cat ${WORKDIR}/client.log
+	echo "$1"
+	echo "Test failed."
+	exit 1
+}
+
+# never scheduled during the test
+python3 backup_client.py schedule "0 0 1 1 *" > ${WORKDIR}/client.log 2>&1 &
+CLIENT_PID=$!
+for i in $(seq 50); do
+	[ -S ${SOCKET} ] && break
+	sleep 0.1
+done
+
+[ "$(api -o /dev/null -w '%{http_code}' -X POST http://localhost/cancel)" == 409 ] || fail "Cancel without running job did not fail"
+[ "$(api -o /dev/null -w '%{http_code}' -X POST http://localhost/run)" == 202 ] || fail "Run was not started"
+sleep 2
+
+STATUS=$(api http://localhost/status)
+echo "${STATUS}" | grep -q '"lane": "backup"' || fail "Status does not show the running backup: ${STATUS}"
+echo "${STATUS}" | grep -q '"percent_done": 0.5' || fail "Status does not show the backup progress: ${STATUS}"
+[ "$(api -o /dev/null -w '%{http_code}' -X POST http://localhost/prune)" == 409 ] || fail "Prune was not skipped while the backup runs"
+
+api -X POST http://localhost/cancel | grep -q '"cancelled": "backup"' || fail "Backup was not cancelled"
+for i in $(seq 50); do
+	api http://localhost/status | grep -q '"running": null' && break
+	sleep 0.1
+done
+api http://localhost/status | grep -q '"result": "cancelled"' || fail "Cancelled backup is still running: $(api http://localhost/status)"
+
+[ "$(api -o /dev/null -w '%{http_code}' -X POST http://localhost/rotate)" == 202 ] || fail "Rotate was not started"
+for i in $(seq 50); do
+	grep -q "^forget" ${STUB_RESTIC_DIR}/calls.log && break
+	sleep 0.1
+done
+grep -q "^forget --keep-last 1" ${STUB_RESTIC_DIR}/calls.log || fail "Rotate did not run restic forget"
+
+echo "Test succeeded."
+
+exit 0
@@ -0,0 +1,83 @@
+#!/bin/bash
+# Checks the dedupe friendly mysql layout (one uncompressed file per table with rows ordered by primary key) and the report
+# of the data each folder added to the repository. Uses the stub binaries in test/stubs.
+
+set -e
+
+cd "$(dirname "$0")/.."
+
+WORKDIR=$(mktemp -d)
+trap "rm -rf ${WORKDIR}" EXIT
+
+cat > ${WORKDIR}/config.yaml <<CONFIG
+keep:
+  last: 1
+progress-interval: 0
+report-data-added: true
+metrics:
+  textfile: ${WORKDIR}/metrics.prom
+mysqldump:
+  host: localhost
+  username: root
+  password: guest
+  per-table: true
+  order-by-primary: true
+  compression: none
+CONFIG
+
+export PATH="$(pwd)/test/stubs:${PATH}"
+export STUB_RESTIC_DIR=${WORKDIR}/restic
+export STUB_MYSQL_DATABASES="db1"
+export RESTIC_REPOSITORY=stub
+export RESTIC_PASSWORD=guest
+export RESTIC_PRUNE_TIMEOUT=12h
+export BACKUP_HOSTNAME=restic_host
+export BACKUP_ROOT=${WORKDIR}/backup
+export BACKUP_CONFIG=${WORKDIR}/config.yaml
+DUMP_DIR=${BACKUP_ROOT}/mysqldump
+
+fail() {
+	cat ${WORKDIR}/client.log
+	echo "$1"
+	echo "Test failed."
+	exit 1
+}
+
+mkdir -p ${BACKUP_ROOT}/files
+echo "some file" > ${BACKUP_ROOT}/files/a.txt
+
+python3 backup_client.py run > ${WORKDIR}/client.log 2>&1 || fail "Backup failed"
+
+for table in t u; do
+	[ -f ${DUMP_DIR}/MYSQL_db1/${table}.sql ] || fail "Missing uncompressed dump of table ${table}"
+	grep -q -- '--order-by-primary' ${DUMP_DIR}/MYSQL_db1/${table}.sql || fail "Table ${table} was not dumped ordered by primary key"
+	grep -q -- '--single-transaction' ${DUMP_DIR}/MYSQL_db1/${table}.sql || fail "Table ${table} was not dumped in a transaction"
+done
+# per-table dumps do not block writes by default
+! grep -q 'Mysql: Locking' ${WORKDIR}/client.log || fail "Tables of db1 were locked by default"
+
+SIZE=$(find ${DUMP_DIR} -type f -printf '%s\n' | awk '{ sum+=$1 } END { print sum }')
+grep -q 'Backup summary: Data added by folder: files 10 B, mysqldump' ${WORKDIR}/client.log || fail "Missing data added by folder"
+grep -q "restic_backup_backup_path_data_added_bytes{host=\"restic_host\",path=\"mysqldump\"} ${SIZE}.0" ${WORKDIR}/metrics.prom ||
+	fail "Missing metric of data added by mysqldump (${SIZE} bytes): $(grep path_data ${WORKDIR}/metrics.prom)"
+
+# consistency locked dumps all tables under one read lock and warns about it
+sed -i 's/per-table: true/per-table: {consistency: locked}/' ${WORKDIR}/config.yaml
+python3 backup_client.py run > ${WORKDIR}/client.log 2>&1 || fail "Backup with locked tables failed"
+for table in t u; do
+	grep -q -- '--skip-lock-tables' ${DUMP_DIR}/MYSQL_db1/${table}.sql || fail "Table ${table} was not dumped under the shared lock"
+done
+grep -q 'WARNING: Mysql: Locking 2 tables of db1, writes to db1 are blocked' ${WORKDIR}/client.log || fail "Missing warning about the locked tables"
+
+# levels outside the range of the codec fail at config load, before anything is dumped
+sed -i 's/compression: none/compression: {codec: zstd, level: 30}/' ${WORKDIR}/config.yaml
+rm -r ${DUMP_DIR}
+if python3 backup_client.py run > ${WORKDIR}/client.log 2>&1; then
+	fail "Invalid compression level was accepted"
+fi
+grep -q "Invalid compression level for zstd: 30 (allowed: 1-22)" ${WORKDIR}/client.log || fail "Missing error for the compression level"
+[ ! -e ${DUMP_DIR} ] || fail "Dumps were started with an invalid compression level"
+
+echo "Test succeeded."
+
+exit 0
@@ -0,0 +1,62 @@
+#!/bin/bash
+# Checks the native elasticsearch exporter (point in time and scroll, by version) against the stand-in server in test/stubs.
+# The sliced exports of an unchanged index must be byte-identical, so the dump files are kept and deduplicated.
+
+set -e
+
+cd "$(dirname "$0")/.."
+
+WORKDIR=$(mktemp -d)
+PORT=${STUB_ES_PORT:-19200}
+SERVER_PID=""
+trap '[ -n "${SERVER_PID}" ] && kill ${SERVER_PID}; rm -rf ${WORKDIR}' EXIT
+
+export STUB_ES_INDICES="logs-1 logs-2"
+export STUB_ES_DOCS=2500
+
+# elasticsearch 7.10 and 7.11 have point in time, but no _shard_doc sort, so the exporter scrolls
+for mode in pit pit-7.10 scroll; do
+	if [ "${mode}" == "pit-7.10" ]; then
+		export STUB_ES_VERSION=7.10.2
+	fi
+	if [ "${mode}" == "scroll" ]; then
+		unset STUB_ES_VERSION
+		export STUB_ES_NO_PIT=1
+	fi
+	python3 test/stubs/es_standin.py ${PORT} &
+	SERVER_PID=$!
+	sleep 1
+
+	mkdir ${WORKDIR}/${mode} ${WORKDIR}/${mode}-again
+	python3 elasticdump.py --native --slices 3 http://127.0.0.1:${PORT} ${WORKDIR}/${mode}
+	python3 elasticdump.py --native --slices 3 --batch-size 7 http://127.0.0.1:${PORT} ${WORKDIR}/${mode}-again
+
+	kill ${SERVER_PID}
+	wait ${SERVER_PID} || true
+	SERVER_PID=""
+
+	for index in ${STUB_ES_INDICES}; do
+		for datatype in alias mapping; do
+			if ! grep -q "\"${index}\"" ${WORKDIR}/${mode}/${index}__${datatype}.json; then
+				echo "${mode}: missing ${datatype} of ${index}"
+				echo "Test failed."
+				exit 1
+			fi
+		done
+		ACTUAL=$(cut -d, -f2 ${WORKDIR}/${mode}/${index}__data.json | sort -u | wc -l)
+		if [ ${ACTUAL} != ${STUB_ES_DOCS} ]; then
+			echo "${mode}: expected ${STUB_ES_DOCS} documents in ${index}, got ${ACTUAL}"
+			echo "Test failed."
+			exit 1
+		fi
+		if ! cmp -s ${WORKDIR}/${mode}/${index}__data.json ${WORKDIR}/${mode}-again/${index}__data.json; then
+			echo "${mode}: two exports of the unchanged ${index} differ"
+			echo "Test failed."
+			exit 1
+		fi
+	done
+done
+
+echo "Test succeeded."
+
+exit 0
@@ -0,0 +1,110 @@
+#!/bin/bash
+# Checks that notifications are queued, batched into one mail per run and retried, using the SMTP stand-in in test/stubs.
+
+set -e
+
+cd "$(dirname "$0")/.."
+
+WORKDIR=$(mktemp -d)
+PORT=${STUB_SMTP_PORT:-19025}
+SERVER_PID=""
+trap '[ -n "${SERVER_PID}" ] && kill ${SERVER_PID}; rm -rf ${WORKDIR}' EXIT
+
+cat > ${WORKDIR}/config.yaml <<CONFIG
+keep:
+  last: 1
+smtp:
+  host: 127.0.0.1
+  port: ${PORT}
+  tls: none
+  username: user
+  password: guest
+  from: backup@example.com
+  recipient: admin@example.com
+  retries: 2
+  retry-delay: 0.2
+CONFIG
+
+export PATH="$(pwd)/test/stubs:${PATH}"
+export STUB_RESTIC_DIR=${WORKDIR}/restic
+export RESTIC_REPOSITORY=stub
+export RESTIC_PASSWORD=guest
+export RESTIC_PRUNE_TIMEOUT=12h
+export BACKUP_HOSTNAME=restic_host
+export BACKUP_ROOT=${WORKDIR}/backup
+export BACKUP_CONFIG=${WORKDIR}/config.yaml
+mkdir ${BACKUP_ROOT} ${WORKDIR}/mails
+
+# the first connection is rejected, the retry succeeds
+STUB_SMTP_DIR=${WORKDIR}/mails STUB_SMTP_FAIL=1 python3 test/stubs/smtp_standin.py ${PORT} &
+SERVER_PID=$!
+sleep 1
+
+if STUB_RESTIC_BACKUP_EXIT=1 python3 backup_client.py run; then
+	echo "Failed backup did not fail"
+	echo "Test failed."
+	exit 1
+fi
+
+if [ "$(ls ${WORKDIR}/mails | wc -l)" != 1 ]; then
+	echo "Expected one mail for the run, got: $(ls ${WORKDIR}/mails)"
+	echo "Test failed."
+	exit 1
+fi
+
+for subject in "Subject: Restic Backup failed (and 1 more)" "Restic Backup Failed" "Backup Host: restic_host"; do
+	if ! grep -q "${subject}" ${WORKDIR}/mails/mail-1.eml; then
+		echo "Missing '${subject}' in the mail"
+		echo "Test failed."
+		exit 1
+	fi
+done
+
+kill ${SERVER_PID}
+wait ${SERVER_PID} || true
+SERVER_PID=""
+
+if python3 backup_client.py notify; then
+	echo "Notification without mail server did not fail"
+	echo "Test failed."
+	exit 1
+fi
+
+# with the default retries, delivery would take minutes, but the run exits after exit-timeout
+sed -i 's/retry-delay: 0.2/retry-delay: 30\n  exit-timeout: 1/' ${WORKDIR}/config.yaml
+STARTED=${SECONDS}
+if STUB_RESTIC_BACKUP_EXIT=1 timeout 60 python3 backup_client.py run > ${WORKDIR}/client.log 2>&1; then
+	echo "Failed backup did not fail"
+	echo "Test failed."
+	exit 1
+fi
+if [ $((SECONDS-STARTED)) -gt 20 ] || ! grep -q "Mail delivery did not finish in time." ${WORKDIR}/client.log; then
+	cat ${WORKDIR}/client.log
+	echo "Run waited for the mail server for $((SECONDS-STARTED))s"
+	echo "Test failed."
+	exit 1
+fi
+
+# an unexpected error does not stop the delivery of later mails
+python3 - <<'PYTHON'
+import sys
+import smtp_client
+mails=smtp_client.MailQueue(smtp_client.smtp_settings({'host': 'localhost','from': 'a','recipient': 'b','retries': 0}))
+sent=[]
+def send_mail(subject,body):
+	if subject=='broken':
+		raise ValueError('unexpected')
+	sent.append(subject)
+mails.client.send_mail=send_mail
+for subject in ('broken','working'):
+	mails.add(subject,'')
+	mails.flush()
+if mails.wait(5) or sent!=['working']:
+	print('Mails after an unexpected error: %s'%sent)
+	print('Test failed.')
+	sys.exit(1)
+PYTHON
+
+echo "Test succeeded."
+
+exit 0
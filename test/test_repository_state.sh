@@ -0,0 +1,85 @@
+#!/bin/bash
+# Checks that a long running client initializes the repository once and only unlocks it if locks exist.
+# Runs several backups in one process via the control API, using the stub binaries in test/stubs.
+
+set -e
+
+cd "$(dirname "$0")/.."
+
+WORKDIR=$(mktemp -d)
+SOCKET=${WORKDIR}/control.sock
+CLIENT_PID=""
+trap '[ -n "${CLIENT_PID}" ] && kill ${CLIENT_PID}; rm -rf ${WORKDIR}' EXIT
+
+cat > ${WORKDIR}/config.yaml <<CONFIG
+keep:
+  last: 1
+progress-interval: 0
+metrics:
+  textfile: ${WORKDIR}/metrics.prom
+control:
+  listen: ${SOCKET}
+CONFIG
+
+export PATH="$(pwd)/test/stubs:${PATH}"
+export STUB_RESTIC_DIR=${WORKDIR}/restic
+export RESTIC_REPOSITORY=stub
+export RESTIC_PASSWORD=guest
+export RESTIC_PRUNE_TIMEOUT=12h
+export BACKUP_HOSTNAME=restic_host
+export BACKUP_ROOT=${WORKDIR}/backup
+export BACKUP_CONFIG=${WORKDIR}/config.yaml
+mkdir ${BACKUP_ROOT}
+
+fail() {
+	cat ${WORKDIR}/client.log
+	echo "$1"
+	echo "Test failed."
+	exit 1
+}
+
+calls() {
+	grep -c "^$1" ${STUB_RESTIC_DIR}/calls.log || true
+}
+
+run_backup() {
+	curl -s --unix-socket ${SOCKET} -X POST http://localhost/run > /dev/null
+	for i in $(seq 100); do
+		sleep 0.1
+		curl -s --unix-socket ${SOCKET} http://localhost/status | grep -q '"running": null' && return
+	done
+	fail "Backup did not finish"
+}
+
+python3 backup_client.py schedule "0 0 1 1 *" > ${WORKDIR}/client.log 2>&1 &
+CLIENT_PID=$!
+for i in $(seq 50); do
+	[ -S ${SOCKET} ] && break
+	sleep 0.1
+done
+
+run_backup
+run_backup
+[ "$(calls init)" == 1 ] || fail "Expected one restic init, got $(calls init)"
+[ "$(calls unlock)" == 0 ] || fail "Unlocked a repository without locks"
+[ "$(calls 'list locks')" == 2 ] || fail "Expected one lock check per backup, got $(calls 'list locks')"
+
+echo "stale" > ${STUB_RESTIC_DIR}/locks
+run_backup
+[ "$(calls unlock)" == 1 ] || fail "Stale lock was not removed"
+
+grep -q 'restic_backup_repository_calls_skipped{call="init",host="restic_host"} 2.0' ${WORKDIR}/metrics.prom ||
+	fail "Missing metrics of skipped calls: $(cat ${WORKDIR}/metrics.prom)"
+
+# a failing unlock fails the rotation of the target instead of crashing the job
+echo "stale" > ${STUB_RESTIC_DIR}/locks
+if STUB_RESTIC_UNLOCK_FAIL=1 python3 backup_client.py rotate > ${WORKDIR}/rotate.log 2>&1; then
+	cat ${WORKDIR}/rotate.log
+	fail "Rotation with a failed unlock did not fail"
+fi
+grep -q 'Cleanup failed!' ${WORKDIR}/rotate.log || { cat ${WORKDIR}/rotate.log; fail "Failed unlock was not reported"; }
+! grep -q 'Traceback' ${WORKDIR}/rotate.log || { cat ${WORKDIR}/rotate.log; fail "Failed unlock raised an exception"; }
+
+echo "Test succeeded."
+
+exit 0
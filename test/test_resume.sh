@@ -0,0 +1,80 @@
+#!/bin/bash
+# Checks that "run --resume" keeps the databases a failed run dumped completely and that failed dumps are retried.
+# Uses the stub binaries in test/stubs, so neither a database nor restic is required.
+
+set -e
+
+cd "$(dirname "$0")/.."
+
+WORKDIR=$(mktemp -d)
+trap "rm -rf ${WORKDIR}" EXIT
+
+cat > ${WORKDIR}/config.yaml <<CONFIG
+keep:
+  last: 1
+progress-interval: 0
+mysqldump:
+  host: localhost
+  username: root
+  password: guest
+CONFIG
+
+export PATH="$(pwd)/test/stubs:${PATH}"
+export STUB_RESTIC_DIR=${WORKDIR}/restic
+export STUB_MYSQL_DATABASES="db1 db2 db3"
+export STUB_MYSQL_FLAKY_DIR=${WORKDIR}
+export RESTIC_REPOSITORY=stub
+export RESTIC_PASSWORD=guest
+export RESTIC_PRUNE_TIMEOUT=12h
+export BACKUP_HOSTNAME=restic_host
+export BACKUP_ROOT=${WORKDIR}/backup
+export BACKUP_CONFIG=${WORKDIR}/config.yaml
+DUMP_DIR=${BACKUP_ROOT}/mysqldump
+WRITE_DIR=${BACKUP_ROOT}/.mysqldump.new
+
+fail() {
+	cat ${WORKDIR}/client.log
+	echo "$1"
+	echo "Test failed."
+	exit 1
+}
+
+# runs without --resume record no checkpoint
+if STUB_MYSQL_FAIL=db2 python3 backup_client.py run > ${WORKDIR}/client.log 2>&1; then
+	fail "Backup with a failing database succeeded"
+fi
+[ -f ${WRITE_DIR}/.checkpoint.json ] && fail "Checkpoint written without --resume"
+
+if STUB_MYSQL_FAIL=db2 python3 backup_client.py run --resume > ${WORKDIR}/client.log 2>&1; then
+	fail "Backup with a failing database succeeded"
+fi
+[ -f ${WRITE_DIR}/.checkpoint.json ] || fail "No checkpoint written"
+grep -q '"db1"' ${WRITE_DIR}/.checkpoint.json || fail "db1 is not in the checkpoint"
+grep -q '"db2"' ${WRITE_DIR}/.checkpoint.json && fail "Failed db2 is in the checkpoint"
+
+# the kept dump must not be written again
+touch -d '2001-01-01' ${WRITE_DIR}/MYSQL_db1_DATA.sql.gz
+python3 backup_client.py run --resume > ${WORKDIR}/client.log 2>&1 || fail "Resumed backup failed"
+grep -q 'db1 was dumped completely by the interrupted run' ${WORKDIR}/client.log || fail "db1 was not kept"
+[ "$(stat -c %Y ${DUMP_DIR}/MYSQL_db1_DATA.sql.gz)" == "$(date -d '2001-01-01' +%s)" ] || fail "db1 was dumped again"
+for db in db2 db3; do
+	[ -f ${DUMP_DIR}/MYSQL_${db}_DATA.sql.gz ] || fail "${db} was not dumped"
+done
+[ -e ${WRITE_DIR} ] && fail "Checkpoint was not removed after the backup"
+
+# a changed dump is not trusted
+STUB_MYSQL_FAIL=db3 python3 backup_client.py run --resume > ${WORKDIR}/client.log 2>&1 || true
+echo "-- modified" > ${WRITE_DIR}/MYSQL_db1_DROP_CREATE.sql.gz
+python3 backup_client.py run --resume > ${WORKDIR}/client.log 2>&1 || fail "Resumed backup failed"
+grep -q 'dump of db1 changed since the interrupted run' ${WORKDIR}/client.log || fail "Modified db1 dump was kept"
+
+cat >> ${WORKDIR}/config.yaml <<CONFIG
+dump-retries: 2
+dump-retry-delay: 0.1
+CONFIG
+STUB_MYSQL_FLAKY=db2 python3 backup_client.py run > ${WORKDIR}/client.log 2>&1 || fail "Backup with a retried database failed"
+grep -q 'dump of db2 failed, retrying in 0.1s (1/2)' ${WORKDIR}/client.log || fail "db2 was not retried"
+
+echo "Test succeeded."
+
+exit 0
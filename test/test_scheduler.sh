@@ -0,0 +1,101 @@
+#!/bin/bash
+# Checks the overlap policies of the scheduler: a skip lane is dropped while a job runs, queue lanes run afterwards,
+# a coalesce lane waits at most once and jobs of all lanes never run at the same time. Needs neither restic nor a database.
+
+set -e
+
+cd "$(dirname "$0")/.."
+
+python3 - <<'PYTHON'
+import sys
+import threading
+import time
+import scheduler
+
+runs=[]
+lock=threading.Lock()
+
+def job(name):
+	def run(cancel):
+		started=time.monotonic()
+		time.sleep(0.3)
+		with lock:
+			runs.append((name,started,time.monotonic()))
+		return True
+	return run
+
+def fail(message):
+	print(message)
+	print('Runs: %s'%[run[0] for run in runs])
+	print('Test failed.')
+	sys.exit(1)
+
+def wait(condition,timeout=10):
+	deadline=time.monotonic()+timeout
+	while not condition():
+		if time.monotonic()>deadline:
+			fail('Timed out, status: %s'%jobs.status())
+		time.sleep(0.01)
+
+jobs=scheduler.Scheduler()
+jobs.add_lane('backup',[],job('backup'),'queue')
+jobs.add_lane('prune',[],job('prune'),'skip')
+jobs.add_lane('check',[],job('check'),'queue')
+jobs.add_lane('stats',[],job('stats'),'coalesce')
+runner=threading.Thread(target=jobs.run,daemon=True)
+runner.start()
+
+try:
+	jobs.add_lane('invalid',[],job('invalid'),'later')
+	fail('Invalid overlap policy was accepted')
+except ValueError:
+	pass
+
+if not jobs.trigger('backup'):
+	fail('Idle backup was not started')
+wait(lambda: jobs.status()['running'] is not None)
+
+if jobs.trigger('prune'):
+	fail('prune (skip) was not skipped while backup was running')
+if not jobs.trigger('check'):
+	fail('check (queue) was not queued while backup was running')
+if not jobs.trigger('backup'):
+	fail('backup (queue) was not queued while it was running')
+if not jobs.trigger('stats'):
+	fail('stats (coalesce) was not queued while backup was running')
+if jobs.trigger('stats'):
+	fail('stats (coalesce) was queued twice')
+if jobs.status()['pending']!=['check','backup','stats']:
+	fail('Unexpected pending lanes: %s'%jobs.status()['pending'])
+
+wait(lambda: len(runs)==4)
+if [run[0] for run in runs]!=['backup','check','backup','stats']:
+	fail('Unexpected order of runs')
+for previous,current in zip(runs,runs[1:]):
+	if current[1]<previous[2]:
+		fail('%s started before %s was finished'%(current[0],previous[0]))
+
+# a skip lane runs once nothing else is running or waiting
+wait(lambda: jobs.status()['running'] is None)
+if not jobs.trigger('prune'):
+	fail('prune was skipped while the scheduler was idle')
+wait(lambda: len(runs)==5)
+lanes={lane['name']: lane for lane in jobs.status()['lanes']}
+if lanes['prune']['last_run']['result']!='ok':
+	fail('Unexpected result of prune: %s'%lanes['prune']['last_run'])
+
+try:
+	jobs.trigger('unknown')
+	fail('Unknown lane was triggered')
+except KeyError:
+	pass
+
+jobs.stop()
+runner.join(5)
+if runner.is_alive():
+	fail('Scheduler did not stop')
+PYTHON
+
+echo "Test succeeded."
+
+exit 0
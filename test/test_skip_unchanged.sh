@@ -0,0 +1,81 @@
+#!/bin/bash
+# Checks that skip-unchanged keeps the dumps of unchanged mysql databases and dumps changed ones again, with the checksum
+# (default) and the metadata fingerprint. Uses the stub binaries in test/stubs, so neither a database nor restic is required.
+
+set -e
+
+cd "$(dirname "$0")/.."
+
+WORKDIR=$(mktemp -d)
+trap "rm -rf ${WORKDIR}" EXIT
+
+write_config() {
+	cat > ${WORKDIR}/config.yaml <<CONFIG
+keep:
+  last: 1
+progress-interval: 0
+mysqldump:
+  host: localhost
+  username: root
+  password: guest
+  skip-unchanged: $1
+CONFIG
+}
+
+export PATH="$(pwd)/test/stubs:${PATH}"
+export STUB_RESTIC_DIR=${WORKDIR}/restic
+export STUB_MYSQL_DATABASES="db1 db2"
+export RESTIC_REPOSITORY=stub
+export RESTIC_PASSWORD=guest
+export RESTIC_PRUNE_TIMEOUT=12h
+export BACKUP_HOSTNAME=restic_host
+export BACKUP_ROOT=${WORKDIR}/backup
+export BACKUP_CONFIG=${WORKDIR}/config.yaml
+
+fail() {
+	cat ${WORKDIR}/client.log
+	echo "$1"
+	echo "Test failed."
+	exit 1
+}
+
+run() {
+	python3 backup_client.py run --dump-only > ${WORKDIR}/client.log 2>&1 || fail "Backup failed"
+}
+
+kept() {
+	grep -q "Mysql: $1 is unchanged since" ${WORKDIR}/client.log
+}
+
+write_config true
+run
+kept db1 && fail "db1 was kept without a previous dump"
+grep -q '"checksum:' ${BACKUP_ROOT}/mysqldump/.dumpstate.json || fail "checksum is not the default method"
+
+# a change that information_schema does not reflect is found by the checksum
+STUB_MYSQL_SILENT_CHANGED=db2 run
+kept db1 || fail "Unchanged db1 was dumped again"
+kept db2 && fail "Changed db2 was kept"
+
+# the stub reports the original checksum again, which counts as another change
+run
+run
+kept db2 || fail "db2 was dumped again without a change"
+
+# metadata only detects changes of information_schema
+write_config "{method: metadata}"
+run
+kept db1 && fail "Fingerprint of another method was accepted"
+STUB_MYSQL_CHANGED=db2 run
+kept db1 || fail "Unchanged db1 was dumped again with metadata"
+kept db2 && fail "Changed db2 was kept with metadata"
+
+# a forced full dump ignores the fingerprint
+write_config "{force-full-days: 0}"
+run
+run
+kept db1 && fail "db1 was kept although a full dump was due"
+
+echo "Test succeeded."
+
+exit 0
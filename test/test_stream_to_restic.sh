@@ -0,0 +1,108 @@
+#!/bin/bash
+# Checks that stream-to-restic pipes mysql dumps and mongodb archives into "restic backup --stdin" without staging files.
+# Uses the stub binaries and the stub pymongo module in test/stubs, so neither a database nor restic is required.
+
+set -e
+
+cd "$(dirname "$0")/.."
+
+WORKDIR=$(mktemp -d)
+trap "rm -rf ${WORKDIR}" EXIT
+
+cat > ${WORKDIR}/config.yaml <<CONFIG
+stream-to-restic: true
+metrics:
+  textfile: ${WORKDIR}/metrics.prom
+keep:
+  last: 1
+tags:
+  - nightly
+mysqldump:
+  host: localhost
+  username: root
+  password: guest
+  parallelism: 2
+mongodump:
+  host: localhost
+  username: root
+  password: guest
+  per-database: true
+  parallelism: 2
+  archive: true
+CONFIG
+
+export PATH="$(pwd)/test/stubs:${PATH}"
+# the stub pymongo hides an installed one
+export PYTHONPATH="$(pwd)/test/stubs/python"
+export STUB_PYMONGO_LOG=${WORKDIR}/pymongo.log
+export STUB_RESTIC_DIR=${WORKDIR}/restic
+export STUB_MYSQL_DATABASES="db1 db2"
+export STUB_MONGO_DATABASES="admin app"
+export RESTIC_REPOSITORY=stub
+export RESTIC_PASSWORD=guest
+export RESTIC_PRUNE_TIMEOUT=12h
+export BACKUP_HOSTNAME=restic_host
+export BACKUP_ROOT=${WORKDIR}/backup
+export BACKUP_CONFIG=${WORKDIR}/config.yaml
+
+check_mongo_archives() {
+	for db in admin app; do
+		if ! grep -q "mongo archive ${db}" ${STUB_RESTIC_DIR}/stdin/mongodump/MONGO_${db}.archive; then
+			echo "Missing streamed archive MONGO_${db}.archive"
+			echo "Test failed."
+			exit 1
+		fi
+	done
+}
+
+python3 backup_client.py run
+
+if ! grep -q "^localhost 27017 root admin$" ${STUB_PYMONGO_LOG}; then
+	echo "Mongo databases were not listed with pymongo"
+	echo "Test failed."
+	exit 1
+fi
+
+for db in db1 db2; do
+	for part in "DROP_CREATE:CREATE DATABASE" "DATA:INSERT INTO"; do
+		if ! grep -q "${part#*:}" ${STUB_RESTIC_DIR}/stdin/mysqldump/MYSQL_${db}_${part%%:*}.sql; then
+			echo "Missing streamed dump MYSQL_${db}_${part%%:*}.sql"
+			echo "Test failed."
+			exit 1
+		fi
+	done
+done
+
+check_mongo_archives
+
+if [ -n "$(ls -A ${BACKUP_ROOT}/mysqldump)" ]; then
+	echo "Dump files were staged in ${BACKUP_ROOT}/mysqldump"
+	echo "Test failed."
+	exit 1
+fi
+
+if ! grep -q -- "--stdin-filename mysqldump/MYSQL_db1_DATA.sql --host restic_host --tag nightly" ${STUB_RESTIC_DIR}/calls.log; then
+	echo "Streamed backup does not use host and tags of the file backup"
+	echo "Test failed."
+	exit 1
+fi
+
+if ! grep -q 'restic_backup_phase_exit_code{database="db1",engine="mysqldump",host="restic_host",phase="dump_database"} 0.0' ${WORKDIR}/metrics.prom; then
+	echo "Missing metrics of the mysql dump"
+	echo "Test failed."
+	exit 1
+fi
+
+# without pymongo, the databases are listed with the mongo shell
+rm -r ${STUB_RESTIC_DIR}/stdin/mongodump ${STUB_PYMONGO_LOG}
+STUB_PYMONGO_MISSING=1 python3 backup_client.py run
+check_mongo_archives
+if [ -e ${STUB_PYMONGO_LOG} ]; then
+	echo "pymongo was used although it is missing"
+	echo "Test failed."
+	exit 1
+fi
+
+echo "Test succeeded."
+
+exit 0
@@ -0,0 +1,94 @@
+#!/bin/bash
+# Checks backups to several target repositories: in parallel with per-target retention and status, and with
+# replication via "restic copy" from a first target that also receives the streamed dumps. Uses the stubs in test/stubs.
+
+set -e
+
+cd "$(dirname "$0")/.."
+
+WORKDIR=$(mktemp -d)
+trap "rm -rf ${WORKDIR}" EXIT
+
+export PATH="$(pwd)/test/stubs:${PATH}"
+export STUB_RESTIC_DIR=${WORKDIR}/restic
+export STUB_MYSQL_DATABASES="db1"
+export RESTIC_PRUNE_TIMEOUT=12h
+export BACKUP_HOSTNAME=restic_host
+export BACKUP_ROOT=${WORKDIR}/backup
+export BACKUP_CONFIG=${WORKDIR}/config.yaml
+unset RESTIC_REPOSITORY RESTIC_PASSWORD
+mkdir ${BACKUP_ROOT}
+
+fail() {
+	echo "$1"
+	echo "Test failed."
+	exit 1
+}
+
+write_config() {
+	cat > ${WORKDIR}/config.yaml <<CONFIG
+replication: $1
+stream-to-restic: $2
+progress-interval: 0
+metrics:
+  textfile: ${WORKDIR}/metrics.prom
+keep:
+  last: 2
+mysqldump:
+  host: localhost
+  username: root
+  password: guest
+targets:
+  - name: onsite
+    repository: onsite
+    password: guest
+  - name: offsite
+    repository: offsite
+    password: secret
+    keep:
+      daily: 7
+CONFIG
+}
+
+# parallel backups, one target fails
+write_config parallel false
+if STUB_RESTIC_FAIL_REPOSITORY=offsite python3 backup_client.py run; then
+	fail "Run with a failed target did not fail"
+fi
+grep -q "^forget --keep-last 2" ${STUB_RESTIC_DIR}/onsite/calls.log || fail "onsite was not rotated with its retention"
+grep -q "^prune" ${STUB_RESTIC_DIR}/onsite/calls.log || fail "onsite was not pruned"
+! grep -q "^forget" ${STUB_RESTIC_DIR}/offsite/calls.log || fail "offsite was rotated after a failed backup"
+grep -q 'restic_backup_phase_exit_code{host="restic_host",phase="backup",target="offsite"} 1.0' ${WORKDIR}/metrics.prom ||
+	fail "Missing failure of offsite in metrics"
+grep -q 'restic_backup_phase_exit_code{host="restic_host",phase="backup",target="onsite"} 0.0' ${WORKDIR}/metrics.prom ||
+	fail "Missing success of onsite in metrics"
+
+python3 backup_client.py run
+grep -q "^forget --keep-daily 7" ${STUB_RESTIC_DIR}/offsite/calls.log || fail "offsite was not rotated with its retention"
+
+# one backup (streamed into the first target), copied to the second. Both repositories are new, the second one is
+# initialized with the chunker parameters of the first once that exists
+rm -rf ${STUB_RESTIC_DIR}
+write_config copy true
+STUB_RESTIC_INIT_DELAY=1 python3 backup_client.py run || fail "Run with new repositories failed"
+grep -q "MYSQL_db1_DATA.sql --host restic_host --repo onsite --password-file" ${STUB_RESTIC_DIR}/onsite/calls.log ||
+	fail "Dumps were not streamed into onsite"
+grep -q "INSERT INTO" ${STUB_RESTIC_DIR}/onsite/stdin/mysqldump/MYSQL_db1_DATA.sql || fail "Missing streamed dump in onsite"
+grep -q "^init --copy-chunker-params from onsite" ${STUB_RESTIC_DIR}/offsite/calls.log || fail "offsite was not initialized from onsite"
+! grep -q "^backup" ${STUB_RESTIC_DIR}/offsite/calls.log || fail "offsite was backed up instead of copied"
+grep -q "^forget --keep-daily 7" ${STUB_RESTIC_DIR}/offsite/calls.log || fail "offsite was not rotated after the copy"
+
+# only the snapshots of each run are copied (file backup and streamed dumps), not older ones forgotten by offsite
+copied() {
+	grep "^copy " ${STUB_RESTIC_DIR}/offsite/calls.log | sed -n "$1p" | tr ' ' '\n' | grep -E '^[0-9a-f]{8,}$' | sort
+}
+snapshots() {
+	grep -o '"id":"[0-9a-f]*"' ${STUB_RESTIC_DIR}/onsite/snapshots | cut -d '"' -f 4 | sed -n "$1p" | sort
+}
+[ "$(copied 1)" == "$(snapshots 1,3)" ] || fail "The first copy did not send the snapshots of its run: $(copied 1)"
+python3 backup_client.py run || fail "Second run with copy failed"
+[ "$(copied 2)" == "$(snapshots 4,6)" ] || fail "The second copy did not send only the snapshots of its run: $(copied 2)"
+
+echo "Test succeeded."
+
+exit 0
@@ -0,0 +1,62 @@
+#!/bin/bash
+# Checks that dump pipes are throttled and that the rate is lowered while the database latency probe exceeds its target.
+# Uses the stub binaries in test/stubs, so neither a database nor restic is required.
+
+set -e
+
+cd "$(dirname "$0")/.."
+
+WORKDIR=$(mktemp -d)
+trap "rm -rf ${WORKDIR}" EXIT
+
+# the probe target cannot be met, so the rate drops from 400K to 100K within 0.4s
+cat > ${WORKDIR}/config.yaml <<CONFIG
+keep:
+  last: 1
+progress-interval: 0
+throttle:
+  rate: 400K
+  min-rate: 100K
+  interval: 0.2
+  probe:
+    engine: mysqldump
+    latency: 0.000001
+mysqldump:
+  host: localhost
+  username: root
+  password: guest
+CONFIG
+
+export PATH="$(pwd)/test/stubs:${PATH}"
+export STUB_RESTIC_DIR=${WORKDIR}/restic
+export STUB_MYSQL_DATABASES="db1 db2"
+export STUB_MYSQL_PADDING=200000
+export RESTIC_REPOSITORY=stub
+export RESTIC_PASSWORD=guest
+export RESTIC_PRUNE_TIMEOUT=12h
+export BACKUP_HOSTNAME=restic_host
+export BACKUP_ROOT=${WORKDIR}/backup
+export BACKUP_CONFIG=${WORKDIR}/config.yaml
+
+fail() {
+	cat ${WORKDIR}/client.log
+	echo "$1"
+	echo "Test failed."
+	exit 1
+}
+
+STARTED=$(date +%s%N)
+python3 backup_client.py run --dump-only > ${WORKDIR}/client.log 2>&1 || fail "Backup failed"
+DURATION=$((($(date +%s%N)-STARTED)/1000000))
+
+grep -q 'Throttle: limiting dumps to 400.0 KiB/s' ${WORKDIR}/client.log || fail "Dumps were not throttled"
+grep -q 'Throttle: probe latency .* lowering dump rate to 100.0 KiB/s' ${WORKDIR}/client.log || fail "Rate was not lowered"
+# 400K at no less than 100K/s after the first 0.4s
+[ ${DURATION} -gt 2000 ] || fail "Dumps were not slowed down (${DURATION}ms)"
+for db in db1 db2; do
+	[ $(gunzip -c ${BACKUP_ROOT}/mysqldump/MYSQL_${db}_DATA.sql.gz | wc -c) -gt 200000 ] || fail "Dump of ${db} is incomplete"
+done
+
+echo "Test succeeded."
+
+exit 0
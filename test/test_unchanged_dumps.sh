@@ -0,0 +1,55 @@
+#!/bin/bash
+# Checks that dump files whose content did not change since the last run are kept with their mtime, changed files are
+# replaced and dumps of databases that are gone are removed.
+# Uses the stub binaries in test/stubs, so neither a database nor restic is required.
+
+set -e
+
+cd "$(dirname "$0")/.."
+
+WORKDIR=$(mktemp -d)
+trap "rm -rf ${WORKDIR}" EXIT
+
+cat > ${WORKDIR}/config.yaml <<CONFIG
+keep:
+  last: 1
+progress-interval: 0
+mysqldump:
+  host: localhost
+  username: root
+  password: guest
+CONFIG
+
+export PATH="$(pwd)/test/stubs:${PATH}"
+export STUB_RESTIC_DIR=${WORKDIR}/restic
+export RESTIC_REPOSITORY=stub
+export RESTIC_PASSWORD=guest
+export RESTIC_PRUNE_TIMEOUT=12h
+export BACKUP_HOSTNAME=restic_host
+export BACKUP_ROOT=${WORKDIR}/backup
+export BACKUP_CONFIG=${WORKDIR}/config.yaml
+DUMP_DIR=${BACKUP_ROOT}/mysqldump
+OLD=$(date -d '2001-01-01' +%s)
+
+fail() {
+	cat ${WORKDIR}/client.log
+	echo "$1"
+	echo "Test failed."
+	exit 1
+}
+
+STUB_MYSQL_DATABASES="db1 db2 db3" python3 backup_client.py run > ${WORKDIR}/client.log 2>&1 || fail "First backup failed"
+touch -d '2001-01-01' ${DUMP_DIR}/*
+
+STUB_MYSQL_DATABASES="db1 db2" STUB_MYSQL_CHANGED=db2 python3 backup_client.py run > ${WORKDIR}/client.log 2>&1 || fail "Second backup failed"
+grep -q 'Mysqldump: 1 of 4 dump files changed' ${WORKDIR}/client.log || fail "Unexpected number of changed files"
+for file in MYSQL_db1_DROP_CREATE.sql.gz MYSQL_db1_DATA.sql.gz MYSQL_db2_DROP_CREATE.sql.gz; do
+	[ "$(stat -c %Y ${DUMP_DIR}/${file})" == "${OLD}" ] || fail "Unchanged ${file} was replaced"
+done
+[ "$(stat -c %Y ${DUMP_DIR}/MYSQL_db2_DATA.sql.gz)" != "${OLD}" ] || fail "Changed MYSQL_db2_DATA.sql.gz was not replaced"
+[ -e ${DUMP_DIR}/MYSQL_db3_DATA.sql.gz ] && fail "Dump of removed db3 was kept"
+[ -e ${BACKUP_ROOT}/.mysqldump.new ] && fail "Write dir was not removed"
+
+echo "Test succeeded."
+
+exit 0
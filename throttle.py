@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+import logging as log
+import contextlib
+import os
+import os.path
+import re
+import shlex
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# dump engines whose database can be probed for its query latency
+PROBE_ENGINES=['mysqldump','pgdump']
+PRESSURE_FILE='/proc/pressure/io'
+# name of the file with the current rate in the directory shared with the pipe processes
+RATE_FILE='rate'
+# seconds between two reads of the rate file by a pipe process
+PIPE_REFRESH=1.0
+PIPE_BLOCK_SIZE=64*1024
+
+def parse_bytes(value):
+	'''
+	Parses a number of bytes with an optional binary unit suffix (K, M, G, e.g. "50M"). Raises ValueError if it is invalid.
+	'''
+	match=re.match(r'^\s*([0-9.]+)\s*([KMG]?)i?B?\s*$',str(value),re.I)
+	if match is None:
+		raise ValueError('Invalid size: %s'%value)
+	return int(float(match.group(1))*1024**' KMG'.index(match.group(2).upper() or ' '))
+
+def throttle_settings(config):
+	'''
+	Parses the "throttle" section of the config. Returns None if the config is invalid.
+	'''
+	if type(config) is not dict or 'rate' not in config:
+		log.error('Invalid throttle config, rate is required: %s'%config)
+		return None
+	probe=config['probe'] if 'probe' in config else None
+	if probe is not None and (type(probe) is not dict or probe.get('engine') not in PROBE_ENGINES or 'latency' not in probe):
+		log.error('Invalid throttle probe: engine (one of %s) and latency are required'%', '.join(PROBE_ENGINES))
+		return None
+	try:
+		rate=parse_bytes(config['rate'])
+		settings={
+			'rate': rate,
+			'min-rate': parse_bytes(config['min-rate']) if 'min-rate' in config else rate//20,
+			'interval': float(config['interval']) if 'interval' in config else 5,
+			'load': float(config['load']) if 'load' in config else None,
+			'io-pressure': float(config['io-pressure']) if 'io-pressure' in config else None,
+			'probe': None,
+		}
+		if probe is not None:
+			settings['probe']={
+				'engine': probe['engine'],
+				'query': str(probe['query']) if 'query' in probe else 'SELECT 1',
+				'latency': float(probe['latency']),
+			}
+	except ValueError as e:
+		log.error('Invalid throttle config: %s'%e)
+		return None
+	if settings['load'] is None and settings['io-pressure'] is None and settings['probe'] is None:
+		log.warning('Throttle: no load, io-pressure or probe target set, dumps are limited to a fixed rate')
+	return settings
+
+def read_io_pressure():
+	'''
+	Returns the share of time (in percent, average of the last 10 seconds) in which some tasks waited for IO, or None if
+	the kernel does not report pressure stall information.
+	'''
+	try:
+		with open(PRESSURE_FILE) as f:
+			for line in f:
+				if line.startswith('some '):
+					return float(dict([field.split('=') for field in line.split()[1:]])['avg10'])
+	except (OSError,KeyError,ValueError):
+		pass
+	return None
+
+class Throttle:
+	'''
+	Limits the bandwidth of all dump pipes together (see pipe_command) to a rate that adapts to the load every interval seconds:
+	if a signal (load average, IO pressure or the latency of a probe query against the database) exceeds its target, the rate
+	is halved (not below min-rate), if all signals are below 80% of their target, it is raised by a tenth of the configured rate.
+	The rate is shared with the pipe processes through a file in a private directory.
+	'''
+	def __init__(self,settings,probe=None):
+		self.settings=settings
+		self.probe=probe
+		self.rate=settings['rate']
+		self.dir=tempfile.mkdtemp(prefix='throttle')
+		self.stopped=threading.Event()
+		self.thread=None
+		self.write_rate()
+
+	def write_rate(self):
+		tmp_file=os.path.join(self.dir,RATE_FILE+'.tmp')
+		with open(tmp_file,'w') as f:
+			f.write('%d\n'%self.rate)
+		os.replace(tmp_file,os.path.join(self.dir,RATE_FILE))
+
+	def signals(self):
+		'''
+		Returns (name,value,target) of each configured signal that could be measured.
+		'''
+		signals=[]
+		if self.settings['load'] is not None:
+			signals.append(('load',os.getloadavg()[0],self.settings['load']))
+		if self.settings['io-pressure'] is not None:
+			pressure=read_io_pressure()
+			if pressure is not None:
+				signals.append(('io pressure',pressure,self.settings['io-pressure']))
+		if self.probe is not None:
+			started=time.monotonic()
+			try:
+				self.probe(self.settings['probe']['query'],timeout=self.settings['interval'])
+				latency=time.monotonic()-started
+			except Exception as e:
+				log.warning('Throttle: probe query failed: %s'%e)
+				# an unreachable database counts as overloaded
+				latency=float('inf')
+			signals.append(('probe latency',latency,self.settings['probe']['latency']))
+		return signals
+
+	def adjust(self):
+		signals=self.signals()
+		load=max([value/target if target>0 else float('inf') for name,value,target in signals],default=0)
+		rate=self.rate
+		if load>1:
+			rate=max(self.settings['min-rate'],self.rate//2)
+		elif load<0.8:
+			rate=min(self.settings['rate'],self.rate+self.settings['rate']//10)
+		if rate==self.rate:
+			return
+		log.info('Throttle: %s, %s dump rate to %s/s (was %s/s)'%(
+			', '.join(['%s %.3g (target %.3g)'%signal for signal in signals]),
+			'lowering' if rate<self.rate else 'raising',format_rate(rate),format_rate(self.rate)))
+		self.rate=rate
+		self.write_rate()
+
+	def run(self):
+		while not self.stopped.wait(self.settings['interval']):
+			try:
+				self.adjust()
+			except Exception:
+				log.exception('Throttle: adjusting the rate failed')
+
+	def start(self):
+		log.info('Throttle: limiting dumps to %s/s'%format_rate(self.rate))
+		self.thread=threading.Thread(target=self.run,name='throttle',daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+		shutil.rmtree(self.dir,ignore_errors=True)
+
+def format_rate(rate):
+	for unit in ['B','KiB','MiB']:
+		if rate<1024:
+			return ('%d %s' if unit=='B' else '%.1f %s')%(rate,unit)
+		rate/=1024
+	return '%.1f GiB'%rate
+
+# the throttle of the running dumps, None if they are not throttled
+_active=None
+
+@contextlib.contextmanager
+def throttled(settings,probe=None):
+	'''
+	Throttles the dump pipes started within the block. Does nothing if settings is None.
+	'''
+	global _active
+	if settings is None:
+		yield None
+		return
+	_active=Throttle(settings,probe)
+	_active.start()
+	try:
+		yield _active
+	finally:
+		_active.stop()
+		_active=None
+
+def pipe_command():
+	'''
+	Returns the shell command of the throttling pipe stage (copies stdin to stdout at the current rate), or None if dumps
+	are not throttled.
+	'''
+	if _active is None:
+		return None
+	return '%s %s pipe %s'%(shlex.quote(sys.executable),shlex.quote(os.path.abspath(__file__)),shlex.quote(_active.dir))
+
+def read_rate(throttle_dir):
+	try:
+		with open(os.path.join(throttle_dir,RATE_FILE)) as f:
+			return int(f.read())
+	except (OSError,ValueError):
+		return 0
+
+def count_pipes(throttle_dir):
+	'''
+	Counts the pipe processes that passed data recently, which share the rate (a pipe waiting for its input does not).
+	'''
+	count=0
+	try:
+		filenames=os.listdir(throttle_dir)
+	except OSError:
+		return 1
+	for filename in filenames:
+		if not filename.startswith('pipe.'):
+			continue
+		try:
+			if time.time()-os.path.getmtime(os.path.join(throttle_dir,filename))<2*PIPE_REFRESH:
+				count+=1
+		except OSError:
+			pass
+	return max(count,1)
+
+def pipe(throttle_dir,source=None,target=None):
+	'''
+	Copies source to target (default stdin/stdout), paced to the share of this process of the rate in throttle_dir.
+	'''
+	source=source or sys.stdin.buffer
+	target=target or sys.stdout.buffer
+	registration=os.path.join(throttle_dir,'pipe.%s'%os.getpid())
+	refreshed=0
+	try:
+		for block in iter(lambda: source.read1(PIPE_BLOCK_SIZE),b''):
+			now=time.monotonic()
+			if now-refreshed>=PIPE_REFRESH:
+				refreshed=window_start=now
+				window_bytes=0
+				try:
+					# the mtime of the registration tells the other pipes that this one is active
+					with open(registration,'a'):
+						os.utime(registration)
+					rate=read_rate(throttle_dir)/count_pipes(throttle_dir)
+				except OSError:
+					# the throttle stopped meanwhile
+					rate=0
+			target.write(block)
+			window_bytes+=len(block)
+			if rate>0:
+				delay=window_start+window_bytes/rate-time.monotonic()
+				if delay>0:
+					target.flush()
+					time.sleep(delay)
+		target.flush()
+	finally:
+		try:
+			os.unlink(registration)
+		except OSError:
+			pass
+
+def main():
+	if len(sys.argv)!=3 or sys.argv[1]!='pipe':
+		print('Usage: throttle.py pipe <throttle-dir>')
+		quit(1)
+	try:
+		pipe(sys.argv[2])
+	except BrokenPipeError:
+		quit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import logging as log
+import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+class Cancelled(Exception):
+	pass
+
+class CancelToken:
+	'''
+	A cancellation flag which is also set if its parent is set, so nested worker pools stop together.
+	'''
+	def __init__(self,parent=None):
+		self.parent=parent
+		self.event=threading.Event()
+
+	def set(self):
+		self.event.set()
+
+	def is_set(self):
+		return self.event.is_set() or (self.parent is not None and self.parent.is_set())
+
+	def wait(self,timeout,poll_interval=0.5):
+		'''
+		Waits up to timeout seconds for the token (or its parent) to be set. Returns is_set().
+		'''
+		deadline=time.monotonic()+timeout
+		while not self.is_set():
+			remaining=deadline-time.monotonic()
+			if remaining<=0:
+				break
+			self.event.wait(min(remaining,poll_interval))
+		return self.is_set()
+
+_context=threading.local()
+
+def get_log_prefix():
+	return getattr(_context,'prefix',None)
+
+def set_log_prefix(prefix):
+	_context.prefix=prefix
+
+class LogPrefixFilter(log.Filter):
+	def filter(self,record):
+		prefix=get_log_prefix()
+		if prefix is not None:
+			record.msg='[%s] %s'%(prefix,record.msg)
+		return True
+
+def install_log_prefix():
+	'''
+	Prefixes all log lines with the name of the job that emitted them (see run_parallel).
+	'''
+	log.getLogger().addFilter(LogPrefixFilter())
+
+def log_output(stream,prefix):
+	set_log_prefix(prefix)
+	for line in iter(stream.readline,b''):
+		line=line.decode(errors='replace').rstrip()
+		if line:
+			log.info('%s',line)
+	stream.close()
+
+def run_command(cmd,cancel=None,env=None,poll_interval=0.5):
+	'''
+	Runs a command like subprocess.run(cmd,check=True) in its own process group, so it can be killed
+	once cancel is set. Strings are run as bash pipeline with pipefail enabled. The output of the command
+	is passed to the log.
+	'''
+	if cancel is not None and cancel.is_set():
+		raise Cancelled()
+	if type(cmd) is str:
+		proc=subprocess.Popen('set -o pipefail; %s'%cmd,shell=True,executable='/bin/bash',
+			env=env,start_new_session=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+	else:
+		proc=subprocess.Popen(cmd,env=env,start_new_session=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+	reader=threading.Thread(target=log_output,args=(proc.stdout,get_log_prefix()),daemon=True)
+	reader.start()
+	try:
+		while True:
+			try:
+				proc.wait(timeout=poll_interval)
+				break
+			except subprocess.TimeoutExpired:
+				if cancel is not None and cancel.is_set():
+					kill_process_group(proc)
+					raise Cancelled()
+	except BaseException:
+		kill_process_group(proc)
+		raise
+	finally:
+		reader.join(timeout=5)
+	if proc.returncode!=0:
+		raise subprocess.CalledProcessError(proc.returncode,cmd)
+
+def open_command(cmd,env=None):
+	'''
+	Starts a command (a list) whose stdout is read by the caller. Stderr is passed to the log.
+	Must be finished with close_command.
+	'''
+	proc=subprocess.Popen(cmd,env=env,start_new_session=True,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+	proc.log_reader=threading.Thread(target=log_output,args=(proc.stderr,get_log_prefix()),daemon=True)
+	proc.log_reader.start()
+	return proc
+
+def close_command(proc,cmd,cancel=None):
+	'''
+	Waits for a command started by open_command and raises subprocess.CalledProcessError if it failed,
+	or Cancelled if cancel was set meanwhile.
+	'''
+	if cancel is not None and cancel.is_set():
+		kill_process_group(proc)
+	proc.stdout.close()
+	proc.wait()
+	proc.log_reader.join(timeout=5)
+	if cancel is not None and cancel.is_set():
+		raise Cancelled()
+	if proc.returncode!=0:
+		raise subprocess.CalledProcessError(proc.returncode,cmd)
+
+def kill_process_group(proc):
+	if proc.poll() is not None:
+		return
+	try:
+		os.killpg(proc.pid,signal.SIGTERM)
+		proc.wait(timeout=10)
+	except subprocess.TimeoutExpired:
+		os.killpg(proc.pid,signal.SIGKILL)
+		proc.wait()
+	except ProcessLookupError:
+		pass
+
+def run_parallel(name,jobs,parallelism=1,cancel=None,log_prefix=False,fail_fast=True):
+	'''
+	Runs jobs (a list of (label,function) tuples) on a bounded pool of worker threads.
+	Each function is called with a CancelToken that is set once any job (or the parent cancel token) has failed
+	and must return True on success.
+	On the first failure, all jobs that did not start yet are cancelled and running jobs are asked to stop,
+	unless fail_fast is False (then only the parent cancel token stops them).
+	If log_prefix is set, log lines of each job are prefixed with its label, otherwise the prefix of the caller is kept.
+	'''
+	parallelism=max(1,int(parallelism))
+	cancel=CancelToken(cancel)
+	parent_prefix=get_log_prefix()
+	ok=True
+
+	def run_job(label,job):
+		set_log_prefix(label if log_prefix else parent_prefix)
+		if cancel.is_set():
+			return None
+		try:
+			result=job(cancel)
+		except Cancelled:
+			log.info('%s: %s cancelled.'%(name,label))
+			return None
+		except Exception:
+			log.exception('%s: %s failed unexpectedly.'%(name,label))
+			result=False
+		if result is False and fail_fast:
+			# stop other workers before they pick up the next job
+			cancel.set()
+		return result
+
+	with ThreadPoolExecutor(max_workers=parallelism) as executor:
+		futures={}
+		for label,job in jobs:
+			futures[executor.submit(run_job,label,job)]=label
+		for future in as_completed(futures):
+			label=futures[future]
+			if future.cancelled():
+				continue
+			result=future.result()
+			if result is False and ok:
+				ok=False
+				if not fail_fast:
+					continue
+				if len(futures)>1:
+					log.error('%s: %s failed, cancelling remaining jobs.'%(name,label))
+				cancel.set()
+				for other in futures:
+					other.cancel()
+	# a cancelled parent counts as failure even if no job of this pool failed
+	if ok and cancel.is_set():
+		ok=False
+	return ok